@@ -88,6 +88,18 @@ class CenterlineComputationWidget(ScriptedLoadableModuleWidget):
     self.parent.connect( 'mrmlSceneChanged(vtkMRMLScene*)',
                         self.__seedFiducialsNodeSelector, 'setMRMLScene(vtkMRMLScene*)' )
 
+    # vesselness volume selector, its scale map is used to check the centerline radius
+    self.__vesselnessVolumeNodeSelector = slicer.qMRMLNodeComboBox()
+    self.__vesselnessVolumeNodeSelector.objectName = 'vesselnessVolumeNodeSelector'
+    self.__vesselnessVolumeNodeSelector.toolTip = "Select the input or vesselness volume of a Vesselness Filtering that computed a scale map. The vessel radius from the scale map is stored in the VesselnessRadius array of the centerlines and compared to the centerline radius."
+    self.__vesselnessVolumeNodeSelector.nodeTypes = ['vtkMRMLScalarVolumeNode']
+    self.__vesselnessVolumeNodeSelector.noneEnabled = True
+    self.__vesselnessVolumeNodeSelector.addEnabled = False
+    self.__vesselnessVolumeNodeSelector.removeEnabled = False
+    inputsFormLayout.addRow( "Vesselness volume:", self.__vesselnessVolumeNodeSelector )
+    self.parent.connect( 'mrmlSceneChanged(vtkMRMLScene*)',
+                        self.__vesselnessVolumeNodeSelector, 'setMRMLScene(vtkMRMLScene*)' )
+
     #
     # Outputs
     #
@@ -162,6 +174,7 @@ class CenterlineComputationWidget(ScriptedLoadableModuleWidget):
 
     self.__inputModelNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__seedFiducialsNodeSelector.setMRMLScene( slicer.mrmlScene )
+    self.__vesselnessVolumeNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__outputModelNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__outputEndPointsNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__voronoiModelNodeSelector.setMRMLScene( slicer.mrmlScene )
@@ -193,6 +206,7 @@ class CenterlineComputationWidget(ScriptedLoadableModuleWidget):
     currentOutputModelNode = self.__outputModelNodeSelector.currentNode()
     currentEndPointsMarkupsNode = self.__outputEndPointsNodeSelector.currentNode()
     currentVoronoiModelNode = self.__voronoiModelNodeSelector.currentNode()
+    currentVesselnessNode = self.__vesselnessVolumeNodeSelector.currentNode()
 
     if not currentModelNode:
       # we need a input volume node
@@ -324,6 +338,18 @@ class CenterlineComputationWidget(ScriptedLoadableModuleWidget):
       network.DeepCopy( tupel[0] )
       voronoi.DeepCopy( tupel[1] )
 
+      # check the centerline radius against the vessel diameter detected by the vesselness filtering
+      if currentVesselnessNode:
+        if not SlicerVmtkCommonLib.Helper.GetVesselnessScalesVolumeNode( currentVesselnessNode ):
+          logging.warning( "Volume {0} has no vesselness scale map, select a scale map volume in Vesselness Filtering".format(
+            currentVesselnessNode.GetName() ) )
+        else:
+          radiusRatio = self.__logic.addVesselnessRadius( network, currentVesselnessNode )
+          logging.info( "Median centerline radius / vesselness radius: {0}".format( radiusRatio ) )
+          if radiusRatio is not None and ( radiusRatio < 0.5 or radiusRatio > 2.0 ):
+            logging.warning( "Centerline radius differs from the vessel radius of the vesselness scale map by more than a factor of 2,"
+              " the vessel tree model may not match the vessels" )
+
     currentOutputModelNode.SetAndObservePolyData( network )
 
         
@@ -1,5 +1,6 @@
 # slicer imports
 import os
+import multiprocessing
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -264,6 +265,31 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     self.__iterationSpinBox.toolTip = "Choose the number of evolution iterations."
     segmentationAdvancedFormLayout.addRow( SlicerVmtkCommonLib.Helper.CreateSpace( 100 ) + "Iterations:", self.__iterationSpinBox )
 
+    # convergence tolerance spinbox
+    self.__convergenceSpinBox = qt.QDoubleSpinBox()
+    self.__convergenceSpinBox.decimals = 4
+    self.__convergenceSpinBox.minimum = 0
+    self.__convergenceSpinBox.maximum = 1
+    self.__convergenceSpinBox.singleStep = 0.001
+    self.__convergenceSpinBox.specialValueText = "off"
+    self.__convergenceSpinBox.toolTip = "Stop the evolution when the RMS change of the level set in an iteration is below this value. Set to 0 to always run all iterations."
+    segmentationAdvancedFormLayout.addRow( SlicerVmtkCommonLib.Helper.CreateSpace( 100 ) + "Convergence tolerance:", self.__convergenceSpinBox )
+
+    # cropped rounds checkbox
+    self.__croppedRoundsCheckBox = qt.QCheckBox()
+    self.__croppedRoundsCheckBox.toolTip = "If checked, the evolution runs in rounds on the bounding box of the current segmentation. Faster when the segmentation is small compared to the volume, the result can slightly differ."
+    segmentationAdvancedFormLayout.addRow( SlicerVmtkCommonLib.Helper.CreateSpace( 100 ) + "Evolve in cropped rounds:", self.__croppedRoundsCheckBox )
+
+    # crop checkbox
+    self.__cropToInitializationCheckBox = qt.QCheckBox()
+    self.__cropToInitializationCheckBox.toolTip = "If checked, the evolution only runs on the region that the initialization can reach in the given number of iterations."
+    segmentationAdvancedFormLayout.addRow( SlicerVmtkCommonLib.Helper.CreateSpace( 100 ) + "Crop to initialization:", self.__cropToInitializationCheckBox )
+
+    # warm start checkbox
+    self.__warmStartCheckBox = qt.QCheckBox()
+    self.__warmStartCheckBox.toolTip = "If checked and the seeds, stoppers and thresholds are unchanged, the evolution continues from the previous result: more iterations only run the additional ones, other weights refine the previous result."
+    segmentationAdvancedFormLayout.addRow( SlicerVmtkCommonLib.Helper.CreateSpace( 100 ) + "Continue previous evolution:", self.__warmStartCheckBox )
+
     #
     # Reset, preview and apply buttons
     #
@@ -281,6 +307,13 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     self.__startButton.enabled = False
     self.__startButton.toolTip = "Click to start the filtering."
     self.layout.addWidget( self.__buttonBox )
+
+    self.__progressBar = qt.QProgressBar()
+    self.__progressBar.minimum = 0
+    self.__progressBar.maximum = 100
+    self.__progressBar.hide()
+    self.layout.addWidget( self.__progressBar )
+
     self.__resetButton.connect( "clicked()", self.restoreDefaults )
     self.__previewButton.connect( "clicked()", self.onPreviewButtonClicked )
     self.__startButton.connect( "clicked()", self.onStartButtonClicked )
@@ -301,9 +334,14 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
 
   def onStartButtonClicked( self ):
     qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-    # this is no preview
-    self.start( False )
-    qt.QApplication.restoreOverrideCursor()
+    # events are processed during the evolution (see onEvolutionProgress), the buttons must not start another one
+    self.__buttonBox.enabled = False
+    try:
+      # this is no preview
+      self.start( False )
+    finally:
+      self.__buttonBox.enabled = True
+      qt.QApplication.restoreOverrideCursor()
 
   def onPreviewButtonClicked( self ):
       '''
@@ -349,9 +387,11 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     if not currentImageData:
       return
 
+    # a quantized vesselness volume stores scaled values, the slider shows the vesselness response
+    scale = SlicerVmtkCommonLib.Helper.GetVesselnessQuantizationScale( currentNode )
     currentScalarRange = currentImageData.GetScalarRange()
-    minimumScalarValue = round( currentScalarRange[0], 0 )
-    maximumScalarValue = round( currentScalarRange[1], 0 )
+    minimumScalarValue = round( currentScalarRange[0] / scale, 0 )
+    maximumScalarValue = round( currentScalarRange[1] / scale, 0 )
     self.__thresholdSlider.minimum = minimumScalarValue
     self.__thresholdSlider.maximum = maximumScalarValue
 
@@ -362,8 +402,8 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     if currentDisplayNode:
       if currentDisplayNode.GetApplyThreshold():
         # if a threshold is already applied, use it!
-        self.__thresholdSlider.minimumValue = currentDisplayNode.GetLowerThreshold()
-        self.__thresholdSlider.maximumValue = currentDisplayNode.GetUpperThreshold()
+        self.__thresholdSlider.minimumValue = currentDisplayNode.GetLowerThreshold() / scale
+        self.__thresholdSlider.maximumValue = currentDisplayNode.GetUpperThreshold() / scale
       else:
         # don't use a threshold, use the scalar range
         logging.debug( "Reset thresholdSlider's values." )
@@ -391,8 +431,10 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     if currentNode:
       currentDisplayNode = currentNode.GetDisplayNode()
       if currentDisplayNode:
-        currentDisplayNode.SetLowerThreshold( self.__thresholdSlider.minimumValue )
-        currentDisplayNode.SetUpperThreshold( self.__thresholdSlider.maximumValue )
+        # the slider shows vesselness response, a quantized vesselness volume stores scaled values
+        scale = SlicerVmtkCommonLib.Helper.GetVesselnessQuantizationScale( currentNode )
+        currentDisplayNode.SetLowerThreshold( self.__thresholdSlider.minimumValue * scale )
+        currentDisplayNode.SetUpperThreshold( self.__thresholdSlider.maximumValue * scale )
         currentDisplayNode.SetApplyThreshold( 1 )
 
   def onSegmentationAdvancedToggle( self ):
@@ -424,12 +466,23 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     self.__curvatureSlider.value = 70
     self.__attractionSlider.value = 50
     self.__iterationSpinBox.value = 10
+    self.__convergenceSpinBox.value = 0
+    self.__croppedRoundsCheckBox.checked = False
+    self.__cropToInitializationCheckBox.checked = False
+    self.__warmStartCheckBox.checked = True
 
     # reset threshold on display node
     self.resetThresholdOnDisplayNode()
     # if a volume is selected, the threshold slider values have to match it
     self.onInputVolumeChanged()
 
+  def onEvolutionProgress( self, completedIterations, numberOfIterations, rmsChange ):
+    self.__progressBar.value = int( 100 * completedIterations / max( numberOfIterations, 1 ) )
+    if rmsChange is not None:
+      self.__progressBar.format = "%p% (RMS change: {0:.4g})".format( rmsChange )
+    # keep the application responsive while the evolution is running
+    slicer.app.processEvents()
+
   def start( self, preview=False ):
     logging.debug( "Starting Level Set Segmentation.." )
 
@@ -491,6 +544,21 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
         # no, there is none - we use the original image
         inputImage.DeepCopy( currentVolumeNode.GetImageData() )
 
+    # inputImage is a copy, the speed image can be computed in its memory if it has float voxels
+    speedArray = None
+    if inputImage.GetScalarType() == vtk.VTK_FLOAT and inputImage.GetNumberOfScalarComponents() == 1:
+        speedArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray( inputImage )
+
+    # thresholds are specified as vesselness response, a quantized vesselness volume stores scaled values
+    thresholdScale = SlicerVmtkCommonLib.Helper.GetVesselnessQuantizationScale( currentVesselnessNode )
+
+    # identifies the inputs of the initialization, the logic reuses its previous results if they are unchanged
+    initializationInputNode = currentVesselnessNode if currentVesselnessNode else currentVolumeNode
+    initializationKey = ( initializationInputNode.GetID(), initializationInputNode.GetImageData().GetMTime(),
+                          self.__thresholdSlider.minimumValue * thresholdScale, self.__thresholdSlider.maximumValue * thresholdScale,
+                          tuple( seeds.GetId( index ) for index in range( seeds.GetNumberOfIds() ) ),
+                          tuple( stoppers.GetId( index ) for index in range( stoppers.GetNumberOfIds() ) ) )
+
     # initialization
     initImageData = vtk.vtkImageData()
 
@@ -499,11 +567,14 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
 
     # perform the initialization
     initImageData.DeepCopy( self.__logic.performInitialization( inputImage,
-                                                                 self.__thresholdSlider.minimumValue,
-                                                                 self.__thresholdSlider.maximumValue,
+                                                                 self.__thresholdSlider.minimumValue * thresholdScale,
+                                                                 self.__thresholdSlider.maximumValue * thresholdScale,
                                                                  seeds,
                                                                  stoppers,
-                                                                 'collidingfronts' ) )
+                                                                 'collidingfronts',
+                                                                 initializationKey,
+                                                                 numberOfWorkers=multiprocessing.cpu_count(),
+                                                                 speedArray=speedArray ) )
 
     if not initImageData.GetPointData().GetScalars():
         # something went wrong, the image is empty
@@ -519,13 +590,22 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     else:
 
         # no preview, run the whole thing! we never use the vesselness node here, just the original one
+        self.__progressBar.value = 0
+        self.__progressBar.format = "%p%"
+        self.__progressBar.show()
         evolImageData.DeepCopy( self.__logic.performEvolution( currentVolumeNode.GetImageData(),
                                                                 initImageData,
                                                                 self.__iterationSpinBox.value,
                                                                 self.__inflationSlider.value,
                                                                 self.__curvatureSlider.value,
                                                                 self.__attractionSlider.value,
-                                                                'geodesic' ) )
+                                                                'geodesic',
+                                                                self.__croppedRoundsCheckBox.checked,
+                                                                self.__cropToInitializationCheckBox.checked,
+                                                                initializationKey if self.__warmStartCheckBox.checked else None,
+                                                                self.__convergenceSpinBox.value if self.__convergenceSpinBox.value > 0 else None,
+                                                                self.onEvolutionProgress ) )
+        self.__progressBar.hide()
 
 
     # create segmentation labelMap
@@ -562,8 +642,11 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
     ijkToRasMatrix = vtk.vtkMatrix4x4()
     currentLabelMapNode.GetIJKToRASMatrix( ijkToRasMatrix )
 
-    # call marching cubes
-    model.DeepCopy( self.__logic.marchingCubes( evolImageData, ijkToRasMatrix, 0.0 ) )
+    # contour the segmentation, large volumes slab by slab to limit the memory usage
+    if evolImageData.GetNumberOfPoints() > self.__logic.STREAMING_CONTOUR_MINIMUM_VOXELS:
+        model.DeepCopy( self.__logic.contourLevelSetInSlabs( evolImageData, ijkToRasMatrix, 0.0 ) )
+    else:
+        model.DeepCopy( self.__logic.contourLevelSet( evolImageData, ijkToRasMatrix, 0.0 ) )
 
     # propagate model to nodes
     currentModelNode.SetAndObservePolyData( model )
@@ -649,6 +732,206 @@ class LevelSetSegmentationWidget(ScriptedLoadableModuleWidget):
         # IdList was created, return it even if it might be empty
         return outputIds
 
+
+class LevelSetSegmentationTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_CroppedRoundsEvolution()
+    self.setUp()
+    self.test_EvolutionProgress()
+    self.setUp()
+    self.test_ArrivalTimeCutoff()
+    self.setUp()
+    self.test_SpeedImage()
+    self.setUp()
+    self.test_SlabStreamingContour()
+
+  def test_CroppedRoundsEvolution(self):
+    self.delayDisplay("Testing CroppedRoundsEvolution")
+    import numpy
+    import time
+
+    logic = SlicerVmtkCommonLib.LevelSetSegmentationLogic()
+    # a long tube with the initialization at one end, so that the segmentation is small compared to the volume
+    image = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createTubeArray(shape=(40, 40, 256)))
+    initialization = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createSphereLevelSetArray((20, 20, 16), 4, shape=(40, 40, 256)))
+    # the feature image is cached, compute it before timing
+    logic.getGradientBasedFeatureImage(image)
+
+    startTime = time.time()
+    fullDomainImage = logic.performEvolution(image, initialization, 60, 100, 70, 50, 'geodesic')
+    fullDomainTime = time.time() - startTime
+    startTime = time.time()
+    croppedRoundsImage = logic.performEvolution(image, initialization, 60, 100, 70, 50, 'geodesic', croppedRounds=True)
+    croppedRoundsTime = time.time() - startTime
+    logging.info("Level set evolution: {0:.2f} s on the full volume, {1:.2f} s in cropped rounds".format(fullDomainTime, croppedRoundsTime))
+
+    fullDomainLabels = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(fullDomainImage) <= 0
+    croppedRoundsLabels = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(croppedRoundsImage) <= 0
+    initializationLabels = self.createSphereLevelSetArray((20, 20, 16), 4, shape=(40, 40, 256)) <= 0
+    # the segmentation grows along the tube
+    self.assertGreater(fullDomainLabels.sum(), 2 * initializationLabels.sum())
+    # the sparse field is rebuilt in each round, label maps may only differ in a few boundary voxels
+    differentVoxels = numpy.logical_xor(fullDomainLabels, croppedRoundsLabels).sum()
+    self.assertLessEqual(differentVoxels, 0.02 * numpy.logical_or(fullDomainLabels, croppedRoundsLabels).sum())
+
+    self.delayDisplay('Testing CroppedRoundsEvolution completed successfully')
+
+  def test_EvolutionProgress(self):
+    self.delayDisplay("Testing EvolutionProgress")
+
+    logic = SlicerVmtkCommonLib.LevelSetSegmentationLogic()
+    image = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createTubeArray())
+    initialization = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createSphereLevelSetArray((20, 20, 32), 4))
+
+    progressCalls = []
+    logic.performEvolution(image, initialization, 30, 100, 70, 50, 'geodesic',
+      progressCallback=lambda completedIterations, numberOfIterations, rmsChange: progressCalls.append((completedIterations, rmsChange)))
+
+    # the filter reports every iteration while it is running, with the RMS change after the first one
+    reportedIterations = set([completedIterations for completedIterations, rmsChange in progressCalls[:-1]])
+    self.assertTrue(reportedIterations.issuperset(range(30)))
+    self.assertLessEqual(max(reportedIterations), 30)
+    self.assertTrue(all([rmsChange is not None for completedIterations, rmsChange in progressCalls if completedIterations > 0]))
+    self.assertEqual(progressCalls[-1][0], 30)
+
+    self.delayDisplay('Testing EvolutionProgress completed successfully')
+
+  def test_ArrivalTimeCutoff(self):
+    self.delayDisplay("Testing ArrivalTimeCutoff")
+    import numpy
+
+    logic = SlicerVmtkCommonLib.LevelSetSegmentationLogic()
+    # early (vessel) and late (background) arrival times, and voxels that the front did not reach
+    vesselArrivalTimes = numpy.linspace(0.0, 20.0, 1000)
+    backgroundArrivalTimes = numpy.linspace(80.0, 120.0, 5000)
+    unreachedArrivalTimes = numpy.ones(500) * 1e38
+    arrivalTimes = numpy.concatenate([vesselArrivalTimes, backgroundArrivalTimes, unreachedArrivalTimes]).astype(numpy.float32)
+
+    cutoff = logic.getArrivalTimeCutoff(arrivalTimes)
+    self.assertGreaterEqual(cutoff, 20.0)
+    self.assertLessEqual(cutoff, 80.0)
+
+    self.delayDisplay('Testing ArrivalTimeCutoff completed successfully')
+
+  def test_SpeedImage(self):
+    self.delayDisplay("Testing SpeedImage")
+    import numpy
+
+    logic = SlicerVmtkCommonLib.LevelSetSegmentationLogic()
+    image = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createTubeArray().astype(numpy.int16))
+    lowerThreshold = 50
+    upperThreshold = 150
+
+    # reference: cast, threshold and shift/scale vtk pipeline
+    cast = vtk.vtkImageCast()
+    cast.SetInputData(image)
+    cast.SetOutputScalarTypeToFloat()
+    cast.Update()
+    scalarRange = cast.GetOutput().GetScalarRange()
+    threshold = vtk.vtkImageThreshold()
+    threshold.SetInputData(cast.GetOutput())
+    threshold.ThresholdBetween(lowerThreshold, upperThreshold)
+    threshold.ReplaceInOff()
+    threshold.ReplaceOutOn()
+    threshold.SetOutValue(scalarRange[0] - scalarRange[1])
+    threshold.Update()
+    scalarRange = threshold.GetOutput().GetScalarRange()
+    shiftScale = vtk.vtkImageShiftScale()
+    shiftScale.SetInputData(threshold.GetOutput())
+    shiftScale.SetShift(-scalarRange[0])
+    shiftScale.SetScale(1.0 / (scalarRange[1] - scalarRange[0]))
+    shiftScale.Update()
+    referenceArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(shiftScale.GetOutput())
+
+    # small slabs to test slab boundaries
+    logic.SPEED_IMAGE_CHUNK_VOXELS = 1000
+    speedArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(logic.buildSpeedImage(image, lowerThreshold, upperThreshold))
+    self.assertLess(numpy.abs(speedArray - referenceArray).max(), 1e-5)
+
+    # in-place computation in the array of a float image
+    floatImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createTubeArray().astype(numpy.int16).astype(numpy.float32))
+    floatArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(floatImage)
+    imageKey = logic.getImageKey(floatImage)
+    logic.buildSpeedImage(floatImage, lowerThreshold, upperThreshold, floatArray)
+    self.assertLess(numpy.abs(floatArray - referenceArray).max(), 1e-5)
+    # the image is overwritten, cached results of the image must not be used any more
+    self.assertNotEqual(logic.getImageKey(floatImage), imageKey)
+
+    # a sparse image gets the same speed values as the dense image, also if all voxels are between the thresholds
+    denseArray = numpy.where(self.createTubeArray() > 20, self.createTubeArray(), 0).astype(numpy.float32)
+    denseImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(denseArray, (0.5, 0.5, 2.0))
+    sparseImage = SlicerVmtkCommonLib.SparseImage.CreateFromArray(denseArray, spacing=(0.5, 0.5, 2.0), blockSize=8)
+    for thresholds in ((lowerThreshold, upperThreshold), (-1, 250), (0, 100)):
+      denseSpeedImage = logic.buildSpeedImage(denseImage, thresholds[0], thresholds[1])
+      sparseSpeedImage = logic.buildSpeedImageFromSparseImage(sparseImage, thresholds[0], thresholds[1])
+      self.assertLess(numpy.abs(SlicerVmtkCommonLib.Helper.GetImageDataAsArray(sparseSpeedImage)
+        - SlicerVmtkCommonLib.Helper.GetImageDataAsArray(denseSpeedImage)).max(), 1e-5)
+      self.assertEqual(sparseSpeedImage.GetSpacing(), denseSpeedImage.GetSpacing())
+
+    self.delayDisplay('Testing SpeedImage completed successfully')
+
+  def test_SlabStreamingContour(self):
+    self.delayDisplay("Testing SlabStreamingContour")
+
+    logic = SlicerVmtkCommonLib.LevelSetSegmentationLogic()
+    # radius is not an integer, so that no voxel is exactly on the surface
+    levelSetImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(self.createSphereLevelSetArray((20, 20, 32), 10.3))
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+
+    surface = logic.contourLevelSet(levelSetImage, ijkToRasMatrix, 0.0)
+    # small slabs, so that the sphere is split by several seams
+    streamedSurface = logic.contourLevelSetInSlabs(levelSetImage, ijkToRasMatrix, 0.0, slabSizeVoxel=4)
+
+    # seam points are merged: same mesh size as without slabs
+    self.assertGreater(surface.GetNumberOfPoints(), 0)
+    self.assertEqual(streamedSurface.GetNumberOfPoints(), surface.GetNumberOfPoints())
+    self.assertEqual(streamedSurface.GetNumberOfCells(), surface.GetNumberOfCells())
+
+    # closed manifold surface: no boundary edges (unmerged seams) and no non-manifold edges
+    featureEdges = vtk.vtkFeatureEdges()
+    featureEdges.SetInputData(streamedSurface)
+    featureEdges.BoundaryEdgesOn()
+    featureEdges.NonManifoldEdgesOn()
+    featureEdges.FeatureEdgesOff()
+    featureEdges.ManifoldEdgesOff()
+    featureEdges.Update()
+    self.assertEqual(featureEdges.GetOutput().GetNumberOfCells(), 0)
+
+    self.delayDisplay('Testing SlabStreamingContour completed successfully')
+
+  def createTubeArray(self, shape=(40, 40, 64), radius=6.0):
+    '''
+    Synthetic image (indexed [k, j, i]) with a bright tube with smooth boundary along the I axis.
+    '''
+    import numpy
+    k, j, i = numpy.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    distance = numpy.sqrt((k - shape[0] / 2.0) ** 2 + (j - shape[1] / 2.0) ** 2)
+    return (200.0 / (1.0 + numpy.exp(distance - radius))).astype(numpy.float32)
+
+  def createSphereLevelSetArray(self, center, radius, shape=(40, 40, 64)):
+    '''
+    Signed distance from a sphere (center is [k, j, i]), negative inside.
+    '''
+    import numpy
+    k, j, i = numpy.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    distance = numpy.sqrt((k - center[0]) ** 2 + (j - center[1]) ** 2 + (i - center[2]) ** 2)
+    return (distance - radius).astype(numpy.float32)
+
+
 class Slicelet( object ):
   """A slicer slicelet is a module widget that comes up in stand alone mode
   implemented as a python class.
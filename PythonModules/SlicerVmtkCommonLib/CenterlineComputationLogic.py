@@ -2,6 +2,8 @@
 from __main__ import vtk
 import logging
 
+from Helper import Helper
+
 class CenterlineComputationLogic( object ):
     '''
     classdocs
@@ -281,3 +283,28 @@ class CenterlineComputationLogic( object ):
         return [outPolyData, outPolyData2]
 
 
+    def addVesselnessRadius( self, centerlines, volumeNode ):
+        '''
+        Adds a 'VesselnessRadius' point data array to centerlines (in RAS coordinates) with half of the vessel diameter
+        from the vesselness scale map of volumeNode (see Helper.GetVesselnessScaleAtRAS), 0 where the map has no vessel.
+        Returns the median ratio of the centerline 'Radius' (maximum inscribed sphere radius) to the vesselness radius,
+        None if no point has both.
+        '''
+        vesselnessRadiusArray = vtk.vtkDoubleArray()
+        vesselnessRadiusArray.SetName( 'VesselnessRadius' )
+        vesselnessRadiusArray.SetNumberOfValues( centerlines.GetNumberOfPoints() )
+        radiusArray = centerlines.GetPointData().GetArray( 'Radius' )
+
+        radiusRatios = []
+        for pointId in range( centerlines.GetNumberOfPoints() ):
+            diameterMm = Helper.GetVesselnessScaleAtRAS( volumeNode, centerlines.GetPoint( pointId ) )
+            vesselnessRadius = diameterMm / 2.0 if diameterMm else 0.0
+            vesselnessRadiusArray.SetValue( pointId, vesselnessRadius )
+            if radiusArray and vesselnessRadius > 0:
+                radiusRatios.append( radiusArray.GetValue( pointId ) / vesselnessRadius )
+        centerlines.GetPointData().AddArray( vesselnessRadiusArray )
+
+        if not radiusRatios:
+            return None
+        radiusRatios.sort()
+        return radiusRatios[len( radiusRatios ) // 2]
@@ -7,6 +7,76 @@ import time
 
 class Helper(object):
 
+    # Volume node attribute that stores the stored value / response ratio of a quantized vesselness volume
+    VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE = 'Vesselness.QuantizationScale'
+
+    @staticmethod
+    def GetVesselnessQuantizationScale(volumeNode):
+        '''
+        Returns the scale that maps vesselness response to the values stored in volumeNode.
+        It is 1.0 if the volume is not a quantized vesselness volume.
+        Volumes loaded from NRRD files get the scale from the header key/value pair written by the batch processing,
+        the node is not modified.
+        '''
+        if not volumeNode:
+            return 1.0
+        scale = volumeNode.GetAttribute(Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE)
+        if not scale:
+            scale = Helper.ReadVesselnessQuantizationScale(volumeNode)
+        if not scale:
+            return 1.0
+        return float(scale)
+
+    @staticmethod
+    def ReadVesselnessQuantizationScale(volumeNode):
+        '''
+        Returns the quantization scale (string) from the NRRD file of volumeNode, None if it is not stored there.
+        '''
+        import os
+        from MemoryMappedVolume import readNrrdHeader
+        storageNode = volumeNode.GetStorageNode()
+        fileName = storageNode.GetFileName() if storageNode else None
+        if not fileName or not os.path.exists(fileName) or os.path.splitext(fileName)[1].lower() not in ('.nrrd', '.nhdr'):
+            return None
+        try:
+            return readNrrdHeader(fileName)['keyValuePairs'].get(Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE)
+        except (IOError, ValueError):
+            return None
+
+    # Node reference role from the input and the vesselness volume to the volume that stores the scale
+    # (vessel diameter in mm) of the maximum vesselness response
+    VESSELNESS_SCALES_REFERENCE_ROLE = 'VesselnessScales'
+
+    @staticmethod
+    def GetVesselnessScalesVolumeNode(volumeNode):
+        '''
+        Returns the scale map of volumeNode (an input or a vesselness volume), None if it has not been computed.
+        '''
+        if not volumeNode:
+            return None
+        return volumeNode.GetNodeReference(Helper.VESSELNESS_SCALES_REFERENCE_ROLE)
+
+    @staticmethod
+    def GetVesselnessScaleAtRAS(volumeNode, rasCoordinates):
+        '''
+        Returns the vessel diameter in mm (the scale of the maximum vesselness response) at rasCoordinates
+        from the scale map of volumeNode. Returns None if there is no scale map, the position is outside of it
+        or there is no vessel at the position.
+        '''
+        scalesVolumeNode = Helper.GetVesselnessScalesVolumeNode(volumeNode)
+        if not scalesVolumeNode or not scalesVolumeNode.GetImageData():
+            return None
+        ijk = Helper.ConvertRAStoIJK(scalesVolumeNode, list(rasCoordinates))
+        ijk = [int(round(ijk[axis])) for axis in range(3)]
+        extent = scalesVolumeNode.GetImageData().GetExtent()
+        for axis in range(3):
+            if ijk[axis] < extent[axis*2] or ijk[axis] > extent[axis*2+1]:
+                return None
+        scale = scalesVolumeNode.GetImageData().GetScalarComponentAsDouble(ijk[0], ijk[1], ijk[2], 0)
+        if scale <= 0:
+            return None
+        return scale
+
     @staticmethod
     def ConvertRAStoIJK(volumeNode,rasCoordinates):
         '''
@@ -21,3 +91,30 @@ class Helper(object):
         ijkCoordinates = rasToIjkMatrix.MultiplyPoint(rasCoordinates)
 
         return ijkCoordinates
+
+    @staticmethod
+    def GetImageDataAsArray(imageData):
+        '''
+        Returns the scalars of imageData as a numpy array indexed [k, j, i].
+        The array shares memory with the image, no copy is made.
+        '''
+        from vtk.util import numpy_support
+        dimensions = imageData.GetDimensions()
+        scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+        return scalars.reshape(dimensions[2], dimensions[1], dimensions[0])
+
+    @staticmethod
+    def CreateImageDataFromArray(array, spacing=(1,1,1), extentStart=(0,0,0)):
+        '''
+        Returns a vtkImageData that wraps a contiguous numpy array indexed [k, j, i].
+        The image keeps a reference to the array, no copy is made.
+        '''
+        from vtk.util import numpy_support
+        imageData = vtk.vtkImageData()
+        imageData.SetExtent(extentStart[0], extentStart[0]+array.shape[2]-1,
+                            extentStart[1], extentStart[1]+array.shape[1]-1,
+                            extentStart[2], extentStart[2]+array.shape[0]-1)
+        imageData.SetSpacing(spacing)
+        scalars = numpy_support.numpy_to_vtk(array.ravel(), deep=False)
+        imageData.GetPointData().SetScalars(scalars)
+        return imageData
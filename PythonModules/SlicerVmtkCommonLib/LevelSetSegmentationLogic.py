@@ -1,6 +1,12 @@
 # vtk includes
 from __main__ import vtk
+import collections
 import logging
+import numpy
+import time
+
+from Helper import Helper
+from SparseImage import SparseImage
 
 
 class LevelSetSegmentationLogic( object ):
@@ -8,106 +14,92 @@ class LevelSetSegmentationLogic( object ):
     classdocs
     '''
 
+    # Evolution in cropped rounds runs this many iterations on the bounding box of the segmentation before the box is updated
+    CROPPED_ROUND_ITERATIONS = 20
+    # Extra voxels around a cropped region that the front can reach (sparse field layers and derivative stencils)
+    EVOLUTION_CROP_MARGIN_VOXEL = 4
 
-    def __init__( self ):
-        '''
-        Constructor
-        '''
-
-
-    def performInitialization( self, image, lowerThreshold, upperThreshold, sourceSeedIds, targetSeedIds, method="collidingfronts" ):
-        '''
-        '''
-        # import the vmtk libraries
-        try:
-            import vtkvmtkSegmentationPython as vtkvmtkSegmentation
-        except ImportError:
-            logging.error("Unable to import the SlicerVmtk libraries")
+    # Feature images are cached, so that evolutions with different weights or iterations skip their computation
+    FEATURE_IMAGE_CACHE_MAXIMUM_ENTRIES = 4
+    FEATURE_IMAGE_CACHE_MAXIMUM_MB = 1024
 
-        cast = vtk.vtkImageCast()
-        cast.SetInputData( image )
-        cast.SetOutputScalarTypeToFloat()
-        cast.Update()
-        image = cast.GetOutput()
+    # Fast marching arrival times are cached per speed image and seeds, so that other targets or cut-offs only threshold them
+    ARRIVAL_TIME_CACHE_MAXIMUM_ENTRIES = 4
+    ARRIVAL_TIME_CACHE_MAXIMUM_MB = 1024
+    # Arrival times above this value are voxels that the front did not reach
+    ARRIVAL_TIME_UNREACHED = 1E30
 
-        scalarRange = image.GetScalarRange()
+    # With more than two seeds, colliding fronts runs between consecutive seeds on the bounding box of the two seeds,
+    # extended by this many voxels and this fraction of the box size (vessels are not straight between seeds)
+    COLLIDING_FRONTS_MARGIN_VOXEL = 10
+    COLLIDING_FRONTS_MARGIN_FRACTION = 0.5
 
-        imageDimensions = image.GetDimensions()
-        maxImageDimensions = max( imageDimensions )
+    # The speed image is computed in slabs of about this many voxels, to limit temporary arrays
+    SPEED_IMAGE_CHUNK_VOXELS = 4 * 1024 * 1024
 
-        threshold = vtk.vtkImageThreshold()
-        threshold.SetInputData( image )
-        threshold.ThresholdBetween( lowerThreshold, upperThreshold )
-        threshold.ReplaceInOff()
-        threshold.ReplaceOutOn()
-        threshold.SetOutValue( scalarRange[0] - scalarRange[1] )
-        threshold.Update()
+    # Slab-streaming contouring processes this many slices at a time
+    CONTOUR_SLAB_SIZE_VOXEL = 32
+    # The widget uses slab-streaming contouring when the level set has more than this many voxels
+    STREAMING_CONTOUR_MINIMUM_VOXELS = 128 * 1024 * 1024
 
-        thresholdedImage = threshold.GetOutput()
 
-        scalarRange = thresholdedImage.GetScalarRange()
+    def __init__( self ):
+        '''
+        Constructor
+        '''
+        self.featureImageCache = collections.OrderedDict()
+        self.arrivalTimeCache = collections.OrderedDict()
+        # (cacheKey, image) of the last initialization
+        self.lastInitialization = None
+        # last evolved level set with the inputs and parameters that produced it, for warm start
+        self.lastEvolution = None
 
-        shiftScale = vtk.vtkImageShiftScale()
-        shiftScale.SetInputData( thresholdedImage )
-        shiftScale.SetShift( -scalarRange[0] )
-        shiftScale.SetScale( 1.0 / ( scalarRange[1] - scalarRange[0] ) )
-        shiftScale.Update()
 
-        speedImage = shiftScale.GetOutput()
+    def performInitialization( self, image, lowerThreshold, upperThreshold, sourceSeedIds, targetSeedIds, method="collidingfronts", cacheKey=None, arrivalTimeCutoff=None, numberOfWorkers=1, speedArray=None ):
+        '''
+        image is a vtkImageData or a SparseImage (for example a sparse vesselness volume).
+        If cacheKey is set (any value that identifies the image, thresholds, seeds and method) and it is the same as
+        in the previous call then the previous initialization is returned without computation.
+        For fastmarching without targets (or if no target is reached) the initialization is the region with arrival time
+        below arrivalTimeCutoff, by default the cut-off is computed from the arrival time histogram (see getArrivalTimeCutoff).
+        For collidingfronts with more than two seeds see performMultiSegmentCollidingFronts.
+        speedArray is an optional buffer for the speed image (see buildSpeedImage).
+        '''
+        if cacheKey is not None and self.lastInitialization and self.lastInitialization[0] == cacheKey:
+            logging.debug( "Using the previous initialization" )
+            outImageData = vtk.vtkImageData()
+            outImageData.DeepCopy( self.lastInitialization[1] )
+            return outImageData
 
         if method == "collidingfronts":
+            speedImage = self.buildSpeedImageFromInput( image, lowerThreshold, upperThreshold, speedArray )
             # ignore sidebranches, use colliding fronts
             logging.debug("Using Colliding fronts algorithm")
             logging.debug("number of vtk ids: " + str(sourceSeedIds.GetNumberOfIds()))
             logging.debug("SourceSeedIds:")
             logging.debug(sourceSeedIds)
-            collidingFronts = vtkvmtkSegmentation.vtkvmtkCollidingFrontsImageFilter()
-            collidingFronts.SetInputData( speedImage )
-            sourceSeedId1 = vtk.vtkIdList()
-            sourceSeedId1.InsertNextId( sourceSeedIds.GetId(0) )
-            sourceSeedId2 = vtk.vtkIdList()
-            sourceSeedId2.InsertNextId( sourceSeedIds.GetId(1) )
-            collidingFronts.SetSeeds1( sourceSeedId1 )
-            collidingFronts.SetSeeds2( sourceSeedId2 )
-            collidingFronts.ApplyConnectivityOn()
-            collidingFronts.StopOnTargetsOn()
-            collidingFronts.Update()
-
-            subtract = vtk.vtkImageMathematics()
-            subtract.SetInputData( collidingFronts.GetOutput() )
-            subtract.SetOperationToAddConstant()
-            subtract.SetConstantC( -10 * collidingFronts.GetNegativeEpsilon() )
-            subtract.Update()
-
-        elif method == "fastmarching":
-            fastMarching = vtkvmtkSegmentation.vtkvmtkFastMarchingUpwindGradientImageFilter()
-            fastMarching.SetInputData( speedImage )
-            fastMarching.SetSeeds( sourceSeedIds )
-            fastMarching.GenerateGradientImageOn()
-            fastMarching.SetTargetOffset( 0.0 )
-            fastMarching.SetTargets( targetSeedIds )
-            if targetSeedIds.GetNumberOfIds() > 0:
-                fastMarching.SetTargetReachedModeToOneTarget()
+            if sourceSeedIds.GetNumberOfIds() > 2:
+                initializationImage = self.performMultiSegmentCollidingFronts( speedImage, sourceSeedIds, numberOfWorkers )
             else:
-                fastMarching.SetTargetReachedModeToNoTargets()
-            fastMarching.Update()
+                initializationImage = self.performCollidingFronts( speedImage, sourceSeedIds.GetId(0), sourceSeedIds.GetId(1) )
 
+        elif method == "fastmarching":
+            arrivalTimes = self.getArrivalTimes( image, lowerThreshold, upperThreshold, sourceSeedIds, speedArray )
             if targetSeedIds.GetNumberOfIds() > 0:
-                subtract = vtk.vtkImageMathematics()
-                subtract.SetInputData( fastMarching.GetOutput() )
-                subtract.SetOperationToAddConstant()
-                subtract.SetConstantC( -fastMarching.GetTargetValue() )
-                subtract.Update()
+                # the front stops at the first target that it reaches
+                targetArrivalTimes = [float( arrivalTimes.flat[targetSeedIds.GetId( index )] ) for index in range( targetSeedIds.GetNumberOfIds() )]
+                if min( targetArrivalTimes ) < self.ARRIVAL_TIME_UNREACHED:
+                    arrivalTimeCutoff = min( targetArrivalTimes )
+                else:
+                    logging.warning( "None of the targets is reached by the front, the arrival time cut-off is used instead" )
+            if arrivalTimeCutoff is None:
+                arrivalTimeCutoff = self.getArrivalTimeCutoff( arrivalTimes )
+            logging.debug( "Arrival time cut-off: " + str( arrivalTimeCutoff ) )
+            # negative inside, as the colliding fronts initialization, with the geometry of the speed image
+            initializationImage = Helper.CreateImageDataFromArray( arrivalTimes - numpy.float32( arrivalTimeCutoff ), image.GetSpacing(), image.GetExtent()[0::2] )
+            if not isinstance( image, SparseImage ):
+                initializationImage.SetOrigin( image.GetOrigin() )
 
-            else:
-                subtract = vtk.vtkImageThreshold()
-                subtract.SetInputData( fastMarching.GetOutput() )
-                subtract.ThresholdByLower( 2000 )  # TODO find robuste value
-                subtract.ReplaceInOff()
-                subtract.ReplaceOutOn()
-                subtract.SetOutValue( -1 )
-                subtract.Update()
-        
         elif method == "threshold":
             raise NotImplementedError()
         elif method == "isosurface":
@@ -118,35 +110,489 @@ class LevelSetSegmentationLogic( object ):
             raise NameError('Unsupported InitializationType')
 
         outImageData = vtk.vtkImageData()
-        outImageData.DeepCopy( subtract.GetOutput() )
-
-        return outImageData
+        outImageData.DeepCopy( initializationImage )
 
+        if cacheKey is not None:
+            self.lastInitialization = ( cacheKey, outImageData )
+            outImageData = vtk.vtkImageData()
+            outImageData.DeepCopy( self.lastInitialization[1] )
 
+        return outImageData
 
-    def performEvolution( self, originalImage, segmentationImage, numberOfIterations, inflation, curvature, attraction, levelSetsType='geodesic' ):
+    def performCollidingFronts( self, speedImage, sourceSeedId1, sourceSeedId2 ):
         '''
+        Returns the colliding fronts initialization (negative inside) between two seeds (point ids of speedImage).
+        '''
+        # import the vmtk libraries
+        try:
+            import vtkvmtkSegmentationPython as vtkvmtkSegmentation
+        except ImportError:
+            logging.error("Unable to import the SlicerVmtk libraries")
 
+        collidingFronts = vtkvmtkSegmentation.vtkvmtkCollidingFrontsImageFilter()
+        collidingFronts.SetInputData( speedImage )
+        sourceSeedId1List = vtk.vtkIdList()
+        sourceSeedId1List.InsertNextId( sourceSeedId1 )
+        sourceSeedId2List = vtk.vtkIdList()
+        sourceSeedId2List.InsertNextId( sourceSeedId2 )
+        collidingFronts.SetSeeds1( sourceSeedId1List )
+        collidingFronts.SetSeeds2( sourceSeedId2List )
+        collidingFronts.ApplyConnectivityOn()
+        collidingFronts.StopOnTargetsOn()
+        collidingFronts.Update()
+
+        subtract = vtk.vtkImageMathematics()
+        subtract.SetInputData( collidingFronts.GetOutput() )
+        subtract.SetOperationToAddConstant()
+        subtract.SetConstantC( -10 * collidingFronts.GetNegativeEpsilon() )
+        subtract.Update()
+        return subtract.GetOutput()
+
+    def performMultiSegmentCollidingFronts( self, speedImage, sourceSeedIds, numberOfWorkers=1 ):
+        '''
+        Runs colliding fronts between each pair of consecutive seeds, on a pool of numberOfWorkers threads. Each pair only
+        processes the bounding box of its seeds, extended by COLLIDING_FRONTS_MARGIN_VOXEL and COLLIDING_FRONTS_MARGIN_FRACTION.
+        Returns the union of the initializations (minimum of the level sets).
+        '''
+        speedArray = Helper.GetImageDataAsArray( speedImage )
+        spacing = speedImage.GetSpacing()
+        seedIndices = [numpy.unravel_index( sourceSeedIds.GetId( index ), speedArray.shape ) for index in range( sourceSeedIds.GetNumberOfIds() )]
+        segments = list( zip( seedIndices[:-1], seedIndices[1:] ) )
+        segmentLevelSets = [None] * len( segments )
+
+        def processSegment( segmentIndex ):
+            seedIndex1, seedIndex2 = segments[segmentIndex]
+            regionSlices = []
+            for axis in range( 3 ):
+                low = min( seedIndex1[axis], seedIndex2[axis] )
+                high = max( seedIndex1[axis], seedIndex2[axis] )
+                margin = self.COLLIDING_FRONTS_MARGIN_VOXEL + int( self.COLLIDING_FRONTS_MARGIN_FRACTION * ( high - low ) )
+                regionSlices.append( slice( max( low - margin, 0 ), min( high + margin + 1, speedArray.shape[axis] ) ) )
+            regionSlices = tuple( regionSlices )
+            regionSpeedArray = numpy.ascontiguousarray( speedArray[regionSlices] )
+            regionSeedIds = [int( numpy.ravel_multi_index( tuple( seedIndex[axis] - regionSlices[axis].start for axis in range( 3 ) ), regionSpeedArray.shape ) )
+                             for seedIndex in ( seedIndex1, seedIndex2 )]
+            regionLevelSet = self.performCollidingFronts( Helper.CreateImageDataFromArray( regionSpeedArray, spacing ), regionSeedIds[0], regionSeedIds[1] )
+            segmentLevelSets[segmentIndex] = ( regionSlices, numpy.array( Helper.GetImageDataAsArray( regionLevelSet ), dtype=numpy.float32 ) )
+
+        segmentIndices = list( range( len( segments ) ) )
+        if numberOfWorkers > 1 and len( segments ) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool( numberOfWorkers )
+            try:
+                pool.map( processSegment, segmentIndices )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for segmentIndex in segmentIndices:
+                processSegment( segmentIndex )
+
+        # outside of all regions the level set is positive, as outside of the initialization in the regions
+        outsideValue = max( [float( regionLevelSet.max() ) for regionSlices, regionLevelSet in segmentLevelSets] )
+        levelSetArray = numpy.empty( speedArray.shape, dtype=numpy.float32 )
+        levelSetArray.fill( outsideValue )
+        for regionSlices, regionLevelSet in segmentLevelSets:
+            levelSetArray[regionSlices] = numpy.minimum( levelSetArray[regionSlices], regionLevelSet )
+        initializationImage = Helper.CreateImageDataFromArray( levelSetArray, spacing, speedImage.GetExtent()[0::2] )
+        initializationImage.SetOrigin( speedImage.GetOrigin() )
+        return initializationImage
+
+    def getImageKey( self, image ):
+        '''
+        Returns a value that identifies the voxels of image (vtkImageData or SparseImage) as long as they are not modified.
+        Shallow copies of an image have the same key.
+        '''
+        if isinstance( image, SparseImage ):
+            return ( id( image ), image.GetNumberOfBlocks(), tuple( image.GetExtent() ) )
+        scalars = image.GetPointData().GetScalars()
+        if not scalars:
+            return ( image.GetAddressAsString( 'vtkImageData' ), image.GetMTime() )
+        return ( scalars.GetAddressAsString( 'vtkDataArray' ), scalars.GetMTime(), tuple( image.GetExtent() ) )
+
+    def getArrivalTimes( self, image, lowerThreshold, upperThreshold, sourceSeedIds, speedArray=None ):
+        '''
+        Returns the fast marching arrival times from the seeds on the speed image of image (numpy array indexed [k, j, i]),
+        from the cache if available. The front is propagated to the whole image, so that the result can be used with any
+        targets. The returned array may be shared with later calls, it must not be modified.
         '''
+        # the key is computed before the speed image, which may overwrite the image (and then modifies its scalars)
+        key = ( self.getImageKey( image ), lowerThreshold, upperThreshold,
+                tuple( sourceSeedIds.GetId( index ) for index in range( sourceSeedIds.GetNumberOfIds() ) ) )
+        if key in self.arrivalTimeCache:
+            logging.debug( "Using cached arrival times" )
+            # move to the end, as most recently used
+            arrivalTimes = self.arrivalTimeCache.pop( key )
+            self.arrivalTimeCache[key] = arrivalTimes
+            return arrivalTimes
+
         # import the vmtk libraries
         try:
             import vtkvmtkSegmentationPython as vtkvmtkSegmentation
         except ImportError:
             logging.error("Unable to import the SlicerVmtk libraries")
 
-        featureDerivativeSigma = 0.0
-        maximumRMSError = 1E-20
-        isoSurfaceValue = 0.0
+        fastMarching = vtkvmtkSegmentation.vtkvmtkFastMarchingUpwindGradientImageFilter()
+        fastMarching.SetInputData( self.buildSpeedImageFromInput( image, lowerThreshold, upperThreshold, speedArray ) )
+        fastMarching.SetSeeds( sourceSeedIds )
+        fastMarching.GenerateGradientImageOff()
+        fastMarching.SetTargetOffset( 0.0 )
+        fastMarching.SetTargetReachedModeToNoTargets()
+        fastMarching.Update()
+        arrivalTimes = numpy.array( Helper.GetImageDataAsArray( fastMarching.GetOutput() ), dtype=numpy.float32 )
+
+        arrivalTimesSizeMb = arrivalTimes.nbytes / 1024.0 / 1024.0
+        if arrivalTimesSizeMb > self.ARRIVAL_TIME_CACHE_MAXIMUM_MB:
+            logging.debug( "Arrival times are not cached, they would take {0:.0f}MB".format( arrivalTimesSizeMb ) )
+            return arrivalTimes
+        self.arrivalTimeCache[key] = arrivalTimes
+        while ( len( self.arrivalTimeCache ) > self.ARRIVAL_TIME_CACHE_MAXIMUM_ENTRIES
+                or self.getArrivalTimeCacheSizeMb() > self.ARRIVAL_TIME_CACHE_MAXIMUM_MB ):
+            # remove least recently used
+            self.arrivalTimeCache.popitem( last=False )
+        return arrivalTimes
+
+    def getArrivalTimeCacheSizeMb( self ):
+        return sum( [arrivalTimes.nbytes for arrivalTimes in self.arrivalTimeCache.values()] ) / 1024.0 / 1024.0
+
+    def clearArrivalTimeCache( self ):
+        self.arrivalTimeCache.clear()
+
+    def getArrivalTimeCutoff( self, arrivalTimes, numberOfBins=256 ):
+        '''
+        Returns the arrival time that separates the early (vessel) and late (background) arrival times of the reached
+        voxels, with Otsu's method on their histogram.
+        '''
+        reachedArrivalTimes = arrivalTimes[arrivalTimes < self.ARRIVAL_TIME_UNREACHED]
+        if not reachedArrivalTimes.size:
+            return 0.0
+        counts, binEdges = numpy.histogram( reachedArrivalTimes, bins=numberOfBins )
+        binCenters = ( binEdges[:-1] + binEdges[1:] ) / 2.0
+        counts = counts.astype( numpy.float64 )
+        # number of voxels and mean arrival time below and above each possible cut-off
+        countsBelow = numpy.cumsum( counts )
+        countsAbove = countsBelow[-1] - countsBelow
+        sumsBelow = numpy.cumsum( counts * binCenters )
+        sumsAbove = sumsBelow[-1] - sumsBelow
+        valid = ( countsBelow > 0 ) & ( countsAbove > 0 )
+        if not valid.any():
+            return float( binEdges[-1] )
+        meansBelow = sumsBelow[valid] / countsBelow[valid]
+        meansAbove = sumsAbove[valid] / countsAbove[valid]
+        betweenClassVariance = countsBelow[valid] * countsAbove[valid] * ( meansBelow - meansAbove ) ** 2
+        return float( binEdges[1:][valid][numpy.argmax( betweenClassVariance )] )
+
+    def buildSpeedImageFromInput( self, image, lowerThreshold, upperThreshold, speedArray=None ):
+        '''
+        Returns the speed image of image, a vtkImageData or a SparseImage.
+        speedArray is only used for vtkImageData (see buildSpeedImage).
+        '''
+        if isinstance( image, SparseImage ):
+            return self.buildSpeedImageFromSparseImage( image, lowerThreshold, upperThreshold )
+        return self.buildSpeedImage( image, lowerThreshold, upperThreshold, speedArray )
+
+    def buildSpeedImage( self, image, lowerThreshold, upperThreshold, speedArray=None ):
+        '''
+        Speed image for the initialization: voxels between lowerThreshold and upperThreshold keep their
+        value rescaled to 0..1, the others get speed 0.
+        The image is read twice in slabs (for the value ranges, then for the speed values), only the speed image is
+        allocated. If speedArray (float32 numpy array indexed [k, j, i] with the dimensions of image) is set then the speed
+        values are written into it and no memory is allocated. It may be the array of image itself (in-place), then
+        the scalars of image are marked as modified, so that cache keys of image (see getImageKey) change.
+        '''
+        inputArray = Helper.GetImageDataAsArray( image )
+        if speedArray is None:
+            speedArray = numpy.empty( inputArray.shape, dtype=numpy.float32 )
+        elif speedArray.shape != inputArray.shape or speedArray.dtype != numpy.float32:
+            raise ValueError( "The speed array must be a float32 array with the dimensions of the image" )
+
+        slabSize = max( 1, self.SPEED_IMAGE_CHUNK_VOXELS // ( inputArray.shape[1] * inputArray.shape[2] ) )
+        slabs = [slice( k, min( k + slabSize, inputArray.shape[0] ) ) for k in range( 0, inputArray.shape[0], slabSize )]
+
+        # range of the image and of the values between the thresholds
+        minimum = maximum = None
+        inRangeMinimum = inRangeMaximum = None
+        outOfRange = False
+        for slab in slabs:
+            values = inputArray[slab]
+            minimum = min( minimum, float( values.min() ) ) if minimum is not None else float( values.min() )
+            maximum = max( maximum, float( values.max() ) ) if maximum is not None else float( values.max() )
+            inRangeValues = values[( values >= lowerThreshold ) & ( values <= upperThreshold )]
+            if inRangeValues.size:
+                inRangeMinimum = min( inRangeMinimum, float( inRangeValues.min() ) ) if inRangeMinimum is not None else float( inRangeValues.min() )
+                inRangeMaximum = max( inRangeMaximum, float( inRangeValues.max() ) ) if inRangeMaximum is not None else float( inRangeValues.max() )
+            outOfRange = outOfRange or inRangeValues.size < values.size
+
+        # values outside the thresholds are replaced by outValue, then the range is rescaled to 0..1
+        outValue = minimum - maximum
+        thresholdedValues = ( [outValue] if outOfRange else [] ) + ( [inRangeMinimum, inRangeMaximum] if inRangeMinimum is not None else [] )
+        thresholdedMinimum = min( thresholdedValues )
+        thresholdedMaximum = max( thresholdedValues )
+        scale = 1.0 / ( thresholdedMaximum - thresholdedMinimum ) if thresholdedMaximum > thresholdedMinimum else 0.0
+        outSpeed = ( outValue - thresholdedMinimum ) * scale
+
+        for slab in slabs:
+            values = inputArray[slab]
+            # computed before writing the speed values, as values and speedArray may be the same memory
+            inRange = ( values >= lowerThreshold ) & ( values <= upperThreshold )
+            speedSlab = speedArray[slab]
+            numpy.subtract( values, thresholdedMinimum, out=speedSlab, casting='unsafe' )
+            speedSlab *= scale
+            speedSlab[~inRange] = outSpeed
+        if numpy.may_share_memory( speedArray, inputArray ):
+            image.GetPointData().GetScalars().Modified()
+
+        speedImage = Helper.CreateImageDataFromArray( speedArray, image.GetSpacing(), image.GetExtent()[0::2] )
+        speedImage.SetOrigin( image.GetOrigin() )
+        return speedImage
+
+    def buildSpeedImageFromSparseImage( self, image, lowerThreshold, upperThreshold ):
+        '''
+        Same as buildSpeedImage, for a SparseImage. Only the stored blocks are thresholded,
+        all other voxels (implicit zeros) get the same speed value. The value ranges include the implicit zeros, so
+        that the speed values are the same as for the dense image. The speed image has the spacing of image
+        (SparseImage has no origin, the origin is 0 as for the image data of volume nodes).
+        '''
+        scalarRange = image.GetScalarRange()
+        outValue = scalarRange[0] - scalarRange[1]
+
+        # range of the values between the thresholds, as in buildSpeedImage
+        inRangeMinimum = inRangeMaximum = None
+        outOfRange = False
+        blocks = image.GetBlocks()
+        for blockExtent, block in blocks:
+            inRangeValues = block[( block >= lowerThreshold ) & ( block <= upperThreshold )]
+            if inRangeValues.size:
+                inRangeMinimum = min( inRangeMinimum, float( inRangeValues.min() ) ) if inRangeMinimum is not None else float( inRangeValues.min() )
+                inRangeMaximum = max( inRangeMaximum, float( inRangeValues.max() ) ) if inRangeMaximum is not None else float( inRangeValues.max() )
+            outOfRange = outOfRange or inRangeValues.size < block.size
+        if image.GetFillFraction() < 1.0:
+            if lowerThreshold <= 0 and upperThreshold >= 0:
+                inRangeMinimum = min( inRangeMinimum, 0.0 ) if inRangeMinimum is not None else 0.0
+                inRangeMaximum = max( inRangeMaximum, 0.0 ) if inRangeMaximum is not None else 0.0
+            else:
+                outOfRange = True
+
+        thresholdedValues = ( [outValue] if outOfRange else [] ) + ( [inRangeMinimum, inRangeMaximum] if inRangeMinimum is not None else [] )
+        thresholdedMinimum = min( thresholdedValues )
+        thresholdedMaximum = max( thresholdedValues )
+        scale = 1.0 / ( thresholdedMaximum - thresholdedMinimum ) if thresholdedMaximum > thresholdedMinimum else 0.0
+        outSpeed = ( outValue - thresholdedMinimum ) * scale
+
+        def speed( values ):
+            inRange = ( values >= lowerThreshold ) & ( values <= upperThreshold )
+            return numpy.where( inRange, ( values - thresholdedMinimum ) * scale, outSpeed ).astype( numpy.float32 )
 
+        speedArray = numpy.empty( [image.GetDimensions()[axis] for axis in ( 2, 1, 0 )], dtype=numpy.float32 )
+        speedArray.fill( speed( numpy.zeros( 1, dtype=numpy.float32 ) )[0] )
+        extent = image.GetExtent()
+        for blockExtent, block in blocks:
+            speedArray[blockExtent[4] - extent[4]:blockExtent[5] - extent[4] + 1,
+                       blockExtent[2] - extent[2]:blockExtent[3] - extent[2] + 1,
+                       blockExtent[0] - extent[0]:blockExtent[1] - extent[0] + 1] = speed( block )
+        return Helper.CreateImageDataFromArray( speedArray, image.GetSpacing(), extent[0::2] )
+
+
+
+    def performEvolution( self, originalImage, segmentationImage, numberOfIterations, inflation, curvature, attraction, levelSetsType='geodesic', croppedRounds=False, cropToInitialization=False, warmStartKey=None,
+                          maximumRMSError=None, progressCallback=None ):
+        '''
+        Evolves segmentationImage (negative inside) with features of originalImage.
+        If croppedRounds is True then the evolution runs in rounds on the bounding box of the current segmentation
+        (see performEvolutionInRounds).
+        If cropToInitialization is True then the evolution runs only on the bounding box of the initialization, extended by
+        the distance the front can travel in numberOfIterations iterations, with the same region of the (cached) feature
+        image of the full originalImage. The result is pasted back into an image of the size of segmentationImage.
+        Both can be combined: the rounds then run inside the region of the initialization. Unlike cropToInitialization,
+        croppedRounds also limits the region when many iterations are run, but its result is not exactly the same as a
+        single evolution.
+        If warmStartKey is set (any value that identifies the initialization inputs: image, thresholds, seeds) and it is the
+        same as in the previous call then the evolution continues from the previous result (see getWarmStartIterations).
+        The returned image is kept for warm start, it must not be modified.
+        If maximumRMSError is set then the evolution stops when the RMS change of the level set in an iteration is below it.
+        progressCallback is called in each iteration with the number of completed iterations, numberOfIterations and
+        the RMS change of the last iteration (None before the first iteration, see runLevelSetFilter).
+        '''
         logging.debug("NumberOfIterations: " + str(numberOfIterations))
         logging.debug("inflation: " + str(inflation))
         logging.debug("curvature: " + str(curvature))
         logging.debug("attraction: " + str(attraction))
 
+        weights = ( inflation, curvature, attraction, levelSetsType )
+        evolutionKey = None
+        totalNumberOfIterations = numberOfIterations
+        if warmStartKey is not None:
+            evolutionKey = ( warmStartKey, originalImage.GetAddressAsString( 'vtkImageData' ), originalImage.GetMTime(), croppedRounds, cropToInitialization )
+            warmStartIterations = self.getWarmStartIterations( evolutionKey, numberOfIterations, weights )
+            if warmStartIterations is not None:
+                if warmStartIterations == 0:
+                    logging.debug( "Using the previous evolution" )
+                    return self.lastEvolution['levelSet']
+                logging.debug( "Continuing the previous evolution with {0} iterations".format( warmStartIterations ) )
+                segmentationImage = self.lastEvolution['levelSet']
+                numberOfIterations = warmStartIterations
+
+        cropSlices = None
+        if cropToInitialization:
+            initializationArray = Helper.GetImageDataAsArray( segmentationImage )
+            cropSlices = self.getBoundingBoxSlices( initializationArray <= 0, numberOfIterations + self.EVOLUTION_CROP_MARGIN_VOXEL )
+            if cropSlices is None:
+                logging.warning( "The initialization is empty, the evolution runs on the full image" )
+
+        featureImage = self.getGradientBasedFeatureImage( originalImage )
+        if cropSlices is None:
+            evolutionImage = segmentationImage
+        else:
+            logging.debug( "Evolution region: " + str( [( regionSlice.start, regionSlice.stop ) for regionSlice in cropSlices] ) )
+            featureArray = numpy.ascontiguousarray( Helper.GetImageDataAsArray( featureImage )[cropSlices], dtype=numpy.float32 )
+            featureImage = Helper.CreateImageDataFromArray( featureArray, segmentationImage.GetSpacing() )
+            evolutionImage = Helper.CreateImageDataFromArray( numpy.array( initializationArray[cropSlices], dtype=numpy.float32 ), segmentationImage.GetSpacing() )
+
+        if croppedRounds:
+            evolvedImage = self.performEvolutionInRounds( featureImage, evolutionImage, numberOfIterations, inflation, curvature, attraction,
+                levelSetsType, self.CROPPED_ROUND_ITERATIONS, maximumRMSError, progressCallback )
+        else:
+            evolvedImage = self.runLevelSetFilter( featureImage, evolutionImage, numberOfIterations, inflation, curvature, attraction,
+                levelSetsType, maximumRMSError, progressCallback ).GetOutput()
+
+        if cropSlices is None:
+            outImageData = vtk.vtkImageData()
+            outImageData.DeepCopy( evolvedImage )
+        else:
+            levelSetArray = numpy.array( initializationArray, dtype=numpy.float32 )
+            levelSetArray[cropSlices] = Helper.GetImageDataAsArray( evolvedImage )
+            outImageData = Helper.CreateImageDataFromArray( levelSetArray, segmentationImage.GetSpacing(), segmentationImage.GetExtent()[0::2] )
+            outImageData.SetOrigin( segmentationImage.GetOrigin() )
+
+        if evolutionKey is not None:
+            self.lastEvolution = { 'key': evolutionKey, 'weights': weights, 'numberOfIterations': totalNumberOfIterations, 'levelSet': outImageData }
+        return outImageData
+
+    def getWarmStartIterations( self, evolutionKey, numberOfIterations, weights ):
+        '''
+        Returns the number of iterations to run from the previous result to get numberOfIterations iterations with weights,
+        None if the evolution has to start from the initialization.
+        With the same weights only the additional iterations are run. With other weights the previous result is refined
+        with numberOfIterations iterations.
+        '''
+        if not self.lastEvolution or self.lastEvolution['key'] != evolutionKey:
+            return None
+        if self.lastEvolution['weights'] != weights:
+            return numberOfIterations
+        if numberOfIterations < self.lastEvolution['numberOfIterations']:
+            return None
+        return numberOfIterations - self.lastEvolution['numberOfIterations']
+
+    def clearWarmStart( self ):
+        self.lastInitialization = None
+        self.lastEvolution = None
+
+    def runLevelSetFilter( self, featureImage, segmentationImage, numberOfIterations, inflation, curvature, attraction, levelSetsType='geodesic',
+                           maximumRMSError=None, progressCallback=None ):
+        '''
+        Runs the level set filter on segmentationImage and returns it. The filter stops by itself when the RMS change is
+        below maximumRMSError. The ITK level set filter updates its progress before each iteration (in Halt) and the
+        vtkvmtk wrapper forwards it as a ProgressEvent, therefore progressCallback (see performEvolution) is called in each
+        iteration with the elapsed iterations and the RMS change of the last iteration (None before the first one),
+        and once more after the filter is completed. LevelSetSegmentationTest checks that these calls are made.
+        '''
+        levelSets = self.createLevelSetFilter( featureImage, inflation, curvature, attraction, levelSetsType, maximumRMSError )
+        levelSets.SetInputData( segmentationImage )
+        levelSets.SetNumberOfIterations( numberOfIterations )
+        if progressCallback:
+            def onProgress( caller, event ):
+                elapsedIterations = caller.GetElapsedIterations()
+                progressCallback( elapsedIterations, numberOfIterations, caller.GetRMSChange() if elapsedIterations > 0 else None )
+            levelSets.AddObserver( vtk.vtkCommand.ProgressEvent, onProgress )
+        levelSets.Update()
+        logging.debug( "Level set iterations: {0}/{1}, RMS change: {2}".format( levelSets.GetElapsedIterations(), numberOfIterations, levelSets.GetRMSChange() ) )
+        if progressCallback:
+            progressCallback( levelSets.GetElapsedIterations(), numberOfIterations, levelSets.GetRMSChange() )
+        return levelSets
+
+    def performEvolutionInRounds( self, featureImage, segmentationImage, numberOfIterations, inflation, curvature, attraction, levelSetsType='geodesic',
+                                  iterationsPerRound=CROPPED_ROUND_ITERATIONS, maximumRMSError=None, progressCallback=None ):
+        '''
+        Evolution in cropped rounds (this is not a narrow band method, the level set filter already uses a sparse field):
+        evolves the level set in rounds of iterationsPerRound iterations, each round restarts the level set filter from
+        the result of the previous round. Each round runs the level set filter only on the bounding box of the current
+        segmentation, extended by the distance the front can travel in the round (the sparse field moves at most one voxel
+        per iteration) and EVOLUTION_CROP_MARGIN_VOXEL, on the same region of the feature image. The result is pasted back,
+        therefore the speed and advection images and the sparse field are only built for the bounding box instead of the
+        full volume. This is faster when the segmentation is small compared to the volume; the voxels and time of each
+        round are logged, and LevelSetSegmentationTest logs the time of both evolutions.
+        The filter rebuilds its sparse field layers from the zero level set in each round, therefore the segmentation is
+        not exactly the same as a single evolution (LevelSetSegmentationTest checks that they are close).
+        After each round progressCallback is called (see performEvolution) and the evolution stops if the RMS change is
+        below maximumRMSError.
+        '''
+        levelSetArray = numpy.array( Helper.GetImageDataAsArray( segmentationImage ), dtype=numpy.float32 )
+        featureArray = Helper.GetImageDataAsArray( featureImage )
+        spacing = segmentationImage.GetSpacing()
+
+        completedIterations = 0
+        while completedIterations < numberOfIterations:
+            roundIterations = min( iterationsPerRound, numberOfIterations - completedIterations )
+            roundSlices = self.getBoundingBoxSlices( levelSetArray <= 0, roundIterations + self.EVOLUTION_CROP_MARGIN_VOXEL )
+            if roundSlices is None:
+                logging.warning( "Level set evolution stopped, the segmentation is empty" )
+                break
+            roundFeatureImage = Helper.CreateImageDataFromArray( numpy.ascontiguousarray( featureArray[roundSlices], dtype=numpy.float32 ), spacing )
+            roundSegmentationImage = Helper.CreateImageDataFromArray( numpy.ascontiguousarray( levelSetArray[roundSlices] ), spacing )
+            roundStartTime = time.time()
+            levelSets = self.runLevelSetFilter( roundFeatureImage, roundSegmentationImage, roundIterations, inflation, curvature, attraction,
+                levelSetsType, maximumRMSError )
+            levelSetArray[roundSlices] = Helper.GetImageDataAsArray( levelSets.GetOutput() )
+            logging.debug( "Cropped round: {0} of {1} voxels, {2:.2f} s".format( levelSetArray[roundSlices].size, levelSetArray.size,
+                time.time() - roundStartTime ) )
+
+            elapsedIterations = levelSets.GetElapsedIterations()
+            rmsChange = levelSets.GetRMSChange()
+            completedIterations += elapsedIterations
+            if progressCallback:
+                progressCallback( completedIterations, numberOfIterations, rmsChange )
+            if elapsedIterations < roundIterations or ( maximumRMSError is not None and rmsChange < maximumRMSError ):
+                logging.debug( "Level set evolution converged after {0} iterations".format( completedIterations ) )
+                break
+
+        outImageData = Helper.CreateImageDataFromArray( levelSetArray, spacing, segmentationImage.GetExtent()[0::2] )
+        outImageData.SetOrigin( segmentationImage.GetOrigin() )
+        return outImageData
+
+    def getBoundingBoxSlices( self, mask, marginVoxel ):
+        '''
+        Returns the [k, j, i] slices of the bounding box of the non-zero voxels of mask extended by marginVoxel
+        (clamped to the array), None if mask is empty.
+        '''
+        slices = []
+        for axis in range( 3 ):
+            otherAxes = tuple( otherAxis for otherAxis in range( 3 ) if otherAxis != axis )
+            indices = numpy.nonzero( mask.any( axis=otherAxes ) )[0]
+            if not indices.size:
+                return None
+            slices.append( slice( max( int( indices[0] ) - marginVoxel, 0 ), min( int( indices[-1] ) + marginVoxel + 1, mask.shape[axis] ) ) )
+        return tuple( slices )
+
+    def createLevelSetFilter( self, featureImage, inflation, curvature, attraction, levelSetsType='geodesic', maximumRMSError=None ):
+        '''
+        Returns a level set filter that uses featureImage, the input and the number of iterations are not set.
+        If maximumRMSError is None then the filter always runs all iterations.
+        '''
+        # import the vmtk libraries
+        try:
+            import vtkvmtkSegmentationPython as vtkvmtkSegmentation
+        except ImportError:
+            logging.error("Unable to import the SlicerVmtk libraries")
+
+        featureDerivativeSigma = 0.0
+        if maximumRMSError is None:
+            maximumRMSError = 1E-20
+        isoSurfaceValue = 0.0
+
         if levelSetsType == 'geodesic':
             logging.debug("using vtkvmtkGeodesicActiveContourLevelSetImageFilter")
             levelSets = vtkvmtkSegmentation.vtkvmtkGeodesicActiveContourLevelSetImageFilter()
-            levelSets.SetFeatureImage( self.buildGradientBasedFeatureImage( originalImage ) )
+            levelSets.SetFeatureImage( featureImage )
             levelSets.SetDerivativeSigma( featureDerivativeSigma )
             levelSets.SetAutoGenerateSpeedAdvection( 1 )
             levelSets.SetPropagationScaling( inflation * ( -1 ) )
@@ -154,7 +600,7 @@ class LevelSetSegmentationLogic( object ):
             levelSets.SetAdvectionScaling( attraction * ( -1 ) )
         elif levelSetsType == 'curves':
             levelSets = vtkvmtkSegmentation.vtkvmtkCurvesLevelSetImageFilter()
-            levelSets.SetFeatureImage( self.buildGradientBasedFeatureImage( originalImage ) )
+            levelSets.SetFeatureImage( featureImage )
             levelSets.SetDerivativeSigma( featureDerivativeSigma )
             levelSets.SetAutoGenerateSpeedAdvection( 1 )
             levelSets.SetPropagationScaling( inflation * ( -1 ) )
@@ -167,22 +613,52 @@ class LevelSetSegmentationLogic( object ):
         else:
             raise NameError('Unsupported LevelSetsType')
 
-        levelSets.SetInputData( segmentationImage )
-        levelSets.SetNumberOfIterations( numberOfIterations )
         levelSets.SetIsoSurfaceValue( isoSurfaceValue )
         levelSets.SetMaximumRMSError( maximumRMSError )
         levelSets.SetInterpolateSurfaceLocation( 1 )
         levelSets.SetUseImageSpacing( 1 )
-        levelSets.Update()
 
-        outImageData = vtk.vtkImageData()
-        outImageData.DeepCopy( levelSets.GetOutput() )
-
-        return outImageData
+        return levelSets
 
 
-    def buildGradientBasedFeatureImage( self, imageData ):
+    def getGradientBasedFeatureImage( self, imageData, derivativeSigma=0.0, sigmoidRemapping=1 ):
+        '''
+        Returns the feature image of imageData (see buildGradientBasedFeatureImage), from the cache if available.
+        The returned image may be shared with later calls, it must not be modified.
         '''
+        scalars = imageData.GetPointData().GetScalars()
+        key = ( imageData.GetAddressAsString( 'vtkImageData' ), imageData.GetMTime(), scalars.GetMTime() if scalars else 0,
+                derivativeSigma, sigmoidRemapping )
+        if key in self.featureImageCache:
+            logging.debug( "Using cached feature image" )
+            # move to the end, as most recently used
+            featureImage = self.featureImageCache.pop( key )
+            self.featureImageCache[key] = featureImage
+            return featureImage
+
+        featureImage = self.buildGradientBasedFeatureImage( imageData, derivativeSigma, sigmoidRemapping )
+
+        featureImageSizeMb = featureImage.GetActualMemorySize() / 1024.0
+        if featureImageSizeMb > self.FEATURE_IMAGE_CACHE_MAXIMUM_MB:
+            logging.debug( "Feature image is not cached, it would take {0:.0f}MB".format( featureImageSizeMb ) )
+            return featureImage
+        self.featureImageCache[key] = featureImage
+        while ( len( self.featureImageCache ) > self.FEATURE_IMAGE_CACHE_MAXIMUM_ENTRIES
+                or self.getFeatureImageCacheSizeMb() > self.FEATURE_IMAGE_CACHE_MAXIMUM_MB ):
+            # remove least recently used
+            self.featureImageCache.popitem( last=False )
+        return featureImage
+
+    def getFeatureImageCacheSizeMb( self ):
+        return sum( [featureImage.GetActualMemorySize() for featureImage in self.featureImageCache.values()] ) / 1024.0
+
+    def clearFeatureImageCache( self ):
+        self.featureImageCache.clear()
+
+    def buildGradientBasedFeatureImage( self, imageData, derivativeSigma=0.0, sigmoidRemapping=1 ):
+        '''
+        Returns the gradient magnitude of imageData, remapped with a sigmoid (sigmoidRemapping=1)
+        or a bounded reciprocal (sigmoidRemapping=0), so that edges have low values.
         '''
         # import the vmtk libraries
         try:
@@ -190,9 +666,6 @@ class LevelSetSegmentationLogic( object ):
         except ImportError:
             logging.error("Unable to import the SlicerVmtk libraries")
 
-        derivativeSigma = 0.0
-        sigmoidRemapping = 1
-
         cast = vtk.vtkImageCast()
         cast.SetInputData( imageData )
         cast.SetOutputScalarTypeToFloat()
@@ -302,3 +775,145 @@ class LevelSetSegmentationLogic( object ):
         result.DeepCopy( stripper.GetOutput() )
 
         return result
+
+    def contourLevelSet( self, image, ijkToRasMatrix, threshold ):
+        '''
+        Faster alternative of marchingCubes: returns the RAS surface at threshold of image (IJK coordinates).
+        Only the bounding box of the voxels below threshold is contoured, with flying edges (multi-threaded) if available.
+        Points and normals are transformed to RAS directly, there is no normal splitting and no triangle stripping.
+        '''
+        array = Helper.GetImageDataAsArray( image )
+        regionSlices = self.getBoundingBoxSlices( array <= threshold, 1 )
+        if regionSlices is None:
+            return vtk.vtkPolyData()
+        extentStart = image.GetExtent()[0::2]
+        regionExtentStart = [extentStart[axis] + regionSlices[2 - axis].start for axis in range( 3 )]
+        points, normals, triangles = self.contourArray( array[regionSlices], regionExtentStart, threshold )
+        points, normals, triangles = self.transformSurface( points, normals, triangles, ijkToRasMatrix )
+        return self.createPolyData( points, normals, triangles )
+
+    def contourLevelSetInSlabs( self, image, ijkToRasMatrix, threshold, slabSizeVoxel=CONTOUR_SLAB_SIZE_VOXEL ):
+        '''
+        Same as contourLevelSet, processing image in slabs of slabSizeVoxel slices along K, so that the temporary images
+        and surfaces only take memory for one slab. Consecutive slabs share one slice, the points on the shared slice are
+        merged (by their IJK position) and the triangles of each slab are appended to the result.
+        '''
+        array = Helper.GetImageDataAsArray( image )
+        extentStart = image.GetExtent()[0::2]
+        pointChunks = []
+        normalChunks = []
+        triangleChunks = []
+        numberOfPoints = 0
+        # IJK position key -> point index, of the points on the first slice of the current slab
+        seamPointIndices = {}
+
+        for slabStart in range( 0, max( array.shape[0] - 1, 1 ), slabSizeVoxel ):
+            slabSlices = ( slice( slabStart, min( slabStart + slabSizeVoxel + 1, array.shape[0] ) ), )
+            slabArray = array[slabSlices]
+            regionSlices = self.getBoundingBoxSlices( slabArray <= threshold, 1 )
+            if regionSlices is None:
+                seamPointIndices = {}
+                continue
+            # keep all slices of the slab, the seam slices must be contoured in both slabs
+            regionSlices = ( slice( 0, slabArray.shape[0] ), ) + regionSlices[1:]
+            regionExtentStart = [extentStart[0] + regionSlices[2].start, extentStart[1] + regionSlices[1].start, extentStart[2] + slabStart]
+            points, normals, triangles = self.contourArray( slabArray[regionSlices], regionExtentStart, threshold )
+
+            # points on the first slice are merged with the points on the last slice of the previous slab
+            pointIndices = numpy.empty( points.shape[0], dtype=numpy.int64 )
+            pointIndices.fill( -1 )
+            if seamPointIndices:
+                for localIndex in numpy.nonzero( numpy.abs( points[:, 2] - regionExtentStart[2] ) < 1e-3 )[0]:
+                    pointIndices[localIndex] = seamPointIndices.get( self.getPointKey( points[localIndex] ), -1 )
+            newPoints = pointIndices < 0
+            numberOfNewPoints = int( newPoints.sum() )
+            pointIndices[newPoints] = numpy.arange( numberOfPoints, numberOfPoints + numberOfNewPoints )
+
+            lastSlice = regionExtentStart[2] + slabArray.shape[0] - 1
+            seamPointIndices = {}
+            for localIndex in numpy.nonzero( numpy.abs( points[:, 2] - lastSlice ) < 1e-3 )[0]:
+                seamPointIndices[self.getPointKey( points[localIndex] )] = int( pointIndices[localIndex] )
+
+            points, normals, triangles = self.transformSurface( points[newPoints], normals[newPoints], pointIndices[triangles], ijkToRasMatrix )
+            pointChunks.append( points )
+            normalChunks.append( normals )
+            triangleChunks.append( triangles )
+            numberOfPoints += numberOfNewPoints
+
+        if not pointChunks:
+            return vtk.vtkPolyData()
+        return self.createPolyData( numpy.concatenate( pointChunks ), numpy.concatenate( normalChunks ), numpy.concatenate( triangleChunks ) )
+
+    def getPointKey( self, point ):
+        '''
+        Returns a key that is the same for points at the same IJK position (up to rounding).
+        '''
+        return tuple( int( round( coordinate * 1000 ) ) for coordinate in point )
+
+    def contourArray( self, array, extentStart, threshold ):
+        '''
+        Contours array (indexed [k, j, i], its first voxel is at IJK extentStart) at threshold, with vtkFlyingEdges3D
+        or vtkMarchingCubes if it is not available.
+        Returns the points (IJK), the normals and the triangles (point indices) as n x 3 arrays.
+        '''
+        from vtk.util import numpy_support
+        imageData = Helper.CreateImageDataFromArray( numpy.ascontiguousarray( array ), extentStart=extentStart )
+        if hasattr( vtk, 'vtkFlyingEdges3D' ):
+            contour = vtk.vtkFlyingEdges3D()
+        else:
+            contour = vtk.vtkMarchingCubes()
+        contour.SetInputData( imageData )
+        contour.SetValue( 0, threshold )
+        contour.ComputeScalarsOff()
+        contour.ComputeGradientsOff()
+        contour.ComputeNormalsOn()
+        contour.Update()
+        polyData = contour.GetOutput()
+
+        if not polyData.GetNumberOfPoints():
+            return numpy.zeros( ( 0, 3 ) ), numpy.zeros( ( 0, 3 ), dtype=numpy.float32 ), numpy.zeros( ( 0, 3 ), dtype=numpy.int64 )
+        points = numpy.array( numpy_support.vtk_to_numpy( polyData.GetPoints().GetData() ), dtype=numpy.float64 )
+        normals = numpy.array( numpy_support.vtk_to_numpy( polyData.GetPointData().GetNormals() ), dtype=numpy.float32 )
+        polys = polyData.GetPolys()
+        if hasattr( polys, 'GetConnectivityArray' ):
+            triangles = numpy_support.vtk_to_numpy( polys.GetConnectivityArray() ).reshape( -1, 3 )
+        else:
+            # legacy cell array: number of points followed by the point ids of each cell
+            triangles = numpy_support.vtk_to_numpy( polys.GetData() ).reshape( -1, 4 )[:, 1:]
+        return points, normals, numpy.array( triangles, dtype=numpy.int64 )
+
+    def transformSurface( self, points, normals, triangles, ijkToRasMatrix ):
+        '''
+        Transforms points and normals (n x 3 arrays) with the ijkToRasMatrix vtkMatrix4x4. The orientation of the
+        triangles is reversed if the transform flips the surface, so that the triangles stay consistent with the normals.
+        '''
+        matrix = numpy.array( [[ijkToRasMatrix.GetElement( row, column ) for column in range( 4 )] for row in range( 4 )] )
+        points = points.dot( matrix[:3, :3].T ) + matrix[:3, 3]
+        # normals are transformed with the inverse transpose
+        normals = normals.dot( numpy.linalg.inv( matrix[:3, :3] ) )
+        lengths = numpy.sqrt( ( normals ** 2 ).sum( axis=1 ) )
+        lengths[lengths == 0] = 1.0
+        normals = ( normals / lengths[:, numpy.newaxis] ).astype( numpy.float32 )
+        if numpy.linalg.det( matrix[:3, :3] ) < 0:
+            triangles = triangles[:, ::-1]
+        return points, normals, triangles
+
+    def createPolyData( self, points, normals, triangles ):
+        '''
+        Returns a vtkPolyData with points and normals (n x 3 arrays) and triangles (m x 3 point indices).
+        '''
+        from vtk.util import numpy_support
+        polyData = vtk.vtkPolyData()
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData( numpy_support.numpy_to_vtk( numpy.ascontiguousarray( points, dtype=numpy.float32 ), deep=True ) )
+        polyData.SetPoints( vtkPoints )
+        vtkNormals = numpy_support.numpy_to_vtk( numpy.ascontiguousarray( normals, dtype=numpy.float32 ), deep=True )
+        vtkNormals.SetName( "Normals" )
+        polyData.GetPointData().SetNormals( vtkNormals )
+        cells = numpy.empty( ( triangles.shape[0], 4 ), dtype=numpy_support.ID_TYPE_CODE )
+        cells[:, 0] = 3
+        cells[:, 1:] = triangles
+        polys = vtk.vtkCellArray()
+        polys.SetCells( triangles.shape[0], numpy_support.numpy_to_vtkIdTypeArray( cells.ravel(), deep=True ) )
+        polyData.SetPolys( polys )
+        return polyData
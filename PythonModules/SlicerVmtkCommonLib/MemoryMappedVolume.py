@@ -0,0 +1,214 @@
+# Zero-copy loading of uncompressed volume files.
+#
+# The voxel data of raw NRRD (.nrrd, .nhdr) and MetaImage (.mha, .mhd) files is memory-mapped and
+# used directly as the scalars of the volume node image. Only the parts of the volume that are accessed
+# (for example tiles or a region of interest) are read from the disk, and the pages can be released by the
+# operating system under memory pressure, as they are backed by the file.
+#
+# NRRD header reading and writing is also used by the batch processing and by Helper.
+
+import logging
+import os
+import sys
+
+import numpy
+
+from Helper import Helper
+
+__all__ = [ 'readNrrdHeader', 'writeNrrdKeyValuePair', 'readMetaImageHeader', 'getMemoryMappedVolumeInfo', 'loadMemoryMappedVolume' ]
+
+NRRD_TYPES = {
+    'signed char': numpy.int8, 'int8': numpy.int8, 'int8_t': numpy.int8,
+    'uchar': numpy.uint8, 'unsigned char': numpy.uint8, 'uint8': numpy.uint8, 'uint8_t': numpy.uint8,
+    'short': numpy.int16, 'short int': numpy.int16, 'signed short': numpy.int16, 'signed short int': numpy.int16,
+    'int16': numpy.int16, 'int16_t': numpy.int16,
+    'ushort': numpy.uint16, 'unsigned short': numpy.uint16, 'unsigned short int': numpy.uint16,
+    'uint16': numpy.uint16, 'uint16_t': numpy.uint16,
+    'int': numpy.int32, 'signed int': numpy.int32, 'int32': numpy.int32, 'int32_t': numpy.int32,
+    'uint': numpy.uint32, 'unsigned int': numpy.uint32, 'uint32': numpy.uint32, 'uint32_t': numpy.uint32,
+    'float': numpy.float32, 'double': numpy.float64 }
+
+METAIMAGE_TYPES = {
+    'MET_CHAR': numpy.int8, 'MET_UCHAR': numpy.uint8, 'MET_SHORT': numpy.int16, 'MET_USHORT': numpy.uint16,
+    'MET_INT': numpy.int32, 'MET_UINT': numpy.uint32, 'MET_FLOAT': numpy.float32, 'MET_DOUBLE': numpy.float64 }
+
+
+def readNrrdHeader( filePath ):
+    '''
+    Returns the fields of a NRRD header as a dictionary (field names in lowercase).
+    Key/value pairs ("key:=value" lines) are in header['keyValuePairs'].
+    '''
+    header = { 'keyValuePairs': {} }
+    with open( filePath, 'rb' ) as nrrdFile:
+        magic = nrrdFile.readline().decode( 'ascii', 'replace' )
+        if not magic.startswith( 'NRRD' ):
+            raise ValueError( "Not a NRRD file: " + filePath )
+        header['headerSize'] = len( magic )
+        for line in nrrdFile:
+            header['headerSize'] += len( line )
+            line = line.decode( 'ascii', 'replace' ).rstrip( '\r\n' )
+            if not line:
+                # end of header
+                break
+            if line.startswith( '#' ):
+                continue
+            if ':=' in line:
+                key, separator, value = line.partition( ':=' )
+                header['keyValuePairs'][key] = value
+                continue
+            fieldName, separator, fieldValue = line.partition( ': ' )
+            if separator:
+                header[fieldName.strip().lower()] = fieldValue.strip()
+    return header
+
+
+def writeNrrdKeyValuePair( filePath, key, value ):
+    '''
+    Adds a "key:=value" line to the header of a NRRD file (the file is rewritten).
+    '''
+    import shutil
+    temporaryFilePath = filePath + '.tmp'
+    with open( filePath, 'rb' ) as nrrdFile:
+        with open( temporaryFilePath, 'wb' ) as temporaryFile:
+            for line in nrrdFile:
+                if not line.strip():
+                    # end of header
+                    temporaryFile.write( '{0}:={1}\n'.format( key, value ).encode( 'ascii' ) )
+                    temporaryFile.write( line )
+                    break
+                temporaryFile.write( line )
+            shutil.copyfileobj( nrrdFile, temporaryFile )
+    os.remove( filePath )
+    os.rename( temporaryFilePath, filePath )
+
+
+def readMetaImageHeader( filePath ):
+    '''
+    Returns the fields of a MetaImage header as a dictionary, with the size of the header in 'headerSize'.
+    '''
+    header = { 'headerSize': 0 }
+    with open( filePath, 'rb' ) as metaImageFile:
+        for line in metaImageFile:
+            header['headerSize'] += len( line )
+            fieldName, separator, fieldValue = line.decode( 'ascii', 'replace' ).partition( '=' )
+            if not separator:
+                raise ValueError( "Invalid MetaImage header: " + filePath )
+            header[fieldName.strip()] = fieldValue.strip()
+            if fieldName.strip() == 'ElementDataFile':
+                # last field of the header
+                break
+    return header
+
+
+def getMemoryMappedVolumeInfo( filePath ):
+    '''
+    Returns the layout and geometry of the voxel data of a volume file, None if the file cannot be memory-mapped
+    (compressed or non-native byte order data, multi-component or not 3D volume, unknown format).
+    The returned dictionary contains: dataFilePath, offset, dtype, dimensions, spacing, origin (RAS)
+    and directions (RAS direction of the IJK axes).
+    '''
+    lowerFilePath = filePath.lower()
+    nativeByteOrder = sys.byteorder
+    if lowerFilePath.endswith( '.nrrd' ) or lowerFilePath.endswith( '.nhdr' ):
+        header = readNrrdHeader( filePath )
+        if header.get( 'encoding', 'raw' ) != 'raw' or header.get( 'type' ) not in NRRD_TYPES:
+            return None
+        if int( header.get( 'dimension', 0 ) ) != 3:
+            return None
+        dtype = numpy.dtype( NRRD_TYPES[header['type']] )
+        if dtype.itemsize > 1 and header.get( 'endian', nativeByteOrder ) != nativeByteOrder:
+            return None
+        dimensions = [int( size ) for size in header['sizes'].split()]
+        dataFile = header.get( 'data file', header.get( 'datafile' ) )
+        if dataFile:
+            if dataFile.startswith( 'LIST' ) or len( dataFile.split() ) > 1:
+                return None
+            dataFilePath = os.path.join( os.path.dirname( filePath ), dataFile )
+            offset = int( header.get( 'byte skip', header.get( 'byteskip', 0 ) ) )
+        else:
+            dataFilePath = filePath
+            offset = header['headerSize'] + int( header.get( 'byte skip', header.get( 'byteskip', 0 ) ) )
+        if int( header.get( 'line skip', header.get( 'lineskip', 0 ) ) ) != 0:
+            return None
+
+        # space directions are "(x,y,z)" vectors, their length is the spacing
+        directions = []
+        spacing = []
+        if 'space directions' in header:
+            for vector in header['space directions'].replace( ')', '' ).split( '(' )[1:]:
+                components = [float( component ) for component in vector.split( ',' )]
+                length = numpy.linalg.norm( components )
+                spacing.append( length )
+                directions.append( [component / length for component in components] )
+        else:
+            spacing = [float( value ) for value in header.get( 'spacings', '1 1 1' ).split()]
+            directions = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+        origin = [0.0, 0.0, 0.0]
+        if 'space origin' in header:
+            origin = [float( component ) for component in header['space origin'].strip( '()' ).split( ',' )]
+        if header.get( 'space', 'right-anterior-superior' ).lower() in ( 'left-posterior-superior', 'lps' ):
+            origin = [-origin[0], -origin[1], origin[2]]
+            directions = [[-direction[0], -direction[1], direction[2]] for direction in directions]
+
+    elif lowerFilePath.endswith( '.mha' ) or lowerFilePath.endswith( '.mhd' ):
+        header = readMetaImageHeader( filePath )
+        if header.get( 'CompressedData', 'False' ).lower() == 'true' or header.get( 'ElementType' ) not in METAIMAGE_TYPES:
+            return None
+        if int( header.get( 'NDims', 0 ) ) != 3 or int( header.get( 'ElementNumberOfChannels', 1 ) ) != 1:
+            return None
+        dtype = numpy.dtype( METAIMAGE_TYPES[header['ElementType']] )
+        bigEndian = header.get( 'ElementByteOrderMSB', header.get( 'BinaryDataByteOrderMSB', 'False' ) ).lower() == 'true'
+        if dtype.itemsize > 1 and bigEndian != ( nativeByteOrder == 'big' ):
+            return None
+        dimensions = [int( size ) for size in header['DimSize'].split()]
+        if header['ElementDataFile'] == 'LOCAL':
+            dataFilePath = filePath
+            offset = header['headerSize']
+        else:
+            dataFilePath = os.path.join( os.path.dirname( filePath ), header['ElementDataFile'] )
+            offset = int( header.get( 'HeaderSize', 0 ) )
+        if offset < 0:
+            # data is at the end of the file
+            offset = os.path.getsize( dataFilePath ) - dimensions[0] * dimensions[1] * dimensions[2] * dtype.itemsize
+
+        spacing = [float( value ) for value in header.get( 'ElementSpacing', '1 1 1' ).split()]
+        origin = [float( value ) for value in header.get( 'Offset', header.get( 'Origin', header.get( 'Position', '0 0 0' ) ) ).split()]
+        matrix = [float( value ) for value in header.get( 'TransformMatrix', '1 0 0 0 1 0 0 0 1' ).split()]
+        directions = [matrix[axis*3:axis*3+3] for axis in range( 3 )]
+        # MetaImage geometry is in LPS
+        origin = [-origin[0], -origin[1], origin[2]]
+        directions = [[-direction[0], -direction[1], direction[2]] for direction in directions]
+
+    else:
+        return None
+
+    return { 'dataFilePath': dataFilePath, 'offset': offset, 'dtype': dtype, 'dimensions': dimensions,
+        'spacing': spacing, 'origin': origin, 'directions': directions }
+
+
+def loadMemoryMappedVolume( filePath, name=None ):
+    '''
+    Adds a scalar volume node to the scene, with voxels memory-mapped from filePath (see getMemoryMappedVolumeInfo).
+    The mapping is copy-on-write: the volume can be modified, but changes are not written to the file.
+    No display node is created, because automatic window/level would read the whole volume.
+    Returns None if the file cannot be memory-mapped.
+    '''
+    import slicer
+    info = getMemoryMappedVolumeInfo( filePath )
+    if not info:
+        return None
+    dimensions = info['dimensions']
+    array = numpy.memmap( info['dataFilePath'], dtype=info['dtype'], mode='c', offset=info['offset'],
+        shape=( dimensions[2], dimensions[1], dimensions[0] ) )
+    imageData = Helper.CreateImageDataFromArray( array )
+
+    volumeNode = slicer.mrmlScene.AddNode( slicer.vtkMRMLScalarVolumeNode() )
+    volumeNode.SetName( name if name else os.path.basename( filePath ) )
+    volumeNode.SetSpacing( info['spacing'] )
+    volumeNode.SetOrigin( info['origin'] )
+    directions = info['directions']
+    volumeNode.SetIJKToRASDirections( directions[0][0], directions[0][1], directions[0][2],
+        directions[1][0], directions[1][1], directions[1][2], directions[2][0], directions[2][1], directions[2][2] )
+    volumeNode.SetAndObserveImageData( imageData )
+    logging.debug( "Memory-mapped {0} ({1} bytes at offset {2})".format( info['dataFilePath'], array.nbytes, info['offset'] ) )
+    return volumeNode
@@ -0,0 +1,172 @@
+# vtk includes
+from __main__ import vtk
+
+# python includes
+import threading
+import numpy
+
+from Helper import Helper
+
+class SparseImage(object):
+    '''
+    Block-sparse scalar volume. The extent is divided into cubic blocks of BLOCK_SIZE voxels
+    (aligned to the start of the extent) and only blocks that contain values above epsilon are stored.
+    Values not above epsilon are stored as 0. Arrays are indexed [k, j, i], as in Helper.GetImageDataAsArray.
+    '''
+
+    BLOCK_SIZE = 16
+
+    def __init__(self, extent, spacing=(1,1,1), epsilon=0.0, blockSize=None):
+        self.extent = [int(bound) for bound in extent]
+        self.spacing = [float(value) for value in spacing]
+        self.epsilon = float(epsilon)
+        self.blockSize = int(blockSize) if blockSize else self.BLOCK_SIZE
+        # block index (i, j, k) -> float32 array of blockSize^3 voxels, blocks at the end of the extent are padded
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def CreateFromArray(array, extentStart=(0,0,0), spacing=(1,1,1), epsilon=0.0, blockSize=None):
+        '''
+        Creates a sparse image from a dense numpy array indexed [k, j, i].
+        '''
+        extent = [extentStart[0], extentStart[0]+array.shape[2]-1,
+                  extentStart[1], extentStart[1]+array.shape[1]-1,
+                  extentStart[2], extentStart[2]+array.shape[0]-1]
+        sparseImage = SparseImage(extent, spacing, epsilon, blockSize)
+        sparseImage.SetRegion(array, extent)
+        return sparseImage
+
+    def GetExtent(self):
+        return list(self.extent)
+
+    def GetDimensions(self):
+        return [self.extent[axis*2+1] - self.extent[axis*2] + 1 for axis in range(3)]
+
+    def GetSpacing(self):
+        return list(self.spacing)
+
+    def GetNumberOfBlocks(self):
+        return len(self.blocks)
+
+    def GetBlockExtent(self, blockIndex):
+        '''
+        Returns the extent of the block, clipped to the extent of the image.
+        '''
+        blockExtent = []
+        for axis in range(3):
+            blockStart = self.extent[axis*2] + blockIndex[axis] * self.blockSize
+            blockExtent.append(blockStart)
+            blockExtent.append(min(blockStart + self.blockSize - 1, self.extent[axis*2+1]))
+        return blockExtent
+
+    def GetBlocks(self):
+        '''
+        Returns a list of (blockExtent, blockArray) pairs of the stored blocks.
+        blockArray is a view of the part of the block that is inside the image extent.
+        '''
+        blocks = []
+        for blockIndex, block in self.blocks.items():
+            blockExtent = self.GetBlockExtent(blockIndex)
+            blocks.append((blockExtent, block[:blockExtent[5]-blockExtent[4]+1, :blockExtent[3]-blockExtent[2]+1, :blockExtent[1]-blockExtent[0]+1]))
+        return blocks
+
+    def SetRegion(self, array, regionExtent):
+        '''
+        Stores the values of array (numpy array indexed [k, j, i] that covers regionExtent).
+        Regions may be set from multiple threads, but they must not overlap.
+        '''
+        blockIndexRanges = [range((regionExtent[axis*2] - self.extent[axis*2]) // self.blockSize,
+                                  (regionExtent[axis*2+1] - self.extent[axis*2]) // self.blockSize + 1) for axis in range(3)]
+        for blockK in blockIndexRanges[2]:
+            for blockJ in blockIndexRanges[1]:
+                for blockI in blockIndexRanges[0]:
+                    blockIndex = (blockI, blockJ, blockK)
+                    blockExtent = self.GetBlockExtent(blockIndex)
+                    overlapExtent = []
+                    for axis in range(3):
+                        overlapExtent.append(max(blockExtent[axis*2], regionExtent[axis*2]))
+                        overlapExtent.append(min(blockExtent[axis*2+1], regionExtent[axis*2+1]))
+                    values = array[self._GetArraySlices(regionExtent, overlapExtent)]
+                    aboveEpsilon = values > self.epsilon
+                    with self.lock:
+                        block = self.blocks.get(blockIndex)
+                        if block is None:
+                            if not aboveEpsilon.any():
+                                continue
+                            block = numpy.zeros((self.blockSize,)*3, dtype=numpy.float32)
+                            self.blocks[blockIndex] = block
+                    block[self._GetArraySlices(blockExtent[0::2], overlapExtent)] = numpy.where(aboveEpsilon, values, 0)
+
+    def GetFillFraction(self):
+        '''
+        Fraction of the voxels of the image that are stored.
+        '''
+        dimensions = self.GetDimensions()
+        numberOfVoxels = float(dimensions[0] * dimensions[1] * dimensions[2])
+        return sum([block.size for extent, block in self.GetBlocks()]) / numberOfVoxels
+
+    def GetMemorySizeMb(self):
+        return sum([block.nbytes for block in self.blocks.values()]) / 1024.0 / 1024.0
+
+    def GetScalarRange(self):
+        '''
+        Range of the values of the image, including the implicit zeros outside the stored blocks.
+        '''
+        blocks = self.GetBlocks()
+        minimum = min([0.0] + [float(block.min()) for extent, block in blocks])
+        maximum = max([0.0] + [float(block.max()) for extent, block in blocks])
+        return (minimum, maximum)
+
+    def GetDenseArray(self):
+        '''
+        Returns the image as a dense float32 numpy array indexed [k, j, i].
+        '''
+        dimensions = self.GetDimensions()
+        array = numpy.zeros((dimensions[2], dimensions[1], dimensions[0]), dtype=numpy.float32)
+        for blockExtent, block in self.GetBlocks():
+            array[self._GetArraySlices(self.extent, blockExtent)] = block
+        return array
+
+    def GetDenseImageData(self):
+        '''
+        Returns the image as a dense vtkImageData with spacing 1,1,1 (as volume nodes store images).
+        The image is only allocated when this method is called, for example for display.
+        '''
+        return Helper.CreateImageDataFromArray(self.GetDenseArray(), extentStart=self.extent[0::2])
+
+    def Save(self, fileName):
+        '''
+        Writes the image to a numpy .npz file.
+        '''
+        blockIndices = sorted(self.blocks.keys())
+        if blockIndices:
+            blocks = numpy.array([self.blocks[blockIndex] for blockIndex in blockIndices], dtype=numpy.float32)
+        else:
+            blocks = numpy.zeros((0,) + (self.blockSize,)*3, dtype=numpy.float32)
+        numpy.savez_compressed(fileName, extent=numpy.array(self.extent), spacing=numpy.array(self.spacing),
+            epsilon=self.epsilon, blockSize=self.blockSize,
+            blockIndices=numpy.array(blockIndices, dtype=numpy.int64).reshape(-1, 3), blocks=blocks)
+
+    @staticmethod
+    def Load(fileName):
+        '''
+        Reads an image written by Save.
+        '''
+        # the file is closed after reading, so that it can be removed or overwritten
+        with numpy.load(fileName) as data:
+            sparseImage = SparseImage(data['extent'], data['spacing'], float(data['epsilon']), int(data['blockSize']))
+            for blockIndex, block in zip(data['blockIndices'], data['blocks']):
+                sparseImage.blocks[tuple(int(index) for index in blockIndex)] = numpy.array(block, dtype=numpy.float32)
+        return sparseImage
+
+    def _GetArraySlices(self, arrayExtentStart, regionExtent):
+        '''
+        Returns the [k, j, i] slices that select regionExtent from an array that starts at arrayExtentStart
+        (extent or extent start).
+        '''
+        if len(arrayExtentStart) == 6:
+            arrayExtentStart = arrayExtentStart[0::2]
+        return (slice(regionExtent[4] - arrayExtentStart[2], regionExtent[5] - arrayExtentStart[2] + 1),
+                slice(regionExtent[2] - arrayExtentStart[1], regionExtent[3] - arrayExtentStart[1] + 1),
+                slice(regionExtent[0] - arrayExtentStart[0], regionExtent[1] - arrayExtentStart[0] + 1))
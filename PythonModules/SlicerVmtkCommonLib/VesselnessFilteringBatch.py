@@ -0,0 +1,299 @@
+# Headless batch vesselness filtering.
+#
+# Usage:
+#   Slicer --no-splash --no-main-window --python-script VesselnessFilteringBatch.py
+#     --input-dir /data/cta --output-dir /data/vesselness --parameters parameters.json
+#     [--seeds-dir /data/seeds] [--memory-limit-mb 32000] [--max-workers 4]
+#
+# Each volume is processed by a separate Slicer process. The number of processes that run at the
+# same time is limited by --max-workers and by the estimated memory need of the cases.
+# Outputs are written as <name>_vesselness.nrrd, with a <name>_report.json timing and memory report,
+# and a batch_report.json summary of all cases.
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+__all__ = [ 'getVolumeFileBaseName', 'estimateNumberOfVoxels', 'isMemoryMappable', 'estimateWorkerMemoryMb',
+            'getPeakMemoryMb', 'runVesselnessFilteringBatch', 'processVesselnessFilteringCase' ]
+
+# volume file extensions that are processed when an input directory is given
+VOLUME_FILE_EXTENSIONS = ['.nrrd', '.nhdr', '.nii', '.nii.gz', '.mha', '.mhd']
+
+# memory used by a worker in addition to the tiled filter memory budget,
+# for each input voxel (input volume, float output volume)
+WORKER_BYTES_PER_VOXEL = 8
+# same for input volumes that are memory-mapped (float output volume only),
+# pages of the input are backed by the file and can be released by the operating system
+MEMORY_MAPPED_WORKER_BYTES_PER_VOXEL = 4
+# memory used by a Slicer process without any data loaded
+WORKER_BASE_MEMORY_MB = 500
+# computeVesselnessVolume parameters that are set by the batch processing, they cannot be in the parameters
+BATCH_PARAMETERS = ['tiled', 'memoryBudgetMb']
+# computeVesselnessVolume parameters that cannot be combined with tiled processing
+UNSUPPORTED_BATCH_PARAMETERS = ['adaptiveScales']
+
+
+def getVolumeFileBaseName( filePath ):
+    '''
+    Returns the file name without directory and volume file extension.
+    '''
+    fileName = os.path.basename( filePath )
+    for extension in VOLUME_FILE_EXTENSIONS:
+        if fileName.lower().endswith( extension ):
+            return fileName[:-len( extension )]
+    return os.path.splitext( fileName )[0]
+
+
+def estimateNumberOfVoxels( filePath ):
+    '''
+    Number of voxels in the volume, read from the header for NRRD files,
+    estimated from the file size (assuming 2 bytes per voxel) otherwise.
+    '''
+    if filePath.lower().endswith( '.nrrd' ) or filePath.lower().endswith( '.nhdr' ):
+        from SlicerVmtkCommonLib import readNrrdHeader
+        try:
+            sizes = [int( size ) for size in readNrrdHeader( filePath )['sizes'].split()]
+            numberOfVoxels = 1
+            for size in sizes:
+                numberOfVoxels *= size
+            return numberOfVoxels
+        except ( ValueError, KeyError, IOError ):
+            logging.warning( "Failed to read NRRD header of " + filePath )
+    return os.path.getsize( filePath ) // 2
+
+
+def isMemoryMappable( filePath ):
+    from SlicerVmtkCommonLib import getMemoryMappedVolumeInfo
+    try:
+        return getMemoryMappedVolumeInfo( filePath ) is not None
+    except ( ValueError, KeyError, IOError ):
+        return False
+
+
+def estimateWorkerMemoryMb( filePath, filterMemoryBudgetMb ):
+    bytesPerVoxel = MEMORY_MAPPED_WORKER_BYTES_PER_VOXEL if isMemoryMappable( filePath ) else WORKER_BYTES_PER_VOXEL
+    return ( WORKER_BASE_MEMORY_MB + filterMemoryBudgetMb
+        + estimateNumberOfVoxels( filePath ) * bytesPerVoxel / 1024.0 / 1024.0 )
+
+
+def getPeakMemoryMb():
+    '''
+    Peak resident memory of the current process, None if it cannot be determined.
+    '''
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    maxrss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    # reported in bytes on Mac and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+
+def getSlicerExecutablePath():
+    import slicer
+    if hasattr( slicer.app, 'launcherExecutableFilePath' ) and slicer.app.launcherExecutableFilePath:
+        return slicer.app.launcherExecutableFilePath
+    return slicer.app.applicationFilePath()
+
+
+def runVesselnessFilteringBatch( inputFilePaths, outputDirectory, parameters, seedsDirectory=None,
+        memoryLimitMb=8000, maximumNumberOfWorkers=4, filterMemoryBudgetMb=2048 ):
+    '''
+    Computes vesselness of each input volume, in separate Slicer processes.
+    A new process is only started if the estimated memory need of all running cases stays below memoryLimitMb
+    (a case is always started if nothing else is running).
+    Returns the list of per-case reports, which is also saved to batch_report.json in outputDirectory.
+    '''
+    batchParameters = [name for name in BATCH_PARAMETERS if name in parameters]
+    if batchParameters:
+        raise ValueError( "Parameters set by the batch processing cannot be specified: " + ", ".join( batchParameters ) )
+    unsupportedParameters = [name for name in UNSUPPORTED_BATCH_PARAMETERS if parameters.get( name )]
+    if unsupportedParameters:
+        raise ValueError( "Parameters not supported by the tiled batch processing: " + ", ".join( unsupportedParameters ) )
+
+    if not os.path.exists( outputDirectory ):
+        os.makedirs( outputDirectory )
+
+    cases = []
+    for inputFilePath in inputFilePaths:
+        name = getVolumeFileBaseName( inputFilePath )
+        case = {
+            'name': name,
+            'inputFilePath': os.path.abspath( inputFilePath ),
+            'outputFilePath': os.path.abspath( os.path.join( outputDirectory, name + '_vesselness.nrrd' ) ),
+            'reportFilePath': os.path.abspath( os.path.join( outputDirectory, name + '_report.json' ) ),
+            'parameters': parameters,
+            'filterMemoryBudgetMb': filterMemoryBudgetMb,
+            'estimatedMemoryMb': estimateWorkerMemoryMb( inputFilePath, filterMemoryBudgetMb ) }
+        if seedsDirectory:
+            seedsFilePath = os.path.join( seedsDirectory, name + '.fcsv' )
+            if os.path.exists( seedsFilePath ):
+                case['seedsFilePath'] = os.path.abspath( seedsFilePath )
+        cases.append( case )
+
+    # start the largest cases first, smaller ones fill up the remaining memory
+    pendingCases = sorted( cases, key=lambda case: case['estimatedMemoryMb'], reverse=True )
+    runningCases = []
+    slicerExecutablePath = getSlicerExecutablePath()
+
+    while pendingCases or runningCases:
+
+        # start new workers while memory allows
+        usedMemoryMb = sum( [case['estimatedMemoryMb'] for case in runningCases] )
+        for case in list( pendingCases ):
+            if len( runningCases ) >= maximumNumberOfWorkers:
+                break
+            if runningCases and usedMemoryMb + case['estimatedMemoryMb'] > memoryLimitMb:
+                continue
+            caseFilePath = os.path.join( outputDirectory, case['name'] + '_case.json' )
+            with open( caseFilePath, 'w' ) as caseFile:
+                json.dump( case, caseFile )
+            logging.info( "Starting vesselness filtering of {0} (estimated memory: {1:.0f}MB)".format(
+                case['name'], case['estimatedMemoryMb'] ) )
+            case['process'] = subprocess.Popen( [slicerExecutablePath, '--no-splash', '--no-main-window',
+                '--python-script', os.path.abspath( __file__ ), '--worker', caseFilePath] )
+            case['caseFilePath'] = caseFilePath
+            usedMemoryMb += case['estimatedMemoryMb']
+            pendingCases.remove( case )
+            runningCases.append( case )
+
+        time.sleep( 0.5 )
+
+        for case in list( runningCases ):
+            returnCode = case['process'].poll()
+            if returnCode is None:
+                continue
+            runningCases.remove( case )
+            os.remove( case['caseFilePath'] )
+            if returnCode != 0:
+                logging.error( "Vesselness filtering of {0} failed (return code: {1})".format( case['name'], returnCode ) )
+
+    reports = []
+    for case in cases:
+        try:
+            with open( case['reportFilePath'] ) as reportFile:
+                reports.append( json.load( reportFile ) )
+        except IOError:
+            reports.append( { 'name': case['name'], 'success': False } )
+    with open( os.path.join( outputDirectory, 'batch_report.json' ), 'w' ) as reportFile:
+        json.dump( reports, reportFile, indent=2 )
+    return reports
+
+
+def processVesselnessFilteringCase( case ):
+    '''
+    Computes vesselness of a single case (in the current process) and writes the output and the report.
+    '''
+    import slicer
+    import VesselnessFiltering
+
+    report = { 'name': case['name'], 'inputFilePath': case['inputFilePath'], 'success': False }
+    logic = VesselnessFiltering.VesselnessFilteringLogic()
+    parameters = dict( case['parameters'] )
+
+    startTime = time.time()
+    # uncompressed volumes are memory-mapped, tiles are only read from the disk when they are processed
+    from SlicerVmtkCommonLib import loadMemoryMappedVolume
+    inputVolumeNode = loadMemoryMappedVolume( case['inputFilePath'], case['name'] )
+    report['memoryMapped'] = inputVolumeNode is not None
+    if not inputVolumeNode:
+        success, inputVolumeNode = slicer.util.loadVolume( case['inputFilePath'], returnNode=True )
+        if not success:
+            raise IOError( "Failed to load volume " + case['inputFilePath'] )
+    report['loadTimeSec'] = time.time() - startTime
+
+    if 'seedsFilePath' in case:
+        # automatic detection of vessel diameter and contrast, same as in the module widget
+        startTime = time.time()
+        success, seedsNode = slicer.util.loadMarkupsFiducialList( case['seedsFilePath'], returnNode=True )
+        if not success:
+            raise IOError( "Failed to load seeds " + case['seedsFilePath'] )
+        vesselPositionIJK = logic.getIJKFromRAS( inputVolumeNode, logic.getSeedPositionRAS( seedsNode ) )
+        detectedDiameter = logic.getDiameter( inputVolumeNode.GetImageData(), vesselPositionIJK )
+        parameters['maximumDiameterMm'] = detectedDiameter * min( inputVolumeNode.GetSpacing() )
+        parameters['contrastMeasure'] = logic.calculateContrastMeasure( inputVolumeNode.GetImageData(), vesselPositionIJK, detectedDiameter )
+        report['detectionTimeSec'] = time.time() - startTime
+    report['parameters'] = parameters
+
+    outputVolumeNode = slicer.mrmlScene.AddNode( slicer.vtkMRMLScalarVolumeNode() )
+    outputVolumeNode.SetName( case['name'] + '_vesselness' )
+
+    startTime = time.time()
+    logic.computeVesselnessVolume( inputVolumeNode, outputVolumeNode, tiled=True,
+        memoryBudgetMb=case['filterMemoryBudgetMb'], **parameters )
+    report['computationTimeSec'] = time.time() - startTime
+
+    startTime = time.time()
+    if not slicer.util.saveNode( outputVolumeNode, case['outputFilePath'] ):
+        raise IOError( "Failed to save volume " + case['outputFilePath'] )
+    # node attributes are not saved in the file, the quantization scale is written into the header
+    from SlicerVmtkCommonLib import Helper, writeNrrdKeyValuePair
+    quantizationScale = outputVolumeNode.GetAttribute( Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE )
+    if quantizationScale:
+        writeNrrdKeyValuePair( case['outputFilePath'], Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE, quantizationScale )
+        report['quantizationScale'] = float( quantizationScale )
+    report['saveTimeSec'] = time.time() - startTime
+
+    report['outputFilePath'] = case['outputFilePath']
+    report['numberOfVoxels'] = inputVolumeNode.GetImageData().GetNumberOfPoints()
+    report['peakMemoryMb'] = getPeakMemoryMb()
+    report['success'] = True
+    return report
+
+
+def main( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( description="Compute vesselness of a list of volumes" )
+    parser.add_argument( '--input', nargs='*', default=[], help="input volume files" )
+    parser.add_argument( '--input-dir', help="directory of input volume files" )
+    parser.add_argument( '--output-dir', help="directory of the output volumes and reports" )
+    parser.add_argument( '--parameters', help="JSON file of computeVesselnessVolume parameters "
+        "(minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure)" )
+    parser.add_argument( '--seeds-dir', help="directory of <volume name>.fcsv seed files for automatic parameter detection" )
+    parser.add_argument( '--memory-limit-mb', type=float, default=8000, help="memory available for all workers" )
+    parser.add_argument( '--max-workers', type=int, default=4, help="maximum number of cases processed at the same time" )
+    parser.add_argument( '--filter-memory-budget-mb', type=float, default=2048, help="memory budget of the tiled filter in each worker" )
+    parser.add_argument( '--worker', help=argparse.SUPPRESS )
+    args = parser.parse_args( argv )
+
+    if args.worker:
+        with open( args.worker ) as caseFile:
+            case = json.load( caseFile )
+        try:
+            report = processVesselnessFilteringCase( case )
+        except Exception as e:
+            logging.error( "Vesselness filtering of {0} failed: {1}".format( case['name'], e ) )
+            report = { 'name': case['name'], 'inputFilePath': case['inputFilePath'], 'success': False, 'error': str( e ) }
+        with open( case['reportFilePath'], 'w' ) as reportFile:
+            json.dump( report, reportFile, indent=2 )
+        return 0 if report['success'] else 1
+
+    if not args.output_dir:
+        parser.error( "--output-dir is required" )
+    inputFilePaths = list( args.input )
+    if args.input_dir:
+        for fileName in sorted( os.listdir( args.input_dir ) ):
+            if [extension for extension in VOLUME_FILE_EXTENSIONS if fileName.lower().endswith( extension )]:
+                inputFilePaths.append( os.path.join( args.input_dir, fileName ) )
+    if not inputFilePaths:
+        parser.error( "no input volumes" )
+
+    parameters = {}
+    if args.parameters:
+        with open( args.parameters ) as parametersFile:
+            parameters = json.load( parametersFile )
+
+    reports = runVesselnessFilteringBatch( inputFilePaths, args.output_dir, parameters, args.seeds_dir,
+        args.memory_limit_mb, args.max_workers, args.filter_memory_budget_mb )
+    return 0 if all( [report['success'] for report in reports] ) else 1
+
+
+if __name__ == "__main__":
+    sys.exit( main( sys.argv[1:] ) )
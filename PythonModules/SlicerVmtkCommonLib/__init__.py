@@ -1,4 +1,7 @@
 # import the vmtk common libs
 from Helper import *
+from SparseImage import *
 from LevelSetSegmentationLogic import *
 from CenterlineComputationLogic import *
+from VesselnessFilteringBatch import *
+from MemoryMappedVolume import *
@@ -1,9 +1,11 @@
 # slicer imports
 import os
 import unittest
+import math
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import numpy
 
 #from __main__ import vtk, qt, ctk, slicer
 
@@ -134,6 +136,19 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.parent.connect( 'mrmlSceneChanged(vtkMRMLScene*)',
                         self.__previewVolumeNodeSelector, 'setMRMLScene(vtkMRMLScene*)' )
 
+    # scales volume selector
+    self.__scalesVolumeNodeSelector = slicer.qMRMLNodeComboBox()
+    self.__scalesVolumeNodeSelector.toolTip = "Select a volume to store the vessel diameter (in mm) of the maximum vesselness response. It is used by the vessel diameter detection and by the Centerline Computation module to check the centerline radius."
+    self.__scalesVolumeNodeSelector.nodeTypes = ['vtkMRMLScalarVolumeNode']
+    self.__scalesVolumeNodeSelector.baseName = "VesselnessScales"
+    self.__scalesVolumeNodeSelector.noneEnabled = True
+    self.__scalesVolumeNodeSelector.addEnabled = True
+    self.__scalesVolumeNodeSelector.selectNodeUponCreation = True
+    self.__scalesVolumeNodeSelector.removeEnabled = True
+    advancedFormLayout.addRow( "Scale map volume:", self.__scalesVolumeNodeSelector )
+    self.parent.connect( 'mrmlSceneChanged(vtkMRMLScene*)',
+                        self.__scalesVolumeNodeSelector, 'setMRMLScene(vtkMRMLScene*)' )
+
     self.__previewVolumeDiameterVoxelSlider = ctk.ctkSliderWidget()
     self.__previewVolumeDiameterVoxelSlider.decimals = 0
     self.__previewVolumeDiameterVoxelSlider.minimum = 10
@@ -199,6 +214,17 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.__suppressBlobsSlider.toolTip = "A higher value filters out more blob-like structures."
     advancedFormLayout.addRow( "Suppress blobs:", self.__suppressBlobsSlider )
 
+    # these parameters are cheap to change, the preview is updated immediately
+    approximatePreviewToolTip = (" Changing this value updates the preview immediately with an approximation"
+      " computed in Python, click Preview to see the result of the VMTK filter.")
+    self.__contrastSlider.toolTip += approximatePreviewToolTip
+    self.__suppressPlatesSlider.toolTip += approximatePreviewToolTip
+    self.__suppressBlobsSlider.toolTip += approximatePreviewToolTip
+    self.__previewComputed = False
+    self.__contrastSlider.connect( 'valueChanged(double)', self.onVesselnessParameterChanged )
+    self.__suppressPlatesSlider.connect( 'valueChanged(double)', self.onVesselnessParameterChanged )
+    self.__suppressBlobsSlider.connect( 'valueChanged(double)', self.onVesselnessParameterChanged )
+
     #
     # Reset, preview and apply buttons
     #
@@ -209,7 +235,7 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.__previewButton = self.__buttonBox.addButton( self.__buttonBox.Discard )
     self.__previewButton.setIcon( qt.QIcon() )
     self.__previewButton.text = "Preview"
-    self.__previewButton.toolTip = "Click to refresh the preview."
+    self.__previewButton.toolTip = "Click to refresh the preview with the VMTK vesselness filter."
     self.__startButton = self.__buttonBox.addButton( self.__buttonBox.Apply )
     self.__startButton.setIcon( qt.QIcon() )
     self.__startButton.text = "Start"
@@ -220,10 +246,28 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.__previewButton.connect( "clicked()", self.onPreviewButtonClicked )
     self.__startButton.connect( "clicked()", self.onStartButtonClicked )
 
+    # preview of neighboring parameter values, side by side
+    self.__parameterGridButton = qt.QPushButton()
+    self.__parameterGridButton.text = "Preview parameter grid"
+    self.__parameterGridButton.toolTip = "Click to compute the preview with lower and higher contrast and plate suppression values and show them side by side. Contrast increases from left to right, plate suppression from top to bottom. The grid is an approximation computed in Python, click Preview to see the result of the VMTK filter."
+    advancedFormLayout.addRow( self.__parameterGridButton )
+    self.__parameterGridButton.connect( "clicked()", self.onParameterGridButtonClicked )
+    self.__parameterGridVolumeNode = None
+
+    # progress of the filtering that runs in the background
+    self.__progressBar = qt.QProgressBar()
+    self.__progressBar.minimum = 0
+    self.__progressBar.maximum = 100
+    self.__progressBar.hide()
+    self.layout.addWidget( self.__progressBar )
+    self.__computationSteps = None
+    self.__computationResult = None
+
     self.__inputVolumeNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__seedFiducialsNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__outputVolumeNodeSelector.setMRMLScene( slicer.mrmlScene )
     self.__previewVolumeNodeSelector.setMRMLScene( slicer.mrmlScene )
+    self.__scalesVolumeNodeSelector.setMRMLScene( slicer.mrmlScene )
 
     # set default values
     self.restoreDefaults()
@@ -236,13 +280,53 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.restoreDefaults()
 
   def onStartButtonClicked( self ):
+    if self.__computationSteps:
+      # filtering is in progress, the button cancels it
+      logging.debug( "Cancel Vesselness Filtering" )
+      self.logic.cancelComputation()
+      return
+
     if self.__detectPushButton.checked:
       self.calculateParameters()
 
-    # this is no preview
-    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    # this is no preview, filtering runs in the background
     self.start( False )
-    qt.QApplication.restoreOverrideCursor()
+
+  def setComputationInProgress( self, inProgress ):
+    self.__startButton.text = "Cancel" if inProgress else "Start"
+    self.__startButton.toolTip = "Click to cancel the filtering." if inProgress else "Click to start the filtering."
+    self.__previewButton.enabled = not inProgress
+    self.__parameterGridButton.enabled = not inProgress
+    self.__resetButton.enabled = not inProgress
+    self.__progressBar.value = 0
+    self.__progressBar.visible = inProgress
+
+  def onComputationProgress( self, progress ):
+    self.__progressBar.value = int( progress * 100 )
+    # keep the application responsive while the filter is running
+    slicer.app.processEvents()
+
+  def onComputationStep( self ):
+    '''
+    Processes the next part of the background filtering and schedules the one after.
+    '''
+    if not self.__computationSteps:
+      return
+    try:
+      progress = next( self.__computationSteps )
+      self.onComputationProgress( progress )
+      qt.QTimer.singleShot( 0, self.onComputationStep )
+      return
+    except StopIteration:
+      if self.logic.isComputationCancelled():
+        logging.info( "Vesselness Filtering was cancelled" )
+      else:
+        self.showResults( *self.__computationResult )
+    except Exception as e:
+      logging.error( "Vesselness Filtering failed: " + str( e ) )
+    self.__computationSteps = None
+    self.__computationResult = None
+    self.setComputationInProgress( False )
 
   def onPreviewButtonClicked( self ):
       '''
@@ -251,12 +335,56 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
           #self.restoreDefaults()
           self.calculateParameters()
 
-      # calculate the preview
+      # calculate the preview, only the blocks of the region that were not filtered before are computed
       self.start( True )
+      self.__previewComputed = True
 
       # activate startButton
       self.__startButton.enabled = True
 
+  def onParameterGridButtonClicked( self ):
+    if self.__detectPushButton.checked:
+      self.calculateParameters()
+
+    currentVolumeNode = self.__inputVolumeNodeSelector.currentNode()
+    currentSeedsNode = self.__seedFiducialsNodeSelector.currentNode()
+    previewRegionSizeVoxel = self.__previewVolumeDiameterVoxelSlider.value
+    previewRegionCenterRAS = self.logic.getSeedPositionRAS(currentSeedsNode)
+
+    if not self.__parameterGridVolumeNode or not slicer.mrmlScene.IsNodePresent( self.__parameterGridVolumeNode ):
+      newVolumeNode = slicer.mrmlScene.CreateNodeByClass( "vtkMRMLScalarVolumeNode" )
+      newVolumeNode.UnRegister(None)
+      newVolumeNode.SetName( slicer.mrmlScene.GetUniqueNameByString( "VesselnessParameterGrid" ) )
+      self.__parameterGridVolumeNode = slicer.mrmlScene.AddNode( newVolumeNode )
+      self.__parameterGridVolumeNode.CreateDefaultDisplayNodes()
+
+    minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure = self.getVesselnessParameters( currentVolumeNode )
+
+    suppressPlatesPercentage = self.__suppressPlatesSlider.value
+    suppressPlatesPercentages = [max( suppressPlatesPercentage - 10, 0 ), suppressPlatesPercentage, min( suppressPlatesPercentage + 10, 100 )]
+    alphaValues = [self.logic.alphaFromSuppressPlatesPercentage( percentage ) for percentage in suppressPlatesPercentages]
+    contrastMeasureValues = [contrastMeasure * 0.5, contrastMeasure, contrastMeasure * 2.0]
+
+    parameterGrid = self.logic.computeVesselnessParameterGrid( currentVolumeNode, self.__parameterGridVolumeNode,
+      previewRegionCenterRAS, previewRegionSizeVoxel, minimumDiameterMm, maximumDiameterMm, alphaValues, [beta], contrastMeasureValues )
+    for tileIndex, ( tileAlpha, tileBeta, tileContrastMeasure ) in enumerate( parameterGrid ):
+      logging.info( "Parameter grid tile {0}: alpha={1}, beta={2}, contrast={3}".format( tileIndex, tileAlpha, tileBeta, tileContrastMeasure ) )
+    slicer.util.showStatusMessage( "Approximate vesselness parameter grid, click Preview to see the result of the VMTK filter", 3000 )
+
+    selectionNode = slicer.app.applicationLogic().GetSelectionNode()
+    selectionNode.SetReferenceActiveVolumeID( self.__parameterGridVolumeNode.GetID() )
+    selectionNode.SetReferenceSecondaryVolumeID( None )
+    slicer.app.applicationLogic().PropagateVolumeSelection(False)
+    self.__parameterGridVolumeNode.GetDisplayNode().AutoWindowLevelOff()
+    self.__parameterGridVolumeNode.GetDisplayNode().AutoWindowLevelOn()
+    slicer.app.applicationLogic().FitSliceToAll()
+
+  def onVesselnessParameterChanged( self ):
+    # only the Frangi measure has to be recomputed, Hessian eigenvalues of the preview region are cached
+    if self.__previewComputed and not self.__computationSteps:
+      self.start( True, useScaleSpaceCache=True )
+      slicer.util.showStatusMessage( "Approximate vesselness preview, click Preview to see the result of the VMTK filter", 3000 )
+
   def calculateParameters( self ):
     logging.debug( "calculateParameters" )
 
@@ -268,21 +396,28 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     if not currentVolumeNode:
       raise ValueError("Input seed node is invalid")
       
-    vesselPositionIJK = self.logic.getIJKFromRAS(currentVolumeNode, self.logic.getSeedPositionRAS(currentSeedsNode))
+    vesselPositionRAS = self.logic.getSeedPositionRAS(currentSeedsNode)
+    vesselPositionIJK = self.logic.getIJKFromRAS(currentVolumeNode, vesselPositionRAS)
 
+    # use the scale map of a previous filtering if available, otherwise
     # we detect the diameter in IJK space (image has spacing 1,1,1) with IJK coordinates
-    detectedDiameter = self.logic.getDiameter( currentVolumeNode.GetImageData(), vesselPositionIJK)
+    detectedDiameter = self.logic.getDiameterFromScales( currentVolumeNode, vesselPositionRAS )
+    if detectedDiameter is None:
+      detectedDiameter = self.logic.getDiameter( currentVolumeNode.GetImageData(), vesselPositionIJK)
     logging.debug( "Diameter detected: " + str( detectedDiameter ) )
 
     contrastMeasure = self.logic.calculateContrastMeasure( currentVolumeNode.GetImageData(), vesselPositionIJK, detectedDiameter )
     logging.debug( "Contrast measure: " + str( contrastMeasure ) )
 
     self.__maximumDiameterSpinBox.value = detectedDiameter
+    wasBlocked = self.__contrastSlider.blockSignals( True )
     self.__contrastSlider.value = contrastMeasure
+    self.__contrastSlider.blockSignals( wasBlocked )
 
   def restoreDefaults( self ):
     logging.debug("restoreDefaults")
 
+    self.__previewComputed = False
     self.__detectPushButton.checked = True
     self.__previewVolumeDiameterVoxelSlider.value = 20
     self.__minimumDiameterSpinBox.value = 1
@@ -294,7 +429,21 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     self.__startButton.enabled = False
 
 
-  def start( self, preview=False ):
+  def getVesselnessParameters( self, currentVolumeNode ):
+    '''
+    Returns the filter parameters set in the widget as a
+    (minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure) tuple.
+    '''
+    # we need to convert diameter to mm, we use the minimum spacing to multiply the voxel value
+    minimumDiameterMm = self.__minimumDiameterSpinBox.value * min( currentVolumeNode.GetSpacing() )
+    maximumDiameterMm = self.__maximumDiameterSpinBox.value * min( currentVolumeNode.GetSpacing() )
+
+    alpha = self.logic.alphaFromSuppressPlatesPercentage(self.__suppressPlatesSlider.value)
+    beta = self.logic.alphaFromSuppressPlatesPercentage(self.__suppressBlobsSlider.value)
+    contrastMeasure = self.__contrastSlider.value
+    return minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure
+
+  def start( self, preview=False, useScaleSpaceCache=False ):
     # first we need the nodes
     currentVolumeNode = self.__inputVolumeNodeSelector.currentNode()
     currentSeedsNode = self.__seedFiducialsNodeSelector.currentNode()
@@ -325,17 +474,23 @@ class VesselnessFilteringWidget(ScriptedLoadableModuleWidget):
     else:
       fitToAllSliceViews = False
     
-    # we need to convert diameter to mm, we use the minimum spacing to multiply the voxel value
-    minimumDiameterMm = self.__minimumDiameterSpinBox.value * min( currentVolumeNode.GetSpacing() )
-    maximumDiameterMm = self.__maximumDiameterSpinBox.value * min( currentVolumeNode.GetSpacing() )
-
-    alpha = self.logic.alphaFromSuppressPlatesPercentage(self.__suppressPlatesSlider.value)
-    beta = self.logic.alphaFromSuppressPlatesPercentage(self.__suppressBlobsSlider.value)
-    contrastMeasure = self.__contrastSlider.value
-    
-    self.logic.computeVesselnessVolume(currentVolumeNode, currentOutputVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel,
-      minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure)
+    minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure = self.getVesselnessParameters( currentVolumeNode )
 
+    if preview:
+      self.logic.computeVesselnessVolume(currentVolumeNode, currentOutputVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, useScaleSpaceCache=useScaleSpaceCache,
+        usePreviewBlockCache=not useScaleSpaceCache)
+      self.showResults( preview, currentVolumeNode, currentOutputVolumeNode, currentSeedsNode, previewRegionCenterRAS, fitToAllSliceViews )
+    else:
+      # the result is only stored in the output volume when all the steps are completed
+      self.__computationSteps = self.logic.computeVesselnessVolumeSteps(currentVolumeNode, currentOutputVolumeNode,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, progressCallback=self.onComputationProgress,
+        scalesOutputVolumeNode=self.__scalesVolumeNodeSelector.currentNode())
+      self.__computationResult = ( preview, currentVolumeNode, currentOutputVolumeNode, currentSeedsNode, previewRegionCenterRAS, fitToAllSliceViews )
+      self.setComputationInProgress( True )
+      qt.QTimer.singleShot( 0, self.onComputationStep )
+
+  def showResults( self, preview, currentVolumeNode, currentOutputVolumeNode, currentSeedsNode, previewRegionCenterRAS, fitToAllSliceViews ):
     # for preview: show the inputVolume as background and the outputVolume as foreground in the slice viewers
     #    note: that's the only way we can have the preview as an overlay of the originalvolume
     # for not preview: show the outputVolume as background and the inputVolume as foreground in the slice viewers
@@ -392,9 +547,65 @@ class VesselnessFilteringLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Number of scales between minimum and maximum diameter
+  DISCRETIZATION_STEPS = 5
+
+  # Spacing of the scales between minimum and maximum diameter
+  SIGMA_SPACING_LINEAR = 'linear'
+  SIGMA_SPACING_LOGARITHMIC = 'logarithmic'
+
+  # Tiles are extended by this many times the largest scale so that
+  # Gaussian derivatives are not affected by the tile boundary.
+  TILE_HALO_SIGMA_FACTOR = 4.0
+
+  # Approximate memory used by vtkvmtkVesselnessMeasureImageFilter for each input voxel
+  # (float input and output, Hessian and its eigenvalues).
+  VESSELNESS_FILTER_BYTES_PER_VOXEL = 120
+
+  # Filtering from the application event loop (computeVesselnessVolumeSteps) evaluates one scale of a tile
+  # of at most this many voxels (with halo) in each step. The filter cannot be interrupted while it runs,
+  # so this limits how long the user interface does not respond and how long cancelling takes.
+  BACKGROUND_STEP_MAXIMUM_VOXELS = 1 << 22
+
+  # Multiresolution mode evaluates scales that span at least MULTIRESOLUTION_COARSE_SIGMA_VOXEL voxels
+  # of the volume downsampled by MULTIRESOLUTION_SHRINK_FACTOR on the downsampled volume.
+  MULTIRESOLUTION_SHRINK_FACTOR = 2
+  MULTIRESOLUTION_COARSE_SIGMA_VOXEL = 2.0
+
+  # Hessian eigenvalues of the most recently used regions are kept so that
+  # changing only alpha, beta or contrast does not require recomputing them.
+  SCALE_SPACE_CACHE_MAXIMUM_ENTRIES = 4
+  SCALE_SPACE_CACHE_MAXIMUM_MB = 1024
+
+  # Filtered preview regions are kept in blocks of this size so that when the preview region moves
+  # only the blocks that were not filtered before have to be computed. Blocks are small compared to the
+  # preview region, so that the bounding box of the missing blocks is not much larger than the region.
+  PREVIEW_BLOCK_SIZE_VOXEL = 8
+  PREVIEW_BLOCK_CACHE_MAXIMUM_MB = 256
+
+  # Vessel diameter auto-detection only looks at this neighborhood of the seed
+  DIAMETER_DETECTION_MAXIMUM_VOXEL = 50
+  # Support of performLaplaceOfGaussian (Gaussian kernel radius and Laplacian stencil)
+  LAPLACE_OF_GAUSSIAN_MARGIN_VOXEL = 5
+
+  # Number of voxels processed at once in the eigen-analysis
+  EIGENANALYSIS_CHUNK_SIZE = 1 << 18
+
+  # Voxels below this intensity are outside the body (air) in the body mask
+  BODY_MASK_MINIMUM_INTENSITY = -500
+
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
     # the pointer to the logic
+    import collections
+    self.scaleSpaceCache = collections.OrderedDict()
+    self.previewBlockCache = collections.OrderedDict()
+    self.lastPreviewBlockStatistics = None
+    self.lastMultiresolutionStatistics = None
+    self.lastMaskStatistics = None
+    self.lastEvaluatedSigmas = None
+    self.activeVesselnessFilter = None
+    self.computationCancelled = False
 
   def getSeedPositionRAS(self, seedNode):
     if not seedNode:
@@ -416,137 +627,1176 @@ class VesselnessFilteringLogic(ScriptedLoadableModuleLogic):
 
   def computeVesselnessVolume(self, currentVolumeNode, currentOutputVolumeNode,
     previewRegionCenterRAS=None, previewRegionSizeVoxel=-1, minimumDiameterMm=0, maximumDiameterMm=25,
-    alpha=0.3, beta=0.3, contrastMeasure=150):
+    alpha=0.3, beta=0.3, contrastMeasure=150, tiled=False, memoryBudgetMb=2048, numberOfWorkers=1,
+    useScaleSpaceCache=False, multiresolution=False, coarseResponseThreshold=0.05, outputScalarType=None,
+    maskVolumeNode=None, maskThresholdRange=None, bodyMask=False, maskDilationMm=None,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR, adaptiveScales=False, adaptiveScaleTolerance=0.01,
+    usePreviewBlockCache=False, scalesOutputVolumeNode=None, sparseOutputEpsilon=None):
+    '''
+    Computes the vesselness of currentVolumeNode and stores it in currentOutputVolumeNode.
+    Scales are numberOfSigmaSteps (DISCRETIZATION_STEPS by default) diameters between minimumDiameterMm and
+    maximumDiameterMm, with sigmaSpacing SIGMA_SPACING_LINEAR or SIGMA_SPACING_LOGARITHMIC (see getSigmaValues).
+    If previewRegionSizeVoxel>0 then only a cube of that size around previewRegionCenterRAS is processed.
+    If tiled is True then the full volume is processed in blocks so that peak memory usage
+    stays within memoryBudgetMb (see computeVesselnessVolumeTiled).
+    If useScaleSpaceCache is True then Hessian eigenvalues are cached and the response is computed
+    in numpy (see computeVesselnessVolumeFromScaleSpace). This is intended for previews.
+    If usePreviewBlockCache is True then preview regions are filtered in blocks and only blocks that were not
+    filtered with the same parameters before are computed (see computeVesselnessVolumeFromBlockCache).
+    If multiresolution is True then large scales are evaluated on a downsampled volume and small scales
+    only where the coarse response is above coarseResponseThreshold (see computeVesselnessVolumeMultiresolution).
+    If outputScalarType is vtk.VTK_UNSIGNED_CHAR or vtk.VTK_UNSIGNED_SHORT then the output is stored
+    quantized (see quantizeVesselnessVolume).
+    If maskVolumeNode, maskThresholdRange or bodyMask is specified then the full volume is only processed
+    inside the mask, dilated by maskDilationMm (see createVesselnessMask), and the response is zero elsewhere.
+    If adaptiveScales is True then scales are evaluated one by one from the smallest and the evaluation stops
+    when a scale no longer changes the response by more than adaptiveScaleTolerance (see computeVesselnessVolumeAdaptive).
+    The full volume is then filtered in a single run, therefore adaptiveScales cannot be combined with tiled or
+    multiresolution processing.
+    If scalesOutputVolumeNode is specified then the scale (diameter in mm) of the maximum response is stored in it
+    (see storeScalesVolume). The scale map is not available from the multiresolution mode and the preview block cache,
+    the tiled and the single-pass computation are used instead, and it is not computed for sparse output.
+    If sparseOutputEpsilon is specified then the full volume is computed in tiles and returned as a SparseImage
+    that only stores blocks with response above sparseOutputEpsilon. currentOutputVolumeNode is not modified,
+    setSparseVesselnessVolume converts the result to a dense volume, for example for display.
+    '''
 
     logging.debug("Starting Vesselness Filtering: diameter min={0}, max={1}, alpha={2}, beta={3}, contrastMeasure={4}".format(
       minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure))
 
     if not currentVolumeNode:
       raise ValueError("Output volume node is invalid")
+    if adaptiveScales and (tiled or multiresolution) and previewRegionSizeVoxel<=0:
+      raise ValueError("Adaptive scale selection is not available with tiled or multiresolution processing")
+
+    maskArray = None
+    if (maskVolumeNode or maskThresholdRange or bodyMask) and previewRegionSizeVoxel<=0:
+      if useScaleSpaceCache and sparseOutputEpsilon is None:
+        # the scale space computation processes the whole region, the mask would not be used
+        logging.warning("Vesselness mask is ignored when the scale space cache is used")
+      else:
+        if maskDilationMm is None:
+          maskDilationMm = maximumDiameterMm
+        maskArray = self.createVesselnessMask(currentVolumeNode, maskVolumeNode, maskThresholdRange, bodyMask, maskDilationMm)
+
+    if scalesOutputVolumeNode:
+      if sparseOutputEpsilon is not None and previewRegionSizeVoxel<=0:
+        logging.warning("Vesselness scale map is not computed for sparse output")
+      elif multiresolution and previewRegionSizeVoxel<=0 and not useScaleSpaceCache:
+        logging.warning("Vesselness scale map is not available in multiresolution mode, the full resolution is used instead")
+      elif usePreviewBlockCache and previewRegionSizeVoxel>0 and not useScaleSpaceCache:
+        logging.warning("Vesselness scale map is not available from the preview block cache, the preview is filtered without cache")
+
+    if sparseOutputEpsilon is not None and previewRegionSizeVoxel<=0:
+      sparseOutput = SlicerVmtkCommonLib.SparseImage(currentVolumeNode.GetImageData().GetExtent(), currentVolumeNode.GetSpacing(),
+        sparseOutputEpsilon)
+      self.computeVesselnessVolumeTiled(currentVolumeNode, None, minimumDiameterMm, maximumDiameterMm,
+        alpha, beta, contrastMeasure, memoryBudgetMb, numberOfWorkers, maskArray, numberOfSigmaSteps, sigmaSpacing,
+        sparseOutput=sparseOutput)
+      logging.info("Sparse vesselness: {0} blocks, {1:.1%} of the volume, {2:.0f}MB".format(
+        sparseOutput.GetNumberOfBlocks(), sparseOutput.GetFillFraction(), sparseOutput.GetMemorySizeMb()))
+      return sparseOutput
+
+    if useScaleSpaceCache:
+      if previewRegionSizeVoxel>0:
+        regionExtent = self.getPreviewRegionExtent(currentVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel)
+      else:
+        regionExtent = currentVolumeNode.GetImageData().GetExtent()
+      self.computeVesselnessVolumeFromScaleSpace(currentVolumeNode, currentOutputVolumeNode, regionExtent,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing,
+        scalesOutputVolumeNode)
+    elif usePreviewBlockCache and previewRegionSizeVoxel>0 and not scalesOutputVolumeNode:
+      regionExtent = self.getPreviewRegionExtent(currentVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel)
+      self.computeVesselnessVolumeFromBlockCache(currentVolumeNode, currentOutputVolumeNode, regionExtent,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing)
+    elif multiresolution and previewRegionSizeVoxel<=0 and not scalesOutputVolumeNode:
+      self.computeVesselnessVolumeMultiresolution(currentVolumeNode, currentOutputVolumeNode, minimumDiameterMm, maximumDiameterMm,
+        alpha, beta, contrastMeasure, memoryBudgetMb, numberOfWorkers, coarseResponseThreshold, maskArray,
+        numberOfSigmaSteps, sigmaSpacing)
+    elif adaptiveScales:
+      self.computeVesselnessVolumeAdaptive(currentVolumeNode, currentOutputVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing,
+        adaptiveScaleTolerance, maskArray, scalesOutputVolumeNode)
+    elif (tiled or multiresolution or maskArray is not None) and previewRegionSizeVoxel<=0:
+      # masked computation always runs in tiles so that tiles outside the mask can be skipped
+      self.computeVesselnessVolumeTiled(currentVolumeNode, currentOutputVolumeNode, minimumDiameterMm, maximumDiameterMm,
+        alpha, beta, contrastMeasure, memoryBudgetMb, numberOfWorkers, maskArray, numberOfSigmaSteps, sigmaSpacing,
+        scalesOutputVolumeNode)
+    else:
+      self.computeVesselnessVolumeSinglePass(currentVolumeNode, currentOutputVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing, scalesOutputVolumeNode)
 
-    # this image will later hold the inputImage
-    inImage = vtk.vtkImageData()
+    if outputScalarType is not None:
+      self.quantizeVesselnessVolume(currentOutputVolumeNode, outputScalarType)
+    else:
+      currentOutputVolumeNode.RemoveAttribute(SlicerVmtkCommonLib.Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE)
 
-    # if we are in previewMode, we have to cut the ROI first for speed
+  def computeVesselnessVolumeSinglePass(self, currentVolumeNode, currentOutputVolumeNode,
+    previewRegionCenterRAS=None, previewRegionSizeVoxel=-1, minimumDiameterMm=0, maximumDiameterMm=25,
+    alpha=0.3, beta=0.3, contrastMeasure=150, numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR,
+    scalesOutputVolumeNode=None):
+    '''
+    Computes vesselness of the full volume or the preview region with a single filter run.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+
+    # if we are in previewMode, we only process the ROI for speed
     if previewRegionSizeVoxel>0:
-        # we extract the ROI of currentVolumeNode and save it to currentOutputVolumeNode
-        # we work in RAS space
-        imageclipper = vtk.vtkImageConstantPad()
-        imageclipper.SetInputData(currentVolumeNode.GetImageData())
-        previewRegionCenterIJK = self.getIJKFromRAS(currentVolumeNode, previewRegionCenterRAS)
-        previewRegionRadiusVoxel = int(round(previewRegionSizeVoxel/2+0.5))
-        imageclipper.SetOutputWholeExtent(
-          previewRegionCenterIJK[0]-previewRegionRadiusVoxel, previewRegionCenterIJK[0]+previewRegionRadiusVoxel,
-          previewRegionCenterIJK[1]-previewRegionRadiusVoxel, previewRegionCenterIJK[1]+previewRegionRadiusVoxel,
-          previewRegionCenterIJK[2]-previewRegionRadiusVoxel, previewRegionCenterIJK[2]+previewRegionRadiusVoxel)
-        imageclipper.Update()
-        currentOutputVolumeNode.SetAndObserveImageData(imageclipper.GetOutput())
-        currentOutputVolumeNode.CopyOrientation(currentVolumeNode)
-        currentOutputVolumeNode.ShiftImageDataExtentToZeroStart()
-        inImage.DeepCopy(currentOutputVolumeNode.GetImageData())
+        regionExtent = self.getPreviewRegionExtent(currentVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel)
     else:
-        # there was no ROI extraction, so just clone the inputImage
-        inImage.DeepCopy(currentVolumeNode.GetImageData())
-        currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
-
-    # temporarily set spacing to allow vesselness computation performed in physical space
-    inImage.SetSpacing( currentVolumeNode.GetSpacing() )
-
-    # we now compute the vesselness in RAS space, inImage has spacing and origin attached, the diameters are converted to mm
-    # we use RAS space to support anisotropic datasets
-    
-    import vtkvmtkSegmentationPython as vtkvmtkSegmentation
-
-    cast = vtk.vtkImageCast()
-    cast.SetInputData( inImage )
-    cast.SetOutputScalarTypeToFloat()
-    cast.Update()
-    inImage = cast.GetOutput()
-
-    discretizationSteps = 5
-    
-    v = vtkvmtkSegmentation.vtkvmtkVesselnessMeasureImageFilter()
+        regionExtent = inputExtent
+
+    # The filter input is a float view of the region. Nothing is copied if the region is the full volume
+    # and the volume is already float, otherwise the region is cut and cast to float in a single step.
+    # Spacing is set to allow vesselness computation performed in physical space,
+    # the diameters are converted to mm. We use RAS space to support anisotropic datasets.
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    regionArray = numpy.ascontiguousarray(inputArray[self.getArraySlices(inputExtent, regionExtent)], dtype=numpy.float32)
+    inImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(regionArray, currentVolumeNode.GetSpacing())
+
+    v = self.createVesselnessFilter(minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure,
+      numberOfSigmaSteps, sigmaSpacing)
     v.SetInputData( inImage )
-    v.SetSigmaMin( minimumDiameterMm )
-    v.SetSigmaMax( maximumDiameterMm )
-    v.SetNumberOfSigmaSteps( discretizationSteps )
-    v.SetAlpha( alpha )
-    v.SetBeta( beta )
-    v.SetGamma( contrastMeasure )
     v.Update()
 
+    # the filter output is used directly, only the geometry is changed
     outImage = vtk.vtkImageData()
-    outImage.DeepCopy( v.GetOutput() )
-    outImage.GetPointData().GetScalars().Modified()    
+    outImage.ShallowCopy( v.GetOutput() )
+    outImage.GetPointData().GetScalars().Modified()
 
-    # restore Slicer-compliant image spacing
+    # restore Slicer-compliant image geometry
     outImage.SetSpacing( 1, 1, 1 )
+    outImage.SetOrigin( 0, 0, 0 )
+    outImage.SetExtent( regionExtent )
 
     # we set the outImage which has spacing 1,1,1. The ijkToRas matrix of the node will take care of that
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
     currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    if previewRegionSizeVoxel>0:
+        currentOutputVolumeNode.ShiftImageDataExtentToZeroStart()
 
     # save which volume node vesselness filterint result was saved to
     currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
-                  
-    logging.debug( "End of Vesselness Filtering" )
-
 
-  def getDiameter( self, image, ijk ):
-      edgeImage = self.performLaplaceOfGaussian( image )
+    if scalesOutputVolumeNode:
+      scalesImage = vtk.vtkImageData()
+      scalesImage.ShallowCopy( v.GetScalesOutput() )
+      scalesImage.SetSpacing( 1, 1, 1 )
+      scalesImage.SetOrigin( 0, 0, 0 )
+      scalesImage.SetExtent( regionExtent )
+      self.storeScalesVolume(currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage, previewRegionSizeVoxel>0)
 
-      foundDiameter = False
+    logging.debug( "End of Vesselness Filtering" )
 
-      edgeImageSeedValue = edgeImage.GetScalarComponentAsFloat(ijk[0], ijk[1], ijk[2], 0)
-      seedValueSign = cmp( edgeImageSeedValue, 0 )  # returns 1 if >0 or -1 if <0
+  def setSparseVesselnessVolume(self, currentVolumeNode, currentOutputVolumeNode, sparseVesselness):
+    '''
+    Stores a sparse vesselness result of currentVolumeNode (see computeVesselnessVolume) as a dense
+    volume in currentOutputVolumeNode.
+    '''
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( sparseVesselness.GetDenseImageData() )
+    currentOutputVolumeNode.RemoveAttribute(SlicerVmtkCommonLib.Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE)
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
 
-      # the list of hits
-      # [left, right, top, bottom, front, back]
-      hits = [False, False, False, False, False, False]
+  def storeScalesVolume(self, currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage, shiftToZeroStart=False):
+    '''
+    Stores the scale of the maximum response (scalesImage, with the same extent as the vesselness image)
+    in scalesOutputVolumeNode. Voxels without vesselness response get scale 0.
+    The input and the vesselness volumes refer to the scales volume with the
+    Helper.VESSELNESS_SCALES_REFERENCE_ROLE reference, see Helper.GetVesselnessScaleAtRAS.
+    '''
+    scalesArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(scalesImage)
+    responseArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(currentOutputVolumeNode.GetImageData())
+    scalesArray[responseArray <= 0] = 0
+    scalesImage.GetPointData().GetScalars().Modified()
+
+    scalesOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    scalesOutputVolumeNode.SetAndObserveImageData( scalesImage )
+    if shiftToZeroStart:
+      scalesOutputVolumeNode.ShiftImageDataExtentToZeroStart()
+    currentVolumeNode.SetAndObserveNodeReferenceID(SlicerVmtkCommonLib.Helper.VESSELNESS_SCALES_REFERENCE_ROLE, scalesOutputVolumeNode.GetID())
+    currentOutputVolumeNode.SetAndObserveNodeReferenceID(SlicerVmtkCommonLib.Helper.VESSELNESS_SCALES_REFERENCE_ROLE, scalesOutputVolumeNode.GetID())
+
+  def computeVesselnessVolumeAdaptive(self, currentVolumeNode, currentOutputVolumeNode,
+    previewRegionCenterRAS=None, previewRegionSizeVoxel=-1, minimumDiameterMm=0, maximumDiameterMm=25,
+    alpha=0.3, beta=0.3, contrastMeasure=150, numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR,
+    tolerance=0.01, maskArray=None, scalesOutputVolumeNode=None):
+    '''
+    Computes vesselness of the full volume or the preview region by evaluating the scales one at a time,
+    from the smallest. Evaluation stops when a scale increases the per-voxel maximum response by less than
+    tolerance times the maximum response anywhere in the mask (maskArray, see createVesselnessMask, or the
+    whole region). Scales above the diameter of the largest vessel in the region do not change the response
+    any more, so for narrow vessels only a few Hessian passes are needed.
+    The result is the same as in computeVesselnessVolumeSinglePass if no scale is skipped.
+    Evaluated scales are stored in lastEvaluatedSigmas.
+    If scalesOutputVolumeNode is specified then the scale of the maximum response is stored in it.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+    if previewRegionSizeVoxel>0:
+      regionExtent = self.getPreviewRegionExtent(currentVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel)
+      maskArray = None
+    else:
+      regionExtent = inputExtent
+
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    regionArray = numpy.ascontiguousarray(inputArray[self.getArraySlices(inputExtent, regionExtent)], dtype=numpy.float32)
+    inImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(regionArray, currentVolumeNode.GetSpacing())
+
+    sigmas = self.getSigmaValues(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps, sigmaSpacing)
+    response = None
+    scales = None
+    evaluatedSigmas = []
+    for sigma in sigmas:
+      v = self.createVesselnessFilter(sigma, sigma, alpha, beta, contrastMeasure, 1)
+      v.SetInputData( inImage )
+      v.Update()
+      scaleResponse = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(v.GetOutput())
+      evaluatedSigmas.append(sigma)
+      if response is None:
+        response = numpy.array(scaleResponse, dtype=numpy.float32)
+        scales = numpy.full(response.shape, sigma, dtype=numpy.float32)
+        continue
+      increase = scaleResponse - response
+      scales[increase > 0] = sigma
+      numpy.maximum(response, scaleResponse, out=response)
+      if maskArray is not None:
+        maximumIncrease = float(increase[maskArray].max()) if maskArray.any() else 0.0
+        maximumResponse = float(response[maskArray].max()) if maskArray.any() else 0.0
+      else:
+        maximumIncrease = float(increase.max())
+        maximumResponse = float(response.max())
+      if maximumIncrease <= tolerance * maximumResponse:
+        break
+
+    self.lastEvaluatedSigmas = evaluatedSigmas
+    logging.info("Adaptive vesselness filtering: evaluated {0} of {1} scales: {2}".format(len(evaluatedSigmas), len(sigmas), evaluatedSigmas))
+
+    if maskArray is not None:
+      response[~maskArray] = 0
+    outImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(response, extentStart=regionExtent[0::2])
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    if previewRegionSizeVoxel>0:
+      currentOutputVolumeNode.ShiftImageDataExtentToZeroStart()
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
 
-      distanceFromSeed = 1
-      while not foundDiameter:
+    if scalesOutputVolumeNode:
+      scalesImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(scales, extentStart=regionExtent[0::2])
+      self.storeScalesVolume(currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage, previewRegionSizeVoxel>0)
+
+  def quantizeVesselnessVolume(self, vesselnessVolumeNode, outputScalarType=vtk.VTK_UNSIGNED_CHAR):
+    '''
+    Replaces the float vesselness image by an 8-bit (VTK_UNSIGNED_CHAR) or 16-bit (VTK_UNSIGNED_SHORT) image,
+    reducing memory and disk usage by 4x or 2x. Stored value is round(response * scale), where scale maps the
+    maximum response to the maximum stored value. The scale is saved in the node attribute
+    Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE, Helper.GetVesselnessQuantizationScale returns it.
+    The absolute error of the response is at most 0.5/scale (half quantization step), therefore thresholding
+    the stored values at threshold*scale selects the same voxels as thresholding the float response at
+    threshold, except voxels with response within half a quantization step of the threshold.
+    '''
+    quantizedTypes = { vtk.VTK_UNSIGNED_CHAR: numpy.uint8, vtk.VTK_UNSIGNED_SHORT: numpy.uint16 }
+    if outputScalarType not in quantizedTypes:
+      raise ValueError("Vesselness can only be quantized to unsigned char or unsigned short")
+    quantizedType = quantizedTypes[outputScalarType]
+    maximumStoredValue = numpy.iinfo(quantizedType).max
+
+    responseArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(vesselnessVolumeNode.GetImageData())
+    maximumResponse = float(responseArray.max())
+    scale = maximumStoredValue / maximumResponse if maximumResponse > 0 else 1.0
+
+    # convert slice by slice to avoid allocating a float temporary image
+    quantizedArray = numpy.empty(responseArray.shape, dtype=quantizedType)
+    for k in range(responseArray.shape[0]):
+      quantizedArray[k] = numpy.clip(numpy.rint(responseArray[k] * scale), 0, maximumStoredValue)
+
+    quantizedImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(quantizedArray,
+      extentStart=vesselnessVolumeNode.GetImageData().GetExtent()[0::2])
+    vesselnessVolumeNode.SetAndObserveImageData( quantizedImage )
+    vesselnessVolumeNode.SetAttribute(SlicerVmtkCommonLib.Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE, repr(scale))
+    logging.debug("Vesselness quantized with scale {0}".format(scale))
+
+  def getTileHaloVoxel(self, spacing, maximumDiameterMm):
+    '''
+    Number of voxels along each axis that a tile must be extended by so that the Gaussian derivatives
+    of the largest scale are not affected by the tile boundary.
+    '''
+    return [int(math.ceil(self.TILE_HALO_SIGMA_FACTOR * maximumDiameterMm / spacing[axis])) for axis in range(3)]
+
+  def getTileSizeVoxel(self, dimensions, haloVoxel, memoryBudgetMb, numberOfWorkers=1):
+    '''
+    Largest tile size (without halo) for which numberOfWorkers tiles can be processed
+    at the same time without exceeding memoryBudgetMb.
+    '''
+    maximumVoxelsPerTile = memoryBudgetMb * 1024.0 * 1024.0 / numberOfWorkers / self.VESSELNESS_FILTER_BYTES_PER_VOXEL
+    tileSize = list(dimensions)
+    while True:
+      haloedTileSize = [min(tileSize[axis] + 2 * haloVoxel[axis], dimensions[axis]) for axis in range(3)]
+      if haloedTileSize[0] * haloedTileSize[1] * haloedTileSize[2] <= maximumVoxelsPerTile:
+        return tileSize
+      # split the longest axis
+      longestAxis = tileSize.index(max(tileSize))
+      if tileSize[longestAxis] <= 1:
+        raise ValueError("Memory budget of {0}MB is too small for vesselness filtering with a halo of {1} voxels".format(memoryBudgetMb, haloVoxel))
+      tileSize[longestAxis] = (tileSize[longestAxis] + 1) // 2
+
+  def getTiles(self, extent, tileSize, haloVoxel):
+    '''
+    Splits extent into tiles. Returns a list of (coreExtent, haloedExtent) pairs,
+    where haloedExtent is coreExtent extended by haloVoxel and clamped to extent.
+    '''
+    tiles = []
+    for kStart in range(extent[4], extent[5] + 1, tileSize[2]):
+      for jStart in range(extent[2], extent[3] + 1, tileSize[1]):
+        for iStart in range(extent[0], extent[1] + 1, tileSize[0]):
+          coreExtent = [iStart, min(iStart + tileSize[0] - 1, extent[1]),
+                        jStart, min(jStart + tileSize[1] - 1, extent[3]),
+                        kStart, min(kStart + tileSize[2] - 1, extent[5])]
+          haloedExtent = []
+          for axis in range(3):
+            haloedExtent.append(max(coreExtent[axis * 2] - haloVoxel[axis], extent[axis * 2]))
+            haloedExtent.append(min(coreExtent[axis * 2 + 1] + haloVoxel[axis], extent[axis * 2 + 1]))
+          tiles.append((coreExtent, haloedExtent))
+    return tiles
+
+  def createVesselnessFilter(self, minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps=None,
+    sigmaSpacing=SIGMA_SPACING_LINEAR):
+    import vtkvmtkSegmentationPython as vtkvmtkSegmentation
+    if sigmaSpacing == self.SIGMA_SPACING_LOGARITHMIC and minimumDiameterMm <= 0:
+      raise ValueError("Logarithmic sigma spacing requires a positive minimum diameter")
+    if numberOfSigmaSteps is None:
+      numberOfSigmaSteps = self.DISCRETIZATION_STEPS
+    v = vtkvmtkSegmentation.vtkvmtkVesselnessMeasureImageFilter()
+    v.SetSigmaMin( minimumDiameterMm )
+    v.SetSigmaMax( maximumDiameterMm )
+    v.SetNumberOfSigmaSteps( numberOfSigmaSteps )
+    if sigmaSpacing == self.SIGMA_SPACING_LOGARITHMIC:
+      v.SetSigmaStepMethodToLogarithmic()
+    elif sigmaSpacing == self.SIGMA_SPACING_LINEAR:
+      v.SetSigmaStepMethodToEquispaced()
+    else:
+      raise ValueError("Unknown sigma spacing: {0}".format(sigmaSpacing))
+    v.SetAlpha( alpha )
+    v.SetBeta( beta )
+    v.SetGamma( contrastMeasure )
+    return v
+
+  def computeVesselnessTile(self, inputArray, inputExtent, spacing, coreExtent, haloedExtent,
+    minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps=None, progressCallback=None,
+    sigmaSpacing=SIGMA_SPACING_LINEAR, returnScales=False):
+    '''
+    Computes vesselness in haloedExtent of inputArray (numpy array of the image with inputExtent)
+    and returns the response in coreExtent as a float32 numpy array indexed [k, j, i].
+    If returnScales is True then a (response, scales) tuple is returned, scales is the scale of the maximum response.
+    If progressCallback is specified then it is called with the progress of the filter (between 0 and 1).
+    '''
+    # the tile is cut and cast to float in one step, the input image is only read
+    haloedSlices = self.getArraySlices(inputExtent, haloedExtent)
+    tileArray = numpy.ascontiguousarray(inputArray[haloedSlices], dtype=numpy.float32)
+    tileImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(tileArray, spacing)
+
+    v = self.createVesselnessFilter(minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure,
+      numberOfSigmaSteps, sigmaSpacing)
+    v.SetInputData( tileImage )
+    if progressCallback:
+      v.AddObserver( vtk.vtkCommand.ProgressEvent, lambda caller, event: progressCallback(caller.GetProgress()) )
+      # allow cancelling the filter while it is running
+      self.activeVesselnessFilter = v
+    v.Update()
+    self.activeVesselnessFilter = None
+
+    coreSlices = self.getArraySlices(haloedExtent, coreExtent)
+    responseArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(v.GetOutput())
+    response = numpy.array(responseArray[coreSlices], dtype=numpy.float32)
+    if returnScales:
+      scalesArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(v.GetScalesOutput())
+      return response, numpy.array(scalesArray[coreSlices], dtype=numpy.float32)
+    return response
+
+  def computeVesselnessVolumeSteps(self, currentVolumeNode, currentOutputVolumeNode, minimumDiameterMm=0, maximumDiameterMm=25,
+    alpha=0.3, beta=0.3, contrastMeasure=150, memoryBudgetMb=2048, progressCallback=None,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR, scalesOutputVolumeNode=None):
+    '''
+    Same computation as computeVesselnessVolumeTiled, as a generator that yields the completed fraction
+    of the work after each step. This allows running the filtering from the application event loop.
+    Each step evaluates one scale in one tile, tiles have at most BACKGROUND_STEP_MAXIMUM_VOXELS voxels, and
+    the response is the maximum over the scales, as in computeVesselnessVolumeAdaptive. progressCallback
+    is called with the completed fraction while a step is being processed.
+    As with computeVesselnessVolumeTiled, the result differs from the single-pass result by the truncation
+    of the Gaussian derivative kernels at the tile halo.
+    The result is stored in currentOutputVolumeNode after the last step, cancelComputation() stops
+    the processing after the current step without modifying currentOutputVolumeNode.
+    '''
+    self.computationCancelled = False
+
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    spacing = currentVolumeNode.GetSpacing()
+
+    haloVoxel = self.getTileHaloVoxel(spacing, maximumDiameterMm)
+    stepMemoryBudgetMb = min(memoryBudgetMb,
+      self.BACKGROUND_STEP_MAXIMUM_VOXELS * self.VESSELNESS_FILTER_BYTES_PER_VOXEL / 1024.0 / 1024.0)
+    tileSize = self.getTileSizeVoxel(inputImage.GetDimensions(), haloVoxel, stepMemoryBudgetMb)
+    tiles = self.getTiles(inputExtent, tileSize, haloVoxel)
+    sigmas = self.getSigmaValues(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps, sigmaSpacing)
+    numberOfSteps = len(tiles) * len(sigmas)
 
-          if ( distanceFromSeed >= edgeImage.GetDimensions()[0]
-              or distanceFromSeed >= edgeImage.GetDimensions()[1]
-              or distanceFromSeed >= edgeImage.GetDimensions()[2] ):
-              # we are out of bounds
-              break
+    outImage = vtk.vtkImageData()
+    outImage.SetExtent( inputExtent )
+    outImage.AllocateScalars( vtk.VTK_FLOAT, 1 )
+    outArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(outImage)
+    if scalesOutputVolumeNode:
+      scalesImage = vtk.vtkImageData()
+      scalesImage.SetExtent( inputExtent )
+      scalesImage.AllocateScalars( vtk.VTK_FLOAT, 1 )
+      scalesArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(scalesImage)
+
+    for tileIndex, (coreExtent, haloedExtent) in enumerate(tiles):
+      coreSlices = self.getArraySlices(inputExtent, coreExtent)
+      coreArray = outArray[coreSlices]
+      for sigmaIndex, sigma in enumerate(sigmas):
+        stepIndex = tileIndex * len(sigmas) + sigmaIndex
+        stepProgressCallback = None
+        if progressCallback:
+          stepProgressCallback = lambda stepProgress: progressCallback(float(stepIndex + stepProgress) / numberOfSteps)
+        scaleResponse = self.computeVesselnessTile(inputArray, inputExtent, spacing, coreExtent, haloedExtent,
+          sigma, sigma, alpha, beta, contrastMeasure, 1, stepProgressCallback)
+        if self.computationCancelled:
+          return
+        if sigmaIndex == 0:
+          coreArray[:] = scaleResponse
+          if scalesOutputVolumeNode:
+            scalesArray[coreSlices] = sigma
+        else:
+          if scalesOutputVolumeNode:
+            scalesArray[coreSlices][scaleResponse > coreArray] = sigma
+          numpy.maximum(coreArray, scaleResponse, out=coreArray)
+        yield float(stepIndex + 1) / numberOfSteps
+
+    outImage.GetPointData().GetScalars().Modified()
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    currentOutputVolumeNode.RemoveAttribute(SlicerVmtkCommonLib.Helper.VESSELNESS_QUANTIZATION_SCALE_ATTRIBUTE)
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
+    if scalesOutputVolumeNode:
+      self.storeScalesVolume(currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage)
+
+  def cancelComputation(self):
+    '''
+    Requests stopping of computeVesselnessVolumeSteps. The filter that is running is not interrupted,
+    the computation stops when it is completed (see BACKGROUND_STEP_MAXIMUM_VOXELS).
+    '''
+    self.computationCancelled = True
+    if self.activeVesselnessFilter:
+      self.activeVesselnessFilter.AbortExecuteOn()
+
+  def isComputationCancelled(self):
+    return self.computationCancelled
+
+  def processTiles(self, processTile, tiles, numberOfWorkers=1):
+    '''
+    Calls processTile for each tile, on a pool of numberOfWorkers threads.
+    '''
+    if numberOfWorkers > 1 and len(tiles) > 1:
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(numberOfWorkers)
+      try:
+        pool.map(processTile, tiles)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for tile in tiles:
+        processTile(tile)
+
+  def getArraySlices(self, arrayExtent, regionExtent):
+    '''
+    Returns the [k, j, i] slices that select regionExtent from an array that covers arrayExtent.
+    '''
+    return (slice(regionExtent[4] - arrayExtent[4], regionExtent[5] - arrayExtent[4] + 1),
+            slice(regionExtent[2] - arrayExtent[2], regionExtent[3] - arrayExtent[2] + 1),
+            slice(regionExtent[0] - arrayExtent[0], regionExtent[1] - arrayExtent[0] + 1))
+
+  def computeVesselnessVolumeTiled(self, currentVolumeNode, currentOutputVolumeNode, minimumDiameterMm=0, maximumDiameterMm=25,
+    alpha=0.3, beta=0.3, contrastMeasure=150, memoryBudgetMb=2048, numberOfWorkers=1, maskArray=None,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR, scalesOutputVolumeNode=None, sparseOutput=None):
+    '''
+    Computes vesselness of the full volume in tiles. Each tile is extended by a halo of
+    TILE_HALO_SIGMA_FACTOR*maximumDiameterMm, therefore the stitched result matches the
+    single-pass result up to the truncation of the Gaussian derivative kernels at the halo.
+    Tiles are processed by numberOfWorkers threads. Tile size is chosen so that the filters running
+    at the same time do not use more than memoryBudgetMb (the input and output volumes are not included).
+    Filters only run in parallel if the VTK Python wrapping releases the interpreter lock,
+    the vesselness filter itself is multithreaded anyway.
+    If maskArray (boolean numpy array indexed [k, j, i], see createVesselnessMask) is specified then tiles
+    are shrunk to the bounding box of the mask voxels they contain, tiles without mask voxels are skipped
+    and the response is set to zero outside the mask.
+    If scalesOutputVolumeNode is specified then the scale of the maximum response is stored in it.
+    If sparseOutput (SparseImage) is specified then the tiles are stored in it instead of currentOutputVolumeNode,
+    the dense output volume is not allocated.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    spacing = currentVolumeNode.GetSpacing()
+
+    haloVoxel = self.getTileHaloVoxel(spacing, maximumDiameterMm)
+    tileSize = self.getTileSizeVoxel(inputImage.GetDimensions(), haloVoxel, memoryBudgetMb, numberOfWorkers)
+    tiles = self.getTiles(inputExtent, tileSize, haloVoxel)
+    logging.debug("Tiled vesselness filtering: {0} tiles of {1} voxels, halo {2} voxels".format(len(tiles), tileSize, haloVoxel))
+
+    if sparseOutput is None:
+      outImage = vtk.vtkImageData()
+      outImage.SetExtent( inputExtent )
+      outImage.AllocateScalars( vtk.VTK_FLOAT, 1 )
+      outArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(outImage)
+
+    if scalesOutputVolumeNode:
+      scalesImage = vtk.vtkImageData()
+      scalesImage.SetExtent( inputExtent )
+      scalesImage.AllocateScalars( vtk.VTK_FLOAT, 1 )
+      scalesArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(scalesImage)
+      scalesArray[:] = 0
+
+    if maskArray is not None:
+      if sparseOutput is None:
+        outArray[:] = 0
+      numberOfTiles = len(tiles)
+      tiles = self.getMaskedTiles(maskArray, inputExtent, tiles, haloVoxel)
+      self.updateMaskStatistics(maskArray, tiles, numberOfTiles)
+
+    def processTile(tile):
+      coreExtent, haloedExtent = tile
+      coreSlices = self.getArraySlices(inputExtent, coreExtent)
+      response = self.computeVesselnessTile(inputArray, inputExtent, spacing,
+        coreExtent, haloedExtent, minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure,
+        numberOfSigmaSteps, sigmaSpacing=sigmaSpacing, returnScales=bool(scalesOutputVolumeNode))
+      if scalesOutputVolumeNode:
+        response, scales = response
+        scalesArray[coreSlices] = scales
+      if maskArray is not None:
+        response[~maskArray[coreSlices]] = 0
+      if sparseOutput is None:
+        outArray[coreSlices] = response
+      else:
+        sparseOutput.SetRegion(response, coreExtent)
+
+    self.processTiles(processTile, tiles, numberOfWorkers)
+    if sparseOutput is not None:
+      return
 
-          # get the values for the lookahead directions in the edgeImage
-          edgeValues = [edgeImage.GetScalarComponentAsFloat( ijk[0] - distanceFromSeed, ijk[1], ijk[2], 0 ),  # left
-                        edgeImage.GetScalarComponentAsFloat( ijk[0] + distanceFromSeed, ijk[1], ijk[2], 0 ),  # right
-                        edgeImage.GetScalarComponentAsFloat( ijk[0], ijk[1] + distanceFromSeed, ijk[2], 0 ),  # top
-                        edgeImage.GetScalarComponentAsFloat( ijk[0], ijk[1] - distanceFromSeed, ijk[2], 0 ),  # bottom
-                        edgeImage.GetScalarComponentAsFloat( ijk[0], ijk[1], ijk[2] + distanceFromSeed, 0 ),  # front
-                        edgeImage.GetScalarComponentAsFloat( ijk[0], ijk[1], ijk[2] - distanceFromSeed, 0 )]  # back
+    outImage.GetPointData().GetScalars().Modified()
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
+    if scalesOutputVolumeNode:
+      self.storeScalesVolume(currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage)
+
+    logging.debug( "End of tiled Vesselness Filtering" )
+
+  def createVesselnessMask(self, volumeNode, maskVolumeNode=None, maskThresholdRange=None, bodyMask=False, dilationMm=0):
+    '''
+    Returns a boolean numpy array (indexed [k, j, i]) of the voxels of volumeNode where vesselness is computed.
+    The mask is the intersection of the specified criteria:
+    - maskVolumeNode: non-zero voxels of a label map or scalar volume with the same dimensions as volumeNode;
+    - maskThresholdRange: (lower, upper) intensity range of volumeNode;
+    - bodyMask: voxels of volumeNode with intensity of at least BODY_MASK_MINIMUM_INTENSITY (excludes air).
+    The mask is dilated by dilationMm so that vessels at the boundary of the mask are fully included.
+    '''
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(volumeNode.GetImageData())
+    maskArray = numpy.ones(inputArray.shape, dtype=bool)
+    if maskVolumeNode:
+      if maskVolumeNode.GetImageData().GetDimensions() != volumeNode.GetImageData().GetDimensions():
+        raise ValueError("Mask volume {0} has different dimensions than input volume {1}".format(
+          maskVolumeNode.GetName(), volumeNode.GetName()))
+      maskArray &= SlicerVmtkCommonLib.Helper.GetImageDataAsArray(maskVolumeNode.GetImageData()) != 0
+    if maskThresholdRange:
+      maskArray &= inputArray >= maskThresholdRange[0]
+      maskArray &= inputArray <= maskThresholdRange[1]
+    if bodyMask:
+      maskArray &= inputArray >= self.BODY_MASK_MINIMUM_INTENSITY
+
+    spacing = volumeNode.GetSpacing()
+    dilationVoxel = [int(math.ceil(dilationMm / spacing[axis])) for axis in range(3)]
+    self.dilateMask(maskArray, dilationVoxel)
+    return maskArray
+
+  def dilateMask(self, maskArray, radiusVoxel):
+    '''
+    Dilates maskArray (indexed [k, j, i]) in place with a box of radiusVoxel (i, j, k) half size.
+    The box is separable, along each axis the mask is combined with shifted copies of itself,
+    doubling the shift each time, so only about 2*log2(radius) passes are needed.
+    '''
+    for axis, radius in zip((2, 1, 0), radiusVoxel):
+      reach = 0
+      while reach < radius:
+        shift = min(reach + 1, radius - reach)
+        forward = [slice(None)] * 3
+        backward = [slice(None)] * 3
+        forward[axis] = slice(shift, None)
+        backward[axis] = slice(None, -shift)
+        shifted = maskArray.copy()
+        shifted[tuple(forward)] |= maskArray[tuple(backward)]
+        shifted[tuple(backward)] |= maskArray[tuple(forward)]
+        maskArray[:] = shifted
+        reach += shift
+
+  def getMaskedTiles(self, maskArray, extent, tiles, haloVoxel):
+    '''
+    Returns the tiles that contain mask voxels, with the core shrunk to the bounding box of these voxels
+    and the halo recomputed around it.
+    '''
+    maskedTiles = []
+    for coreExtent, haloedExtent in tiles:
+      coreMask = maskArray[self.getArraySlices(extent, coreExtent)]
+      if not coreMask.any():
+        continue
+      maskedCoreExtent = []
+      # array axes are k, j, i
+      for axis, arrayAxis in ((0, 2), (1, 1), (2, 0)):
+        otherAxes = tuple(a for a in range(3) if a != arrayAxis)
+        indices = numpy.nonzero(coreMask.any(axis=otherAxes))[0]
+        maskedCoreExtent.append(coreExtent[axis * 2] + int(indices[0]))
+        maskedCoreExtent.append(coreExtent[axis * 2] + int(indices[-1]))
+      maskedHaloedExtent = []
+      for axis in range(3):
+        maskedHaloedExtent.append(max(maskedCoreExtent[axis * 2] - haloVoxel[axis], extent[axis * 2]))
+        maskedHaloedExtent.append(min(maskedCoreExtent[axis * 2 + 1] + haloVoxel[axis], extent[axis * 2 + 1]))
+      maskedTiles.append((maskedCoreExtent, maskedHaloedExtent))
+    return maskedTiles
+
+  def updateMaskStatistics(self, maskArray, maskedTiles, numberOfTiles):
+    '''
+    Logs and stores in lastMaskStatistics how much of the volume was excluded by the mask.
+    numberOfTiles is the number of tiles before masking. skippedFraction is the fraction of the voxels
+    of the volume that are not in the core of any processed tile. Tile cores do not overlap, so each voxel
+    is counted once, halo voxels are only counted if they are in the core of another processed tile.
+    '''
+    numberOfVoxels = maskArray.size
+    numberOfProcessedVoxels = 0
+    for coreExtent, haloedExtent in maskedTiles:
+      numberOfProcessedVoxels += ((coreExtent[1] - coreExtent[0] + 1) * (coreExtent[3] - coreExtent[2] + 1)
+        * (coreExtent[5] - coreExtent[4] + 1))
+    self.lastMaskStatistics = {
+      'maskedFraction': float(numpy.count_nonzero(maskArray)) / numberOfVoxels,
+      'numberOfTiles': numberOfTiles, 'numberOfSkippedTiles': numberOfTiles - len(maskedTiles),
+      'skippedFraction': 1.0 - float(numberOfProcessedVoxels) / numberOfVoxels }
+    logging.info("Masked vesselness filtering: mask covers {0:.1%} of the volume, {1} of {2} tiles skipped, {3:.1%} of voxels skipped".format(
+      self.lastMaskStatistics['maskedFraction'], self.lastMaskStatistics['numberOfSkippedTiles'], numberOfTiles,
+      self.lastMaskStatistics['skippedFraction']))
+
+  def computeVesselnessVolumeMultiresolution(self, currentVolumeNode, currentOutputVolumeNode, minimumDiameterMm=0, maximumDiameterMm=25,
+    alpha=0.3, beta=0.3, contrastMeasure=150, memoryBudgetMb=2048, numberOfWorkers=1, coarseResponseThreshold=0.05,
+    maskArray=None, numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR):
+    '''
+    Coarse-to-fine vesselness computation.
+    Scales that are at least MULTIRESOLUTION_COARSE_SIGMA_VOXEL voxels of a volume downsampled by
+    MULTIRESOLUTION_SHRINK_FACTOR are evaluated on the downsampled volume and linearly interpolated back.
+    Fine scales are evaluated in tiles (see computeVesselnessVolumeTiled), but only in tiles where the coarse
+    response reaches coarseResponseThreshold times its maximum. The result is the maximum of the two.
+
+    The result is an approximation of computeVesselnessVolume, the difference is not bounded:
+    - in tiles where fine scales are evaluated the fine-scale response is the same as the tiled result;
+    - the coarse-scale response is computed on a block-averaged volume and interpolated back, so it is
+      smoothed over MULTIRESOLUTION_SHRINK_FACTOR voxels. It differs most at vessel boundaries and where
+      structures smaller than the downsampling blocks are close to each other;
+    - in skipped tiles only the coarse response is used, fine vessels that are not near a vessel of
+      coarse scale are missing from the result. The number of tiles skipped because of the coarse
+      response and because of the mask is logged and stored in lastMultiresolutionStatistics.
+    test_MultiresolutionVesselness compares the result to the single-resolution result on a synthetic tube.
+    If maskArray is specified then fine scales are only evaluated in tiles that contain mask voxels
+    (see computeVesselnessVolumeTiled) and the response is set to zero outside the mask.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    spacing = currentVolumeNode.GetSpacing()
+    shrinkFactor = self.MULTIRESOLUTION_SHRINK_FACTOR
+
+    sigmas = self.getSigmaValues(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps, sigmaSpacing)
+    coarseSigmaMinimumMm = self.MULTIRESOLUTION_COARSE_SIGMA_VOXEL * shrinkFactor * max(spacing)
+    fineSigmas = [sigma for sigma in sigmas if sigma < coarseSigmaMinimumMm]
+    coarseSigmas = [sigma for sigma in sigmas if sigma >= coarseSigmaMinimumMm]
+    logging.debug("Multiresolution vesselness filtering: fine scales {0}, coarse scales {1}".format(fineSigmas, coarseSigmas))
 
-          # first loop, check if we have hits
-          for v in range( len( edgeValues ) ):
+    outImage = vtk.vtkImageData()
+    outImage.SetExtent( inputExtent )
+    outImage.AllocateScalars( vtk.VTK_FLOAT, 1 )
+    outArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(outImage)
+    outArray[:] = 0
+
+    if coarseSigmas:
+      outArray[:] = self.computeCoarseVesselness(inputArray, spacing, shrinkFactor,
+        coarseSigmas, alpha, beta, contrastMeasure, sigmaSpacing)
+    coarseResponseMaximum = float(outArray.max())
+
+    numberOfTiles = 0
+    numberOfFineTiles = 0
+    numberOfCoarseSkippedTiles = 0
+    numberOfMaskSkippedTiles = 0
+    if fineSigmas:
+      haloVoxel = self.getTileHaloVoxel(spacing, fineSigmas[-1])
+      tileSize = self.getTileSizeVoxel(inputImage.GetDimensions(), haloVoxel, memoryBudgetMb, numberOfWorkers)
+      tiles = self.getTiles(inputExtent, tileSize, haloVoxel)
+      if coarseSigmas:
+        # only keep tiles where there is a vessel at coarse scale
+        selectedTiles = [tile for tile in tiles
+          if outArray[self.getArraySlices(inputExtent, tile[0])].max() >= coarseResponseThreshold * coarseResponseMaximum]
+      else:
+        selectedTiles = tiles
+      numberOfTiles = len(tiles)
+      numberOfCoarseSkippedTiles = len(tiles) - len(selectedTiles)
+      if maskArray is not None:
+        numberOfUnmaskedTiles = len(selectedTiles)
+        selectedTiles = self.getMaskedTiles(maskArray, inputExtent, selectedTiles, haloVoxel)
+        self.updateMaskStatistics(maskArray, selectedTiles, numberOfUnmaskedTiles)
+        numberOfMaskSkippedTiles = numberOfUnmaskedTiles - len(selectedTiles)
+      numberOfFineTiles = len(selectedTiles)
+
+      def processTile(tile):
+        coreExtent, haloedExtent = tile
+        fineResponse = self.computeVesselnessTile(inputArray, inputExtent, spacing, coreExtent, haloedExtent,
+          fineSigmas[0], fineSigmas[-1], alpha, beta, contrastMeasure, len(fineSigmas), sigmaSpacing=sigmaSpacing)
+        coreArray = outArray[self.getArraySlices(inputExtent, coreExtent)]
+        numpy.maximum(coreArray, fineResponse, out=coreArray)
+
+      self.processTiles(processTile, selectedTiles, numberOfWorkers)
+
+    if maskArray is not None:
+      outArray[~maskArray] = 0
+
+    self.lastMultiresolutionStatistics = {
+      'fineSigmas': fineSigmas, 'coarseSigmas': coarseSigmas,
+      'numberOfTiles': numberOfTiles, 'numberOfFineTiles': numberOfFineTiles,
+      'numberOfCoarseSkippedTiles': numberOfCoarseSkippedTiles, 'numberOfMaskSkippedTiles': numberOfMaskSkippedTiles }
+    logging.info("Multiresolution vesselness filtering: fine scales evaluated in {0} of {1} tiles, skipped in {2} tiles"
+      " below the coarse response threshold and {3} tiles outside the mask".format(
+      numberOfFineTiles, numberOfTiles, numberOfCoarseSkippedTiles, numberOfMaskSkippedTiles))
+
+    outImage.GetPointData().GetScalars().Modified()
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
 
-              if not hits[v] and cmp( edgeValues[v], 0 ) != seedValueSign:
-                  # hit
-                  hits[v] = True
+  def computeCoarseVesselness(self, inputArray, spacing, shrinkFactor, sigmas, alpha, beta, contrastMeasure,
+    sigmaSpacing=SIGMA_SPACING_LINEAR):
+    '''
+    Evaluates vesselness at the given scales on inputArray downsampled by shrinkFactor
+    and returns the response interpolated to the resolution of inputArray.
+    '''
+    # downsample by block averaging, trailing voxels that do not fill a whole block are dropped
+    coarseShape = [max(size // shrinkFactor, 1) for size in inputArray.shape]
+    blocks = inputArray[:coarseShape[0] * shrinkFactor, :coarseShape[1] * shrinkFactor, :coarseShape[2] * shrinkFactor]
+    blocks = blocks.reshape(coarseShape[0], shrinkFactor, coarseShape[1], shrinkFactor, coarseShape[2], shrinkFactor)
+    coarseArray = numpy.ascontiguousarray(blocks.mean(axis=(1, 3, 5), dtype=numpy.float32))
+    coarseSpacing = [spacing[axis] * shrinkFactor for axis in range(3)]
+    coarseImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(coarseArray, coarseSpacing)
+    # a block average is located at the center of the block
+    coarseImage.SetOrigin([(shrinkFactor - 1) * 0.5 * spacing[axis] for axis in range(3)])
+
+    v = self.createVesselnessFilter(sigmas[0], sigmas[-1], alpha, beta, contrastMeasure, len(sigmas), sigmaSpacing)
+    v.SetInputData( coarseImage )
+    v.Update()
+    coarseResponse = vtk.vtkImageData()
+    coarseResponse.ShallowCopy( v.GetOutput() )
+    coarseResponse.SetSpacing( coarseSpacing )
+    coarseResponse.SetOrigin( coarseImage.GetOrigin() )
+    coarseResponse.SetExtent( coarseImage.GetExtent() )
+
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData( coarseResponse )
+    reslice.SetInterpolationModeToLinear()
+    reslice.MirrorOn()
+    reslice.SetOutputOrigin( 0, 0, 0 )
+    reslice.SetOutputSpacing( spacing )
+    reslice.SetOutputExtent( 0, inputArray.shape[2] - 1, 0, inputArray.shape[1] - 1, 0, inputArray.shape[0] - 1 )
+    reslice.Update()
+    return SlicerVmtkCommonLib.Helper.GetImageDataAsArray(reslice.GetOutput())
+
+  def getPreviewRegionExtent(self, volumeNode, previewRegionCenterRAS, previewRegionSizeVoxel):
+    '''
+    Returns the extent of a cube of previewRegionSizeVoxel size around previewRegionCenterRAS,
+    clamped to the extent of the volume.
+    '''
+    previewRegionCenterIJK = self.getIJKFromRAS(volumeNode, previewRegionCenterRAS)
+    previewRegionRadiusVoxel = int(round(previewRegionSizeVoxel/2+0.5))
+    extent = volumeNode.GetImageData().GetExtent()
+    regionExtent = []
+    for axis in range(3):
+      regionExtent.append(max(previewRegionCenterIJK[axis]-previewRegionRadiusVoxel, extent[axis*2]))
+      regionExtent.append(min(previewRegionCenterIJK[axis]+previewRegionRadiusVoxel, extent[axis*2+1]))
+    return regionExtent
+
+  def getSigmaValues(self, minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR):
+    '''
+    Scales evaluated between minimum and maximum diameter, same as in vtkvmtkVesselnessMeasureImageFilter.
+    With SIGMA_SPACING_LOGARITHMIC consecutive scales have a constant ratio, which samples small diameters
+    more densely, where the response changes faster with the scale.
+    '''
+    if numberOfSigmaSteps is None:
+      numberOfSigmaSteps = self.DISCRETIZATION_STEPS
+    if numberOfSigmaSteps < 2:
+      return [float(minimumDiameterMm)]
+    if sigmaSpacing == self.SIGMA_SPACING_LOGARITHMIC:
+      if minimumDiameterMm <= 0:
+        raise ValueError("Logarithmic sigma spacing requires a positive minimum diameter")
+      return [float(sigma) for sigma in numpy.exp(numpy.linspace(math.log(minimumDiameterMm), math.log(maximumDiameterMm), numberOfSigmaSteps))]
+    elif sigmaSpacing == self.SIGMA_SPACING_LINEAR:
+      return [float(sigma) for sigma in numpy.linspace(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps)]
+    else:
+      raise ValueError("Unknown sigma spacing: {0}".format(sigmaSpacing))
+
+  def computeVesselnessVolumeFromScaleSpace(self, currentVolumeNode, currentOutputVolumeNode, regionExtent,
+    minimumDiameterMm=0, maximumDiameterMm=25, alpha=0.3, beta=0.3, contrastMeasure=150,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR, scalesOutputVolumeNode=None):
+    '''
+    Computes vesselness in regionExtent of currentVolumeNode from cached Hessian eigenvalues.
+    Eigenvalues only depend on the image, the region and the scales, therefore if only alpha, beta
+    or contrastMeasure changed since the last call then just the Frangi measure is recomputed.
+    The Hessian and the Frangi measure are computed in numpy (see computeHessianEigenvalues), the result
+    approximates vtkvmtkVesselnessMeasureImageFilter but it is not identical to it.
+    '''
+    sigmas = self.getSigmaValues(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps, sigmaSpacing)
+    scaleSpace = self.getScaleSpace(currentVolumeNode, regionExtent, sigmas)
+
+    response = None
+    scales = None
+    for sigma, eigenvalues in zip(sigmas, scaleSpace):
+      scaleResponse = self.computeFrangiResponse(eigenvalues, alpha, beta, contrastMeasure)
+      if response is None:
+        response = scaleResponse
+        scales = numpy.full(response.shape, sigma, dtype=numpy.float32)
+      else:
+        scales[scaleResponse > response] = sigma
+        numpy.maximum(response, scaleResponse, out=response)
+
+    outImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(response, extentStart=regionExtent[0::2])
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    currentOutputVolumeNode.ShiftImageDataExtentToZeroStart()
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
 
-          # now check if we have two hits in opposite directions
-          if hits[0] and hits[1]:
-              # we have the diameter!
-              foundDiameter = True
-              break
+    if scalesOutputVolumeNode:
+      scalesImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(scales, extentStart=regionExtent[0::2])
+      self.storeScalesVolume(currentVolumeNode, currentOutputVolumeNode, scalesOutputVolumeNode, scalesImage, True)
+
+  def computeVesselnessParameterGrid(self, currentVolumeNode, currentOutputVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel,
+    minimumDiameterMm, maximumDiameterMm, alphaValues, betaValues, contrastMeasureValues, numberOfWorkers=4,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR):
+    '''
+    Computes the vesselness of the preview region for all combinations of alphaValues, betaValues and
+    contrastMeasureValues and stores them side by side in currentOutputVolumeNode: contrast changes along
+    the columns (I axis), alpha and beta along the rows (J axis), tiles are separated by one empty voxel.
+    Hessian eigenvalues are computed once (and cached, see getScaleSpace), only the Frangi measure
+    is evaluated for each combination, on numberOfWorkers threads. As in computeVesselnessVolumeFromScaleSpace
+    the response is computed in numpy and approximates vtkvmtkVesselnessMeasureImageFilter.
+    Returns the list of (alpha, beta, contrastMeasure) tuples in row-major tile order.
+    '''
+    import itertools
+    regionExtent = self.getPreviewRegionExtent(currentVolumeNode, previewRegionCenterRAS, previewRegionSizeVoxel)
+    sigmas = self.getSigmaValues(minimumDiameterMm, maximumDiameterMm, numberOfSigmaSteps, sigmaSpacing)
+    scaleSpace = self.getScaleSpace(currentVolumeNode, regionExtent, sigmas)
+
+    parameterGrid = list(itertools.product(alphaValues, betaValues, contrastMeasureValues))
+    numberOfColumns = len(contrastMeasureValues)
+    numberOfRows = len(alphaValues) * len(betaValues)
+    tileShape = scaleSpace[0].shape[1:]
+    mosaicArray = numpy.zeros((tileShape[0], numberOfRows * (tileShape[1] + 1) - 1, numberOfColumns * (tileShape[2] + 1) - 1),
+      dtype=numpy.float32)
+
+    def processTile(tileIndex):
+      alpha, beta, contrastMeasure = parameterGrid[tileIndex]
+      row = tileIndex // numberOfColumns
+      column = tileIndex % numberOfColumns
+      tileArray = mosaicArray[:, row * (tileShape[1] + 1):row * (tileShape[1] + 1) + tileShape[1],
+        column * (tileShape[2] + 1):column * (tileShape[2] + 1) + tileShape[2]]
+      for eigenvalues in scaleSpace:
+        numpy.maximum(tileArray, self.computeFrangiResponse(eigenvalues, alpha, beta, contrastMeasure), out=tileArray)
+
+    self.processTiles(processTile, list(range(len(parameterGrid))), numberOfWorkers)
+
+    outImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(mosaicArray)
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    return parameterGrid
+
+  def computeVesselnessVolumeFromBlockCache(self, currentVolumeNode, currentOutputVolumeNode, regionExtent,
+    minimumDiameterMm=0, maximumDiameterMm=25, alpha=0.3, beta=0.3, contrastMeasure=150,
+    numberOfSigmaSteps=None, sigmaSpacing=SIGMA_SPACING_LINEAR):
+    '''
+    Computes vesselness in regionExtent of currentVolumeNode from cached blocks of PREVIEW_BLOCK_SIZE_VOXEL size.
+    Blocks are aligned to the volume and cached for each set of parameters.
+    If no block of the region is cached (for example after a parameter change) then the region is filtered
+    directly, as in computeVesselnessVolumeSinglePass, and the blocks that are fully inside it are cached.
+    Otherwise the bounding box of the blocks that are not cached is filtered in a single run and these
+    blocks are cached. As for the preview without block cache, no halo is used, so large scales near the
+    boundary of the filtered box are only approximate and blocks computed in different runs may differ
+    slightly at their boundaries.
+    The number of computed blocks is stored in lastPreviewBlockStatistics.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    inputExtent = inputImage.GetExtent()
+    spacing = currentVolumeNode.GetSpacing()
+    # voxels edited in place only modify the scalars, not the image
+    parametersKey = (currentVolumeNode.GetID(), inputImage.GetMTime(), inputImage.GetPointData().GetScalars().GetMTime(),
+      minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing)
+
+    blockSize = self.PREVIEW_BLOCK_SIZE_VOXEL
+    blockIndexRanges = [range((regionExtent[axis * 2] - inputExtent[axis * 2]) // blockSize,
+      (regionExtent[axis * 2 + 1] - inputExtent[axis * 2]) // blockSize + 1) for axis in range(3)]
+    blockExtents = {}
+    for blockK in blockIndexRanges[2]:
+      for blockJ in blockIndexRanges[1]:
+        for blockI in blockIndexRanges[0]:
+          blockIndex = (blockI, blockJ, blockK)
+          blockExtent = []
+          for axis in range(3):
+            blockStart = inputExtent[axis * 2] + blockIndex[axis] * blockSize
+            blockExtent.append(blockStart)
+            blockExtent.append(min(blockStart + blockSize - 1, inputExtent[axis * 2 + 1]))
+          blockExtents[blockIndex] = blockExtent
+
+    missingBlockIndices = [blockIndex for blockIndex in blockExtents if (parametersKey, blockIndex) not in self.previewBlockCache]
+    if len(missingBlockIndices) == len(blockExtents):
+      # nothing to reuse, filter only the region
+      computedExtent = list(regionExtent)
+      computedBlockIndices = [blockIndex for blockIndex, blockExtent in blockExtents.items()
+        if all([blockExtent[axis * 2] >= regionExtent[axis * 2] and blockExtent[axis * 2 + 1] <= regionExtent[axis * 2 + 1]
+          for axis in range(3)])]
+    elif missingBlockIndices:
+      computedExtent = []
+      for axis in range(3):
+        computedExtent.append(min([blockExtents[blockIndex][axis * 2] for blockIndex in missingBlockIndices]))
+        computedExtent.append(max([blockExtents[blockIndex][axis * 2 + 1] for blockIndex in missingBlockIndices]))
+      computedBlockIndices = missingBlockIndices
+
+    regionShape = [regionExtent[axis * 2 + 1] - regionExtent[axis * 2] + 1 for axis in (2, 1, 0)]
+    outArray = numpy.empty(regionShape, dtype=numpy.float32)
+    if missingBlockIndices:
+      inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+      response = self.computeVesselnessTile(inputArray, inputExtent, spacing, computedExtent, computedExtent,
+        minimumDiameterMm, maximumDiameterMm, alpha, beta, contrastMeasure, numberOfSigmaSteps, sigmaSpacing=sigmaSpacing)
+      for blockIndex in computedBlockIndices:
+        self.previewBlockCache[(parametersKey, blockIndex)] = numpy.array(
+          response[self.getArraySlices(computedExtent, blockExtents[blockIndex])])
+      if computedExtent == list(regionExtent):
+        outArray[:] = response
+
+    for blockIndex, blockExtent in blockExtents.items():
+      if (parametersKey, blockIndex) not in self.previewBlockCache:
+        # only in the filtered region
+        continue
+      # move to the end, as most recently used
+      block = self.previewBlockCache.pop((parametersKey, blockIndex))
+      self.previewBlockCache[(parametersKey, blockIndex)] = block
+      overlapExtent = []
+      for axis in range(3):
+        overlapExtent.append(max(blockExtent[axis * 2], regionExtent[axis * 2]))
+        overlapExtent.append(min(blockExtent[axis * 2 + 1], regionExtent[axis * 2 + 1]))
+      outArray[self.getArraySlices(regionExtent, overlapExtent)] = block[self.getArraySlices(blockExtent, overlapExtent)]
+
+    while len(self.previewBlockCache) > len(blockExtents) and self.getPreviewBlockCacheSizeMb() > self.PREVIEW_BLOCK_CACHE_MAXIMUM_MB:
+      # remove least recently used
+      self.previewBlockCache.popitem(last=False)
+
+    self.lastPreviewBlockStatistics = { 'numberOfBlocks': len(blockExtents), 'numberOfComputedBlocks': len(missingBlockIndices) }
+    logging.debug("Vesselness preview: computed {0} of {1} blocks".format(len(missingBlockIndices), len(blockExtents)))
+
+    outImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(outArray, extentStart=regionExtent[0::2])
+    currentOutputVolumeNode.CopyOrientation( currentVolumeNode )
+    currentOutputVolumeNode.SetAndObserveImageData( outImage )
+    currentOutputVolumeNode.ShiftImageDataExtentToZeroStart()
+    currentVolumeNode.SetAndObserveNodeReferenceID("Vesselness", currentOutputVolumeNode.GetID())
 
-          if hits[2] and hits[3]:
-              foundDiameter = True
-              break
+  def getPreviewBlockCacheSizeMb(self):
+    return sum([block.nbytes for block in self.previewBlockCache.values()]) / 1024.0 / 1024.0
+
+  def clearPreviewBlockCache(self):
+    self.previewBlockCache.clear()
+
+  def getScaleSpace(self, currentVolumeNode, regionExtent, sigmas):
+    '''
+    Returns a list of Hessian eigenvalue arrays (one for each sigma), from the cache if available.
+    '''
+    inputImage = currentVolumeNode.GetImageData()
+    # voxels edited in place only modify the scalars, not the image
+    key = (currentVolumeNode.GetID(), inputImage.GetMTime(), inputImage.GetPointData().GetScalars().GetMTime(),
+      tuple(regionExtent), tuple(sigmas))
+    if key in self.scaleSpaceCache:
+      logging.debug("Using cached Hessian eigenvalues")
+      # move to the end, as most recently used
+      scaleSpace = self.scaleSpaceCache.pop(key)
+      self.scaleSpaceCache[key] = scaleSpace
+      return scaleSpace
+
+    inputArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(inputImage)
+    regionArray = inputArray[self.getArraySlices(inputImage.GetExtent(), regionExtent)]
+    spacing = currentVolumeNode.GetSpacing()
+    scaleSpace = [self.computeHessianEigenvalues(regionArray, spacing, sigma) for sigma in sigmas]
+
+    scaleSpaceSizeMb = sum([eigenvalues.nbytes for eigenvalues in scaleSpace]) / 1024.0 / 1024.0
+    if scaleSpaceSizeMb > self.SCALE_SPACE_CACHE_MAXIMUM_MB:
+      logging.debug("Hessian eigenvalues are not cached, they would take {0:.0f}MB".format(scaleSpaceSizeMb))
+      return scaleSpace
+    self.scaleSpaceCache[key] = scaleSpace
+    while (len(self.scaleSpaceCache) > self.SCALE_SPACE_CACHE_MAXIMUM_ENTRIES
+      or self.getScaleSpaceCacheSizeMb() > self.SCALE_SPACE_CACHE_MAXIMUM_MB):
+      # remove least recently used
+      self.scaleSpaceCache.popitem(last=False)
+    return scaleSpace
+
+  def getScaleSpaceCacheSizeMb(self):
+    return sum([eigenvalues.nbytes for scaleSpace in self.scaleSpaceCache.values() for eigenvalues in scaleSpace]) / 1024.0 / 1024.0
+
+  def clearScaleSpaceCache(self):
+    self.scaleSpaceCache.clear()
+
+  def computeHessianEigenvalues(self, inputArray, spacing, sigma):
+    '''
+    Returns the eigenvalues of the scale-normalized Hessian at scale sigma (in mm) as a float32 array
+    of shape (3, k, j, i). Eigenvalues are sorted by increasing magnitude along the first axis.
+    '''
+    if sigma <= 0:
+      return numpy.zeros((3,) + inputArray.shape, dtype=numpy.float32)
+
+    image = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(numpy.ascontiguousarray(inputArray, dtype=numpy.float32))
+    gaussian = vtk.vtkImageGaussianSmooth()
+    gaussian.SetInputData( image )
+    gaussian.SetDimensionality( 3 )
+    # standard deviations are specified in voxels
+    gaussian.SetStandardDeviations( sigma / spacing[0], sigma / spacing[1], sigma / spacing[2] )
+    gaussian.SetRadiusFactors( self.TILE_HALO_SIGMA_FACTOR, self.TILE_HALO_SIGMA_FACTOR, self.TILE_HALO_SIGMA_FACTOR )
+    gaussian.Update()
+    smoothed = SlicerVmtkCommonLib.Helper.GetImageDataAsArray(gaussian.GetOutput())
+
+    # array axes are k, j, i
+    axisSpacing = [spacing[2], spacing[1], spacing[0]]
+    firstDerivatives = [self.centralDifference(smoothed, axis, axisSpacing[axis]) for axis in range(3)]
+    # scale normalization, as in vtkvmtkVesselnessMeasureImageFilter
+    normalization = sigma * sigma
+    hessian = {}
+    for row in range(3):
+      for column in range(row, 3):
+        hessian[(row, column)] = normalization * self.centralDifference(firstDerivatives[row], column, axisSpacing[column])
+    del firstDerivatives
+
+    numberOfVoxels = smoothed.size
+    eigenvalues = numpy.empty((3, numberOfVoxels), dtype=numpy.float32)
+    for start in range(0, numberOfVoxels, self.EIGENANALYSIS_CHUNK_SIZE):
+      stop = min(start + self.EIGENANALYSIS_CHUNK_SIZE, numberOfVoxels)
+      matrices = numpy.empty((stop - start, 3, 3), dtype=numpy.float32)
+      for (row, column), component in hessian.items():
+        matrices[:, row, column] = component.ravel()[start:stop]
+        matrices[:, column, row] = matrices[:, row, column]
+      chunkEigenvalues = numpy.linalg.eigvalsh(matrices)
+      order = numpy.argsort(numpy.abs(chunkEigenvalues), axis=1)
+      chunkEigenvalues = chunkEigenvalues[numpy.arange(stop - start)[:, numpy.newaxis], order]
+      eigenvalues[:, start:stop] = chunkEigenvalues.T
+    return eigenvalues.reshape((3,) + smoothed.shape)
+
+  def centralDifference(self, array, axis, spacing):
+    '''
+    Derivative of array along axis using central differences (one-sided at the boundary).
+    '''
+    def axisSlice(start, stop):
+      slices = [slice(None)] * array.ndim
+      slices[axis] = slice(start, stop)
+      return tuple(slices)
+    derivative = numpy.zeros_like(array)
+    if array.shape[axis] < 2:
+      return derivative
+    derivative[axisSlice(1, -1)] = (array[axisSlice(2, None)] - array[axisSlice(None, -2)]) / (2.0 * spacing)
+    derivative[axisSlice(0, 1)] = (array[axisSlice(1, 2)] - array[axisSlice(0, 1)]) / spacing
+    derivative[axisSlice(-1, None)] = (array[axisSlice(-1, None)] - array[axisSlice(-2, -1)]) / spacing
+    return derivative
+
+  def computeFrangiResponse(self, eigenvalues, alpha, beta, contrastMeasure):
+    '''
+    Frangi vesselness of bright tubular structures from Hessian eigenvalues sorted by magnitude.
+    Uses the same alpha, beta and gamma (contrastMeasure) convention as vtkvmtkVesselnessMeasureImageFilter.
+    '''
+    absLambda1 = numpy.abs(eigenvalues[0])
+    absLambda2 = numpy.abs(eigenvalues[1])
+    absLambda3 = numpy.abs(eigenvalues[2])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      raSquared = (absLambda2 / absLambda3) ** 2
+      rbSquared = absLambda1 ** 2 / (absLambda2 * absLambda3)
+    sSquared = absLambda1 ** 2 + absLambda2 ** 2 + absLambda3 ** 2
+    # avoid division by zero, a zero parameter means that the corresponding term is not used
+    tiny = 1e-12
+    response = 1.0 - numpy.exp(-raSquared / max(2.0 * alpha * alpha, tiny))
+    response *= numpy.exp(-rbSquared / max(2.0 * beta * beta, tiny))
+    response *= 1.0 - numpy.exp(-sSquared / max(2.0 * contrastMeasure * contrastMeasure, tiny))
+    response[(eigenvalues[1] > 0) | (eigenvalues[2] > 0) | ~numpy.isfinite(response)] = 0.0
+    return response.astype(numpy.float32)
+
+  def getDiameterFromScales( self, volumeNode, ras ):
+      '''
+      Returns the vessel diameter (in voxels of the smallest spacing) at ras from the scale map of volumeNode
+      (see storeScalesVolume). Returns None if there is no scale map or it cannot tell the diameter: there is
+      no vessel at the position or the scale is the largest one in the map, so the vessel may be larger.
+      '''
+      diameterMm = SlicerVmtkCommonLib.Helper.GetVesselnessScaleAtRAS( volumeNode, ras )
+      if diameterMm is None:
+          return None
+      scalesVolumeNode = SlicerVmtkCommonLib.Helper.GetVesselnessScalesVolumeNode( volumeNode )
+      if diameterMm >= scalesVolumeNode.GetImageData().GetScalarRange()[1]:
+          return None
+      # scales below half a voxel still mean a vessel of at least one voxel
+      return max( int( round( diameterMm / min( volumeNode.GetSpacing() ) ) ), 1 )
+
+  def getDiameter( self, image, ijk, maximumDiameterVoxel=None ):
+      '''
+      Returns the vessel diameter (in voxels) at ijk, detected as the distance of the nearest
+      pair of opposite sign changes of the Laplacian of Gaussian around the seed.
+      Only a neighborhood of maximumDiameterVoxel around the seed is processed.
+      '''
+      if maximumDiameterVoxel is None:
+          maximumDiameterVoxel = self.DIAMETER_DETECTION_MAXIMUM_VOXEL
+
+      # crop the neighborhood, extended by the support of the Laplacian of Gaussian
+      extent = image.GetExtent()
+      cropRadius = maximumDiameterVoxel + self.LAPLACE_OF_GAUSSIAN_MARGIN_VOXEL
+      cropExtent = []
+      for axis in range( 3 ):
+          cropExtent.append( max( ijk[axis] - cropRadius, extent[axis * 2] ) )
+          cropExtent.append( min( ijk[axis] + cropRadius, extent[axis * 2 + 1] ) )
+      imageArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray( image )
+      cropArray = numpy.ascontiguousarray( imageArray[self.getArraySlices( extent, cropExtent )] )
+      cropImage = SlicerVmtkCommonLib.Helper.CreateImageDataFromArray( cropArray, extentStart=cropExtent[0::2] )
+
+      edgeImage = self.performLaplaceOfGaussian( cropImage )
+      edgeArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray( edgeImage )
+
+      # seed position in the cropped array (k, j, i)
+      i, j, k = [ijk[axis] - cropExtent[axis * 2] for axis in range( 3 )]
+      seedValueSign = numpy.sign( edgeArray[k, j, i] )
+
+      # intensity profiles starting next to the seed
+      # [left, right, top, bottom, front, back]
+      profiles = [edgeArray[k, j, i - 1::-1] if i > 0 else edgeArray[k, j, 0:0],
+                  edgeArray[k, j, i + 1:],
+                  edgeArray[k, j + 1:, i],
+                  edgeArray[k, j - 1::-1, i] if j > 0 else edgeArray[k, 0:0, i],
+                  edgeArray[k + 1:, j, i],
+                  edgeArray[k - 1::-1, j, i] if k > 0 else edgeArray[0:0, j, i]]
 
-          if hits[4] and hits[5]:
-              foundDiameter = True
-              break
+      # distance of the first sign change in each direction
+      hitDistances = []
+      for profile in profiles:
+          hits = numpy.sign( profile[:maximumDiameterVoxel] ) != seedValueSign
+          hitDistances.append( int( numpy.argmax( hits ) ) + 1 if hits.any() else None )
 
-          # increase distance from seed for next iteration
-          distanceFromSeed += 1
+      # the diameter is found when there are hits in two opposite directions
+      diameters = [max( hitDistances[direction], hitDistances[direction + 1] ) for direction in [0, 2, 4]
+                   if hitDistances[direction] is not None and hitDistances[direction + 1] is not None]
+      if not diameters:
+          # the diameter was not detected properly
+          return maximumDiameterVoxel
 
-      # we now just return the distanceFromSeed
-      # if the diameter was not detected properly, this can equal one of the image dimensions
-      return distanceFromSeed
+      return min( diameters )
 
 
   def performLaplaceOfGaussian( self, image ):
@@ -569,17 +1819,22 @@ class VesselnessFilteringLogic(ScriptedLoadableModuleLogic):
 
   def calculateContrastMeasure( self, image, ijk, diameter ):
       '''
+      Estimates contrast from the intensity difference between the seed and points
+      at twice the diameter distance in the six axis directions.
       '''
-      seedValue = image.GetScalarComponentAsFloat( ijk[0], ijk[1], ijk[2], 0 )
+      extent = image.GetExtent()
+      imageArray = SlicerVmtkCommonLib.Helper.GetImageDataAsArray( image )
 
-      outsideValues = [seedValue - image.GetScalarComponentAsFloat( ijk[0] + ( 2 * diameter ), ijk[1], ijk[2], 0 ),  # right
-                       seedValue - image.GetScalarComponentAsFloat( ijk[0] - ( 2 * diameter ), ijk[1], ijk[2], 0 ),  # left
-                       seedValue - image.GetScalarComponentAsFloat( ijk[0], ijk[1] + ( 2 * diameter ), ijk[2], 0 ),  # top
-                       seedValue - image.GetScalarComponentAsFloat( ijk[0], ijk[1] - ( 2 * diameter ), ijk[2], 0 ),  # bottom
-                       seedValue - image.GetScalarComponentAsFloat( ijk[0], ijk[1], ijk[2] + ( 2 * diameter ), 0 ),  # front
-                       seedValue - image.GetScalarComponentAsFloat( ijk[0], ijk[1], ijk[2] - ( 2 * diameter ), 0 )]  # back
+      # right, left, top, bottom, front, back
+      offsets = numpy.array( [[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]] ) * ( 2 * diameter )
+      points = numpy.array( ijk[0:3] ) + offsets
+      for axis in range( 3 ):
+          points[:, axis] = numpy.clip( points[:, axis], extent[axis * 2], extent[axis * 2 + 1] ) - extent[axis * 2]
 
-      differenceValue = max( outsideValues )
+      seedValue = float( imageArray[ijk[2] - extent[4], ijk[1] - extent[2], ijk[0] - extent[0]] )
+      outsideValues = seedValue - imageArray[points[:, 2], points[:, 1], points[:, 0]].astype( numpy.float64 )
+
+      differenceValue = outsideValues.max()
 
       contrastMeasure = differenceValue / 10  # get 1/10 of it
 
@@ -613,6 +1868,12 @@ class VesselnessFilteringTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_BasicVesselSegmentation()
+    self.setUp()
+    self.test_TiledVesselness()
+    self.setUp()
+    self.test_MultiresolutionVesselness()
+    self.setUp()
+    self.test_SparseImageSaveLoad()
 
   def test_BasicVesselSegmentation(self):
     self.delayDisplay("Testing BasicVesselSegmentation")
@@ -640,7 +1901,121 @@ class VesselnessFilteringTest(ScriptedLoadableModuleTest):
     slicer.util.setSliceViewerLayers(background=self.inputAngioVolume, foreground=previewVolumeNode)
     
     self.delayDisplay('Testing BasicVesselSegmentation completed successfully')
-    
+
+  def test_TiledVesselness(self):
+    self.delayDisplay("Testing TiledVesselness")
+
+    logic = VesselnessFilteringLogic()
+
+    singlePassVolumeNode = self.createVolumeNode('VesselnessSinglePass')
+    logic.computeVesselnessVolume(self.inputAngioVolume, singlePassVolumeNode, minimumDiameterMm=0.5, maximumDiameterMm=2.0,
+      alpha=0.03, beta=0.03, contrastMeasure=200)
+
+    # small memory budget to force splitting the volume into many tiles
+    tiledVolumeNode = self.createVolumeNode('VesselnessTiled')
+    logic.computeVesselnessVolume(self.inputAngioVolume, tiledVolumeNode, minimumDiameterMm=0.5, maximumDiameterMm=2.0,
+      alpha=0.03, beta=0.03, contrastMeasure=200, tiled=True, memoryBudgetMb=64, numberOfWorkers=2)
+
+    singlePassArray = slicer.util.array(singlePassVolumeNode.GetID())
+    tiledArray = slicer.util.array(tiledVolumeNode.GetID())
+    self.assertEqual(singlePassArray.shape, tiledArray.shape)
+    self.assertLess(numpy.abs(singlePassArray - tiledArray).max(), 1e-3 * max(singlePassArray.max(), 1e-6))
+
+    # background computation, one scale of one tile in each step
+    stepsVolumeNode = self.createVolumeNode('VesselnessSteps')
+    for progress in logic.computeVesselnessVolumeSteps(self.inputAngioVolume, stepsVolumeNode, minimumDiameterMm=0.5,
+      maximumDiameterMm=2.0, alpha=0.03, beta=0.03, contrastMeasure=200):
+      self.assertLessEqual(progress, 1.0)
+    stepsArray = slicer.util.array(stepsVolumeNode.GetID())
+    self.assertEqual(singlePassArray.shape, stepsArray.shape)
+    self.assertLess(numpy.abs(singlePassArray - stepsArray).max(), 1e-3 * max(singlePassArray.max(), 1e-6))
+
+    self.delayDisplay('Testing TiledVesselness completed successfully')
+
+  def test_MultiresolutionVesselness(self):
+    self.delayDisplay("Testing MultiresolutionVesselness")
+
+    logic = VesselnessFilteringLogic()
+    # tube of 8mm diameter, scales 1, 3 mm are evaluated at full resolution, 5, 7, 9 mm on the downsampled volume
+    tubeVolumeNode = self.createTubeVolumeNode('Tube', radius=4.0)
+
+    singleResolutionVolumeNode = self.createVolumeNode('VesselnessSingleResolution')
+    logic.computeVesselnessVolume(tubeVolumeNode, singleResolutionVolumeNode, minimumDiameterMm=1.0, maximumDiameterMm=9.0,
+      alpha=0.3, beta=0.3, contrastMeasure=100)
+
+    multiresolutionVolumeNode = self.createVolumeNode('VesselnessMultiresolution')
+    logic.computeVesselnessVolume(tubeVolumeNode, multiresolutionVolumeNode, minimumDiameterMm=1.0, maximumDiameterMm=9.0,
+      alpha=0.3, beta=0.3, contrastMeasure=100, multiresolution=True, memoryBudgetMb=64)
+    self.assertTrue(logic.lastMultiresolutionStatistics['fineSigmas'])
+    self.assertTrue(logic.lastMultiresolutionStatistics['coarseSigmas'])
+
+    singleResolutionArray = slicer.util.array(singleResolutionVolumeNode.GetID())
+    multiresolutionArray = slicer.util.array(multiresolutionVolumeNode.GetID())
+    self.assertEqual(singleResolutionArray.shape, multiresolutionArray.shape)
+    responseMaximum = singleResolutionArray.max()
+    self.assertGreater(responseMaximum, 0)
+
+    # response along the tube axis, away from the tube ends
+    shape = singleResolutionArray.shape
+    singleResolutionAxis = singleResolutionArray[shape[0] // 2, shape[1] // 2, 16:-16]
+    multiresolutionAxis = multiresolutionArray[shape[0] // 2, shape[1] // 2, 16:-16]
+    self.assertLess(abs(multiresolutionAxis.mean() - singleResolutionAxis.mean()), 0.1 * singleResolutionAxis.mean())
+    self.assertLess(numpy.abs(multiresolutionArray - singleResolutionArray).mean(), 0.05 * responseMaximum)
+
+    self.delayDisplay('Testing MultiresolutionVesselness completed successfully')
+
+  def test_SparseImageSaveLoad(self):
+    self.delayDisplay("Testing SparseImageSaveLoad")
+
+    import shutil, tempfile
+    # dimensions are not multiples of the block size, the extent does not start at 0
+    denseArray = numpy.zeros((21, 37, 45), dtype=numpy.float32)
+    denseArray[3:9, 20:30, 5:40] = numpy.linspace(0.2, 1.0, 35, dtype=numpy.float32)
+    denseArray[18:21, 0:4, 40:45] = 0.5
+    denseArray[10, 10, 10] = 0.05
+    sparseImage = SlicerVmtkCommonLib.SparseImage.CreateFromArray(denseArray, extentStart=(3, -2, 7),
+      spacing=(0.5, 0.7, 1.25), epsilon=0.1)
+    self.assertGreater(sparseImage.GetNumberOfBlocks(), 0)
+    emptySparseImage = SlicerVmtkCommonLib.SparseImage([0, 9, 0, 9, 0, 9], epsilon=0.1)
+
+    tempDirectory = tempfile.mkdtemp()
+    try:
+      for image in (sparseImage, emptySparseImage):
+        fileName = os.path.join(tempDirectory, 'SparseVesselness.npz')
+        image.Save(fileName)
+        loadedImage = SlicerVmtkCommonLib.SparseImage.Load(fileName)
+        self.assertEqual(loadedImage.GetExtent(), image.GetExtent())
+        self.assertEqual(loadedImage.GetSpacing(), image.GetSpacing())
+        self.assertEqual(loadedImage.GetNumberOfBlocks(), image.GetNumberOfBlocks())
+        self.assertTrue(numpy.array_equal(loadedImage.GetDenseArray(), image.GetDenseArray()))
+    finally:
+      shutil.rmtree(tempDirectory)
+
+    # values not above epsilon are not stored
+    expectedArray = numpy.where(denseArray > 0.1, denseArray, 0)
+    self.assertTrue(numpy.array_equal(sparseImage.GetDenseArray(), expectedArray))
+
+    self.delayDisplay('Testing SparseImageSaveLoad completed successfully')
+
+  def createVolumeNode(self, name):
+    volumeNode = slicer.mrmlScene.CreateNodeByClass( "vtkMRMLScalarVolumeNode" )
+    volumeNode.UnRegister(None)
+    volumeNode.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
+    volumeNode = slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.CreateDefaultDisplayNodes()
+    return volumeNode
+
+  def createTubeVolumeNode(self, name, radius, shape=(48, 48, 80)):
+    '''
+    Synthetic volume (shape is [k, j, i]) of a bright tube with smooth boundary along the I axis.
+    '''
+    k, j, i = numpy.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    distance = numpy.sqrt((k - shape[0] / 2.0) ** 2 + (j - shape[1] / 2.0) ** 2)
+    tubeArray = numpy.ascontiguousarray(200.0 / (1.0 + numpy.exp(distance - radius)), dtype=numpy.float32)
+    volumeNode = self.createVolumeNode(name)
+    volumeNode.SetAndObserveImageData(SlicerVmtkCommonLib.Helper.CreateImageDataFromArray(tubeArray))
+    return volumeNode
+
 class Slicelet( object ):
   """A slicer slicelet is a module widget that comes up in stand alone mode
   implemented as a python class.